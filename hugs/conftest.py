@@ -0,0 +1,66 @@
+from __future__ import division, print_function
+
+import io
+import tarfile
+import threading
+import numpy as np
+import pytest
+from astropy.io import fits
+from six.moves import BaseHTTPServer
+
+
+class _DASHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in for DAS: reply to a coordlist upload with a tar stream
+    of stamps numbered from 2 (the coordlist line numbers), where
+    each image is filled with the first coordinate of its line.
+    Requests whose first line is in server.fail_first fail once.
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        content = body.split(b'\r\n\r\n', 1)[1].rsplit(b'\r\n--', 1)[0]
+        lines = [l for l in content.decode().splitlines()
+                 if l.strip() and l[0]!='#']
+        if lines[0] in self.server.fail_first:
+            self.server.fail_first.remove(lines[0])
+            self.send_error(500)
+            return
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            for i, line in enumerate(lines):
+                hdus = [fits.PrimaryHDU()]
+                value = float(line.split()[0])
+                hdus.append(fits.ImageHDU(np.full((5, 5), value, 'f4')))
+                hdus.append(fits.ImageHDU(np.zeros((5, 5), 'i4')))
+                hdus.append(fits.ImageHDU(np.ones((5, 5), 'f4')))
+                data = io.BytesIO()
+                fits.HDUList(hdus).writeto(data)
+                info = tarfile.TarInfo(
+                    'arch-1/{}-cutout-s16a_wide.fits'.format(i + 2))
+                info.size = data.tell()
+                data.seek(0)
+                tar.addfile(info, data)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(buf.getvalue())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def das_server():
+    """
+    A local DAS stand-in (see _DASHandler), with its address in
+    server.url.
+    """
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _DASHandler)
+    server.fail_first = set()
+    server.url = 'http://127.0.0.1:{}/'.format(server.server_port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -1,4 +1,5 @@
 from .hugged import CatButler
 from . import hugged
 from . import hsc
+from . import das
 from . import yang
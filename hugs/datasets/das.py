@@ -0,0 +1,281 @@
+"""
+Concurrent, resumable downloads of postage stamps from the HSC data
+access service (DAS).
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os
+import io
+import json
+import time
+import base64
+import hashlib
+import tarfile
+import threading
+from six.moves.urllib import request as urllib_request
+
+from .. import utils
+
+__all__ = ['DAS_URL', 'DASDownloader', 'read_coordlist']
+
+DAS_URL = 'https://hscdata.mtk.nao.ac.jp:4443/das_quarry/cgi-bin/quarryImage'
+STATE_FN = 'das-state.json'
+
+
+def read_coordlist(fn):
+    """
+    Read a DAS coordlist (output from hsc.make_query_coordlist).
+
+    Returns
+    -------
+    header : string
+        The column header line.
+    lines : list of strings
+        One line per requested stamp.
+    """
+    header = None
+    lines = []
+    with open(fn) as file:
+        for line in file:
+            if line.startswith('#'):
+                header = line.rstrip('\n')
+            elif line.strip():
+                lines.append(line.rstrip('\n'))
+    return header, lines
+
+
+def _multipart(name, filename, content):
+    """
+    Encode a file upload (curl --form name=@filename) as a
+    multipart/form-data request body.
+    """
+    boundary = '----hugs-das-'+hashlib.md5(content).hexdigest()
+    body = b''.join([
+        ('--'+boundary+'\r\n').encode(),
+        ('Content-Disposition: form-data; name="{}"; '
+         'filename="{}"\r\n'.format(name, filename)).encode(),
+        b'Content-Type: text/plain\r\n\r\n',
+        content,
+        ('\r\n--'+boundary+'--\r\n').encode()])
+    return body, 'multipart/form-data; boundary='+boundary
+
+
+class DASDownloader(object):
+    """
+    Download postage stamps from DAS in chunks of the coordlist,
+    with several requests in flight. Each response is streamed
+    through tarfile, so stamps are written as they arrive without
+    saving the tar archive or shuffling arch* directories. Failed
+    chunks are retried, and completed chunks are recorded in a
+    state file in the output directory, so rerunning a download
+    only requests the missing chunks.
+
+    Parameters
+    ----------
+    username : string
+        DAS user name.
+    password : string, optional
+        DAS password.
+    url : string, optional
+        DAS cutout url (e.g., a local server for testing).
+    chunk_size : int, optional
+        Number of coordlist lines per request.
+    n_jobs : int, optional
+        Number of requests in flight.
+    retries : int, optional
+        Number of times to retry a failed chunk.
+    backoff : float, optional
+        Wait backoff*2**attempt seconds before each retry.
+    timeout : float, optional
+        Socket timeout of the requests in seconds.
+    insecure : bool, optional
+        If True, do not verify the server certificate
+        (like curl --insecure).
+    """
+
+    def __init__(self, username, password=None, url=DAS_URL, chunk_size=200,
+                 n_jobs=4, retries=3, backoff=2.0, timeout=600,
+                 insecure=False):
+        self.username = username
+        self.password = password
+        self.url = url
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.insecure = insecure
+        self._lock = threading.Lock()
+
+    def _open(self, header, lines):
+        content = '\n'.join([header] + lines).encode() + b'\n'
+        body, content_type = _multipart('list', 'coordlist.txt', content)
+        req = urllib_request.Request(self.url, data=body)
+        req.add_header('Content-Type', content_type)
+        auth = '{}:{}'.format(self.username, self.password or '')
+        auth = base64.b64encode(auth.encode()).decode()
+        req.add_header('Authorization', 'Basic '+auth)
+        kwargs = {'timeout': self.timeout}
+        if self.insecure and self.url.startswith('https'):
+            import ssl
+            kwargs['context'] = ssl._create_unverified_context()
+        return urllib_request.urlopen(req, **kwargs)
+
+    def _stream(self, response, offset, outdir, stamps):
+        """
+        Extract the fits members of a tar stream. The stamps are
+        numbered by DAS within each request, so the numbers are
+        shifted by the chunk offset to keep them unique and in
+        coordlist order. Returns the (DAS number, file name) of
+        the stamps.
+        """
+        written = []
+        with tarfile.open(fileobj=response, mode='r|*') as tar:
+            for member in tar:
+                fn = os.path.basename(member.name)
+                if not member.isfile() or fn[-4:]!='fits':
+                    continue
+                num, rest = fn.split('-', 1)
+                file = tar.extractfile(member)
+                if stamps is not None:
+                    stamps.append((int(num), file.read()))
+                    fn = None
+                else:
+                    fn = '{}-{}'.format(int(num) + offset, rest)
+                    tmp_fn = os.path.join(outdir, '.'+fn)
+                    with open(tmp_fn, 'wb') as out:
+                        while True:
+                            buf = file.read(1 << 20)
+                            if not buf:
+                                break
+                            out.write(buf)
+                    os.rename(tmp_fn, os.path.join(outdir, fn))
+                written.append((int(num), fn))
+        return written
+
+    def _fetch(self, chunk, header, outdir, archive, bands, callback):
+        offset, lines = chunk
+        for attempt in range(self.retries + 1):
+            stamps = [] if archive is not None else None
+            try:
+                response = self._open(header, lines)
+                try:
+                    written = self._stream(response, offset, outdir, stamps)
+                finally:
+                    response.close()
+                if len(written) < len(lines):
+                    raise IOError('received {} of {} stamps'.format(
+                        len(written), len(lines)))
+                break
+            except Exception as error:
+                if attempt==self.retries:
+                    return offset, error
+                print('chunk {}: {}, retrying'.format(offset, error))
+                time.sleep(self.backoff*2**attempt)
+        if archive is not None:
+            self._archive_chunk(stamps, offset, archive, bands)
+        if callback is not None:
+            for i, (_, fn) in enumerate(sorted(written)):
+                callback(offset + i, fn)
+        return offset, None
+
+    def _archive_chunk(self, stamps, offset, archive, bands):
+        """
+        Write the stamps of a chunk to a StampArchive, where the line
+        of each stamp gives its candidate number and band (the line
+        order of hsc.make_query_coordlist).
+        """
+        from astropy.io import fits
+        stamps.sort(key=lambda stamp: stamp[0])
+        with self._lock:
+            for i, (_, data) in enumerate(stamps):
+                num, band = divmod(offset + i, len(bands))
+                with fits.open(io.BytesIO(data)) as hdulist:
+                    planes = [hdulist[ext].data for ext in [1, 2, 3]]
+                    headers = [hdulist[ext].header for ext in [1, 2, 3]]
+                    archive.write(num, bands[band], *planes, headers=headers)
+
+    def _load_state(self, state_fn, key):
+        if os.path.isfile(state_fn):
+            with open(state_fn) as file:
+                state = json.load(file)
+            if state.get('key')==key:
+                return state
+        return {'key': key, 'done': []}
+
+    def _save_state(self, state, state_fn):
+        tmp_fn = state_fn+'.tmp'
+        with open(tmp_fn, 'w') as file:
+            json.dump(state, file)
+        os.rename(tmp_fn, state_fn)
+
+    def download(self, coordlist, outdir, archive=None, bands='GRI',
+                 callback=None):
+        """
+        Download the stamps of a coordlist.
+
+        Parameters
+        ----------
+        coordlist : string
+            Coordinate list (output from hsc.make_query_coordlist).
+        outdir : string
+            Output directory for the stamps and the state file.
+        archive : StampArchive, optional
+            If not None, write the stamps to this archive instead
+            of fits files in outdir. The stamps of a chunk are
+            kept in memory until the chunk is complete.
+        bands : string or list, optional
+            Bands of the coordlist, which map the lines to
+            (candidate, band) keys of the archive.
+        callback : callable, optional
+            Called as callback(line, fn) for each stamp when its
+            chunk is complete, where line is the index of the stamp
+            in the coordlist and fn is the file name in outdir (None
+            if archive is not None). It is called from the download
+            threads and may block to apply back-pressure.
+
+        Returns
+        -------
+        failed : list of ints
+            Offsets of the chunks that failed after all the retries
+            (empty if the download is complete). Rerun to resume.
+        """
+        utils.mkdir_if_needed(outdir)
+        header, lines = read_coordlist(coordlist)
+        chunks = [(offset, lines[offset:offset + self.chunk_size])
+                  for offset in range(0, len(lines), self.chunk_size)]
+
+        key = hashlib.md5('\n'.join(lines).encode()).hexdigest()
+        key += '-{}'.format(self.chunk_size)
+        state_fn = os.path.join(outdir, STATE_FN)
+        state = self._load_state(state_fn, key)
+        done = set(state['done'])
+        todo = [chunk for chunk in chunks if chunk[0] not in done]
+        bands = [band.lower() for band in bands]
+
+        fetch = lambda chunk: self._fetch(
+            chunk, header, outdir, archive, bands, callback)
+        pool = None
+        if self.n_jobs==1:
+            results = map(fetch, todo)
+        else:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(self.n_jobs)
+            results = pool.imap_unordered(fetch, todo)
+
+        failed = []
+        try:
+            for offset, error in results:
+                if error is None:
+                    state['done'].append(offset)
+                    self._save_state(state, state_fn)
+                else:
+                    print('chunk {} failed: {}'.format(offset, error))
+                    failed.append(offset)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        return sorted(failed)
@@ -0,0 +1,70 @@
+from __future__ import division, print_function
+
+import os
+import threading
+import pytest
+from astropy.io import fits
+
+from .. import das
+from ... import imtools
+
+
+def _coordlist(tmpdir, num_lines):
+    fn = str(tmpdir.join('coordlist.txt'))
+    with open(fn, 'w') as file:
+        print('#?   ra       dec  filter', file=file)
+        for i in range(num_lines):
+            print(' {:.1f} 0.0 HSC-I'.format(i), file=file)
+    return fn
+
+
+def test_download(tmpdir, das_server):
+    coordlist = _coordlist(tmpdir, 10)
+    outdir = str(tmpdir.join('stamps'))
+    das_server.fail_first.add(' 4.0 0.0 HSC-I')
+    downloader = das.DASDownloader(
+        'user', url=das_server.url, chunk_size=4, n_jobs=2, retries=1, 
+        backoff=0)
+    assert downloader.download(coordlist, outdir)==[]
+    files = sorted(f for f in os.listdir(outdir) if f[-4:]=='fits')
+    assert len(files)==10
+    for fn in files:
+        num = int(fn.split('-')[0])
+        data = fits.getdata(os.path.join(outdir, fn), 1)
+        assert data[0, 0]==num - 2
+
+    # completed chunks are not requested again
+    removed = os.path.join(outdir, files[0])
+    os.remove(removed)
+    assert downloader.download(coordlist, outdir)==[]
+    assert not os.path.isfile(removed)
+
+
+def test_download_archive(tmpdir, das_server):
+    coordlist = _coordlist(tmpdir, 6)
+    outdir = str(tmpdir.join('stamps'))
+    downloader = das.DASDownloader('user', url=das_server.url, chunk_size=4, 
+                                   n_jobs=2)
+    archive_fn = str(tmpdir.join('stamps.h5'))
+    with imtools.StampArchive(archive_fn, 'w') as archive:
+        assert downloader.download(coordlist, outdir, archive, 'GR')==[]
+    with imtools.StampArchive(archive_fn) as archive:
+        assert archive.keys()==[(n, b) for n in range(3) for b in 'gr']
+        header, img, mask, var = archive.read(2, 'r')
+        assert img[0, 0]==5
+
+
+def test_download_pool_closed(tmpdir, monkeypatch, das_server):
+    coordlist = _coordlist(tmpdir, 6)
+    outdir = str(tmpdir.join('stamps'))
+
+    def _fail(self, state, state_fn):
+        raise IOError('disk full')
+
+    monkeypatch.setattr(das.DASDownloader, '_save_state', _fail)
+    downloader = das.DASDownloader('user', url=das_server.url, chunk_size=2, 
+                                   n_jobs=2)
+    num_threads = threading.active_count()
+    with pytest.raises(IOError):
+        downloader.download(coordlist, outdir)
+    assert threading.active_count()==num_threads
@@ -2,4 +2,7 @@ from .masking import make_mask
 from .core import *
 from . import viz
 from . import masking
-from .sersic import Sersic
+from .sersic import Sersic, SersicCatalog
+from .fisher import sersic_jacobian, fisher_covariance
+from .engine import ENGINES
+from . import engine
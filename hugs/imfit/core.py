@@ -26,7 +26,9 @@ def run(img_fn, config_fn, mask_fn=None, var_fn=None, save_model=False,
         The configuration file name.
     mask_fn : string, optional
         Mask fits file with 0 for good pixels and 
-        >1 for bad pixels.
+        >1 for bad pixels. Imfit reads the primary HDU, so 
+        tile-compressed masks (which are stored in extension 1) 
+        are not accepted.
     var_fn : string, optional
         Variance map fits file name. 
     save_model : bool, optional
@@ -54,6 +56,10 @@ def run(img_fn, config_fn, mask_fn=None, var_fn=None, save_model=False,
     """
 
     import subprocess
+    if (mask_fn is not None) and (mask_fn[-1]!=']'):
+        from astropy.io import fits
+        assert fits.getheader(mask_fn, 0)['NAXIS'] > 0, \
+            'imfit needs the mask in the primary HDU (no compression)'
     cmd = "imfit '"+img_fn+"' -c "+config_fn+" "
     if mask_fn is not None:
         cmd += "--mask '"+mask_fn+"' "
@@ -0,0 +1,693 @@
+"""
+In-process Sersic fitting engine, an alternative to running the imfit
+executable on fits files.
+"""
+from __future__ import division, print_function
+
+import numpy as np
+from scipy.special import gammaincinv
+
+from .core import SERSIC_PARAMS
+from .fisher import sersic_jacobian
+
+__all__ = ['ENGINES', 'parse_config', 'fit', 'fit_batch', 'fit_linear',
+           'fit_joint']
+
+ENGINES = ['imfit', 'scipy']
+
+# lower limits for parameters without limits, which keep the
+# profile defined during the fit
+_POSITIVE = {'n': 0.01, 'I_e': 0.0, 'r_e': 0.01}
+
+# peak memory of a fit_batch pass per fit, in float64 planes of the
+# padded model grid: the model and Jacobian planes with the 
+# temporaries of sersic_jacobian and the FFT convolution (~45 
+# measured for HSC stamps with a PSF)
+_PASS_PLANES = 48
+
+
+def parse_config(config):
+    """
+    Parse an imfit config dict (see write_config).
+
+    Returns
+    -------
+    values : ndarray
+        Initial values in the order of SERSIC_PARAMS.
+    lower, upper : ndarrays
+        Parameter limits (-inf/inf if none are given).
+    free : bool ndarray
+        False for fixed parameters.
+    """
+    num = len(SERSIC_PARAMS)
+    values = np.zeros(num)
+    lower, upper = np.full(num, -np.inf), np.full(num, np.inf)
+    free = np.ones(num, dtype=bool)
+    for i, p in enumerate(SERSIC_PARAMS):
+        val = config[p]
+        if type(val) is list:
+            if len(val)==1:
+                values[i] = val[0]
+            elif len(val)==2:
+                assert val[1]=='fixed', 'Invalid parameter definition.'
+                values[i], free[i] = val[0], False
+            elif len(val)==3:
+                values[i], lower[i], upper[i] = val
+            else:
+                raise Exception('Invalid parameter definition.')
+        else:
+            values[i] = val
+        if p in _POSITIVE and lower[i]==-np.inf:
+            lower[i] = _POSITIVE[p]
+    return values, lower, upper, free
+
+
+def _weights(img, mask=None, var=None):
+    """
+    Good pixels of the image(s) and their inverse-sigma weights
+    (zero for bad pixels).
+    """
+    good = np.isfinite(img)
+    if mask is not None:
+        good &= np.asarray(mask)==0
+    if var is None:
+        weight = good.astype(float)
+    else:
+        var = np.asarray(var, dtype=float)
+        good &= var > 0
+        weight = np.zeros(img.shape)
+        weight[good] = 1/np.sqrt(var[good])
+    return good, weight
+
+
+def _grid(shape, psf=None, convolver=None):
+    """
+    Pixel coordinates for the model of an image, padded by the PSF 
+    size, and the slices that crop the padded model to the image.
+    """
+    ny, nx = shape
+    pad_y, pad_x = 0, 0
+    if psf is not None:
+        from .sersic import default_convolver
+        convolver = default_convolver if convolver is None else convolver
+        psf = convolver.load(psf)
+        pad_y, pad_x = psf.shape[0]//2, psf.shape[1]//2
+    # 1-indexed pixel coordinates, as in imfit
+    y, x = np.mgrid[1 - pad_y:ny + pad_y + 1, 1 - pad_x:nx + pad_x + 1]
+    crop = (slice(pad_y, pad_y + ny), slice(pad_x, pad_x + nx))
+    return x, y, crop, psf, convolver
+
+
+def _block_stamp(img, mask, var, factor):
+    """
+    Average an image in factor x factor blocks (cropping it to a
+    multiple of factor), ignoring bad pixels. A block is good if at
+    least half of its pixels are, and its variance is that of the
+    mean of its good pixels.
+    """
+    img = np.asarray(img, dtype=float)
+    good, _ = _weights(img, mask, var)
+    ny, nx = img.shape[0]//factor*factor, img.shape[1]//factor*factor
+    shape = (ny//factor, factor, nx//factor, factor)
+    good = good[:ny, :nx]
+    count = good.reshape(shape).sum(axis=(1, 3))
+    total = np.where(good, img[:ny, :nx], 0).reshape(shape).sum(axis=(1, 3))
+    if var is None:
+        var_sum = count
+    else:
+        var = np.asarray(var, dtype=float)[:ny, :nx]
+        var_sum = np.where(good, var, 0).reshape(shape).sum(axis=(1, 3))
+    block_mask = (count < factor**2/2).astype(int)
+    count = np.maximum(count, 1)
+    return total/count, block_mask, var_sum/count**2
+
+
+def _block_psf(psf, factor):
+    """
+    Sum a PSF in factor x factor blocks, padding it so that its
+    center pixel falls in the central block.
+    """
+    pad = []
+    for n in psf.shape:
+        center = n//2
+        half = -(-(max(center, n - 1 - center) + factor)//factor)
+        left = factor*half + factor//2 - center
+        pad.append((left, factor*(2*half + 1) - n - left))
+    psf = np.pad(psf, pad, mode='constant')
+    shape = (psf.shape[0]//factor, factor, psf.shape[1]//factor, factor)
+    psf = psf.reshape(shape).sum(axis=(1, 3))
+    return psf/psf.sum()
+
+
+def _coarse_config(config, factor, inverse=False):
+    """
+    Map the positions and r_e of a config to (or, if inverse is
+    True, from) the pixels of a stamp reduced in factor x factor
+    blocks.
+    """
+    offset = (factor + 1)/2
+    if inverse:
+        scale = {'X0': lambda v: factor*(v - 1) + offset,
+                 'Y0': lambda v: factor*(v - 1) + offset,
+                 'r_e': lambda v: factor*v}
+    else:
+        scale = {'X0': lambda v: (v - offset)/factor + 1,
+                 'Y0': lambda v: (v - offset)/factor + 1,
+                 'r_e': lambda v: v/factor}
+    coarse = {}
+    for p, val in config.items():
+        if p not in scale:
+            coarse[p] = val
+        elif type(val) is list:
+            coarse[p] = [v if isinstance(v, str) else scale[p](v)
+                         for v in val]
+        else:
+            coarse[p] = scale[p](val)
+    return coarse
+
+
+def fit(img, config, mask=None, var=None, psf=None, convolver=None,
+        max_nfev=None, quiet=True, coarse=None, refine_nfev=3):
+    """
+    Fit a Sersic model to an image with scipy's bounded least squares
+    (trust region reflective) and the analytic Jacobian of the
+    profile. The model, limits, fixed parameters, and outputs are
+    the same as for imfit.run, but the fit runs on numpy arrays.
+
+    Parameters
+    ----------
+    img : 2D ndarray
+        The image.
+    config : dict
+        Initial parameters and limits in the format of write_config.
+        As in imfit, X0 and Y0 are 1-indexed pixel coordinates.
+    mask : 2D ndarray, optional
+        Mask with 0 for good pixels and >0 for bad pixels.
+    var : 2D ndarray, optional
+        Variance image. If None, all pixels have unit weight.
+    psf : 2D ndarray or string, optional
+        PSF image (or fits file name). As in imfit, the model is
+        computed on a grid padded by the PSF size, convolved, and
+        cropped to the image.
+    convolver : hugs.imfit.sersic.PSFConvolver, optional
+        Convolver with cached PSF transforms. If None, use
+        sersic.default_convolver.
+    max_nfev : int, optional
+        Maximum number of function evaluations.
+    quiet : bool, optional
+        If False, print the progress of the fit.
+    coarse : int, optional
+        If given, first fit the image, mask, variance, and PSF
+        reduced in coarse x coarse blocks (e.g., 2 or 4), and start
+        the full-resolution fit from that solution. Large, diffuse
+        objects are well described at the lower resolution, so the
+        full-resolution fit only needs a few steps.
+    refine_nfev : int, optional
+        Maximum number of function evaluations of the full-resolution
+        fit after a coarse fit. If None, the fit runs to convergence.
+
+    Returns
+    -------
+    results : dict
+        Best-fit parameters, their uncertainties (e.g., r_e_err,
+        which are zero for fixed parameters), and the reduced
+        chi-square value of the fit, as returned by imfit.run.
+    """
+    from scipy.optimize import least_squares
+
+    img = np.asarray(img, dtype=float)
+    if coarse is not None and coarse > 1:
+        block_psf = None
+        if psf is not None:
+            from .sersic import default_convolver
+            convolver = default_convolver if convolver is None else convolver
+            block_psf = _block_psf(convolver.load(psf), coarse)
+        block_img, block_mask, block_var = _block_stamp(img, mask, var, coarse)
+        results = fit(block_img, _coarse_config(config, coarse), block_mask,
+                      block_var, block_psf, convolver, quiet=quiet)
+        # start from the coarse solution, with the same limits
+        start = _coarse_config(results, coarse, inverse=True)
+        config = dict(config)
+        for p, val in list(config.items()):
+            if type(val) is not list:
+                config[p] = start[p]
+            elif len(val)!=2:
+                config[p] = [start[p]] + val[1:]
+        if refine_nfev is not None:
+            max_nfev = refine_nfev
+    values, lower, upper, free = parse_config(config)
+    values = np.clip(values, lower, upper)
+
+    good, weight = _weights(img, mask, var)
+    weight = weight[good]
+    data = img[good]
+    x, y, crop, psf, convolver = _grid(img.shape, psf, convolver)
+
+    def model_jac(p):
+        params = values.copy()
+        params[free] = p
+        model, jac = sersic_jacobian(x, y, *params)
+        jac = jac[..., free]
+        if psf is not None:
+            model = convolver(model, psf)
+            jac = np.moveaxis(convolver(np.moveaxis(jac, -1, 0), psf), 0, -1)
+        return model[crop][good], jac[crop][good]
+
+    cache = {}
+
+    def evaluate(p):
+        key = p.tobytes()
+        if key not in cache:
+            cache.clear()
+            cache[key] = model_jac(p)
+        return cache[key]
+
+    def residuals(p):
+        return (evaluate(p)[0] - data)*weight
+
+    def jacobian(p):
+        return evaluate(p)[1]*weight[:, None]
+
+    result = least_squares(residuals, values[free], jac=jacobian,
+                           bounds=(lower[free], upper[free]),
+                           x_scale='jac', method='trf', max_nfev=max_nfev,
+                           verbose=0 if quiet else 1)
+
+    jac = result.jac
+    cov = np.linalg.pinv(jac.T.dot(jac))
+    errors = np.zeros(len(SERSIC_PARAMS))
+    errors[free] = np.sqrt(np.clip(np.diag(cov), 0, None))
+    params = values.copy()
+    params[free] = result.x
+    return _results(params, errors, 2*result.cost, data.size - free.sum())
+
+
+def _results(params, errors, chisq, dof):
+    """
+    Fit results in the format of imfit.run.
+    """
+    results = {'reduced_chisq': float(chisq/max(dof, 1))}
+    for i, p in enumerate(SERSIC_PARAMS):
+        results.update({p: float(params[i])})
+        results.update({p+'_err': float(errors[i])})
+    return results
+
+
+def _pass_size(npix, max_bytes):
+    """
+    Number of fits per vectorized pass of fit_batch that keeps the 
+    pass within max_bytes, for a model grid of npix pixels.
+    """
+    return max(1, int(max_bytes//(8*_PASS_PLANES*npix)))
+
+
+def fit_batch(imgs, configs, masks=None, variances=None, psfs=None,
+              convolver=None, max_iter=100, ftol=1e-8, xtol=1e-8,
+              batch_size=None, max_bytes=2**28):
+    """
+    Fit Sersic models to a stack of equal-size stamps at once with
+    Levenberg-Marquardt. The residuals and Jacobians of all the
+    active fits are evaluated in one vectorized pass, and each fit
+    takes its own damped steps; fits that converge are frozen and
+    dropped from the following passes. Steps that cross a limit go
+    halfway to it, and PA wraps around if its limits span 180 deg.
+
+    Parameters
+    ----------
+    imgs : 3D ndarray
+        N x ny x nx stack of images.
+    configs : dict or list of dicts
+        Initial parameters and limits in the format of write_config,
+        one for all the stamps or one per stamp. As in imfit, X0 and
+        Y0 are 1-indexed pixel coordinates.
+    masks : 3D ndarray, optional
+        Masks with 0 for good pixels and >0 for bad pixels.
+    variances : 3D ndarray, optional
+        Variance images. If None, all pixels have unit weight.
+    psfs : 2D ndarray, string, or list, optional
+        PSF for all the stamps, or a list with a PSF (or None) per
+        stamp. Stamps that share a PSF are convolved together.
+    convolver : hugs.imfit.sersic.PSFConvolver, optional
+        Convolver with cached PSF transforms. If None, use
+        sersic.default_convolver.
+    max_iter : int, optional
+        Maximum number of steps per fit.
+    ftol : float, optional
+        A fit has converged when an accepted step changes the
+        chi-square by less than ftol times its value.
+    xtol : float, optional
+        A fit has converged when a step changes all the parameters
+        by less than xtol times their values.
+    batch_size : int, optional
+        Maximum number of fits evaluated per vectorized pass. If
+        None, passes are sized to fit in max_bytes.
+    max_bytes : int, optional
+        Memory budget of a pass, used if batch_size is None. A fit 
+        takes ~50 float64 planes of the (PSF-padded) stamp in a 
+        pass, e.g. ~60 MB for a 357 x 357 HSC stamp and a 43 x 43 
+        PSF, so the default of 256 MB evaluates 4 such stamps at 
+        once.
+
+    Returns
+    -------
+    results : list of dicts
+        The results of each fit, as returned by fit.
+    """
+    imgs = np.asarray(imgs, dtype=float)
+    assert imgs.ndim==3, 'imgs must be a stack of equal-size stamps'
+    num, ny, nx = imgs.shape
+    if isinstance(configs, dict):
+        configs = [configs]*num
+    assert len(configs)==num, 'need one config per stamp'
+    values, lower, upper, free = [np.array(a) for a in
+                                  zip(*[parse_config(c) for c in configs])]
+    values = np.clip(values, lower, upper)
+    # the profile repeats every 180 deg in PA, so limits that span
+    # a full period wrap the angle instead of bounding it
+    pa = SERSIC_PARAMS.index('PA')
+    wrap = np.zeros(values.shape, dtype=bool)
+    wrap[:, pa] = np.isfinite(upper[:, pa] - lower[:, pa]) & \
+        (upper[:, pa] - lower[:, pa] >= 180)
+
+    good, weight = _weights(imgs, masks, variances)
+    data = np.where(good, imgs, 0)
+    dof = good.reshape(num, -1).sum(axis=1) - free.sum(axis=1)
+
+    if psfs is None or not isinstance(psfs, list):
+        psfs = [psfs]*num
+    assert len(psfs)==num, 'need one psf per stamp'
+    if any(psf is not None for psf in psfs):
+        from .sersic import default_convolver
+        convolver = default_convolver if convolver is None else convolver
+        psfs = [None if psf is None else convolver.load(psf) 
+                for psf in psfs]
+    pad_y = max([psf.shape[0]//2 for psf in psfs if psf is not None] + [0])
+    pad_x = max([psf.shape[1]//2 for psf in psfs if psf is not None] + [0])
+    # 1-indexed pixel coordinates, as in imfit
+    y, x = np.mgrid[1 - pad_y:ny + pad_y + 1, 1 - pad_x:nx + pad_x + 1]
+    if batch_size is None:
+        batch_size = _pass_size(x.size, max_bytes)
+
+    def evaluate(params, idx):
+        """
+        Chi-square, J^T J, and J^T r of the fits idx at params.
+        """
+        chisq = np.empty(len(idx))
+        hess = np.empty((len(idx), 7, 7))
+        grad = np.empty((len(idx), 7))
+        for lo in range(0, len(idx), batch_size):
+            sl = slice(lo, lo + batch_size)
+            model, jac = sersic_jacobian(
+                x, y, *[p[:, None, None] for p in params[sl].T])
+            stack = np.concatenate(
+                [model[:, None], np.moveaxis(jac, -1, 1)], axis=1)
+            groups = {}
+            for i, k in enumerate(idx[sl]):
+                if psfs[k] is not None:
+                    groups.setdefault(id(psfs[k]), []).append(i)
+            for group in groups.values():
+                psf = psfs[idx[sl][group[0]]]
+                stack[group] = convolver(stack[group], psf)
+            stack = stack[..., pad_y:pad_y + ny, pad_x:pad_x + nx]
+            w = weight[idx[sl]]
+            res = (stack[:, 0] - data[idx[sl]])*w
+            jac = stack[:, 1:]*w[:, None]*free[idx[sl], :, None, None]
+            jac = jac.reshape(jac.shape[:2] + (-1,))
+            res = res.reshape(len(res), -1)
+            chisq[sl] = (res**2).sum(axis=1)
+            hess[sl] = np.matmul(jac, jac.transpose(0, 2, 1))
+            grad[sl] = np.matmul(jac, res[..., None])[..., 0]
+        return chisq, hess, grad
+
+    params = values.copy()
+    idx = np.arange(num)
+    chisq, hess, grad = evaluate(params, idx)
+    lam = np.full(num, 1e-3)
+    active = np.ones(num, dtype=bool)
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if len(idx)==0:
+            break
+        # parameters on a limit that the gradient pushes against are
+        # held for this step, like the fixed parameters (which have
+        # zero rows in J^T J and J^T r)
+        hold = ((params[idx] <= lower[idx]) & (grad[idx] > 0)) | \
+               ((params[idx] >= upper[idx]) & (grad[idx] < 0))
+        hold = (hold & ~wrap[idx]) | ~free[idx]
+        keep = ~hold[:, :, None] & ~hold[:, None, :]
+        diag = np.diagonal(hess[idx], axis1=1, axis2=2)
+        diag = np.where(diag > 0, diag, 1)
+        # Marquardt damping; held parameters get a zero step
+        damped = np.where(keep, hess[idx], 0) + \
+            (lam[idx, None]*diag + hold)[..., None]*np.eye(7)
+        rhs = np.where(hold, 0, grad[idx])
+        try:
+            step = -np.linalg.solve(damped, rhs[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            step = -np.einsum('nkl,nl->nk', np.linalg.pinv(damped), rhs)
+        # steps that cross a limit go halfway to it, so parameters
+        # are not trapped on a limit by one long step
+        trial = params[idx] + step
+        periodic = wrap[idx]
+        trial[periodic] = lower[idx][periodic] + \
+            np.mod(trial[periodic] - lower[idx][periodic], 180)
+        trial = np.where(trial < lower[idx], 
+                         (params[idx] + lower[idx])/2, trial)
+        trial = np.where(trial > upper[idx], 
+                         (params[idx] + upper[idx])/2, trial)
+        new_chisq, new_hess, new_grad = evaluate(trial, idx)
+
+        better = new_chisq < chisq[idx]
+        small_step = np.all(np.abs(trial - params[idx]) <= 
+                            xtol*(np.abs(params[idx]) + xtol), axis=1)
+        small_change = better & (chisq[idx] - new_chisq <= 
+                                 ftol*new_chisq)
+        accept = idx[better]
+        params[accept] = trial[better]
+        chisq[accept] = new_chisq[better]
+        hess[accept] = new_hess[better]
+        grad[accept] = new_grad[better]
+        lam[accept] = np.maximum(lam[accept]/10, 1e-7)
+        reject = idx[~better]
+        lam[reject] *= 10
+        active[idx[small_step | small_change]] = False
+        active[lam > 1e10] = False
+
+    results = []
+    for k in range(num):
+        errors = np.zeros(7)
+        sub = np.ix_(free[k], free[k])
+        cov = np.linalg.pinv(hess[k][sub])
+        errors[free[k]] = np.sqrt(np.clip(np.diag(cov), 0, None))
+        results.append(_results(params[k], errors, chisq[k], dof[k]))
+    return results
+
+
+def fit_linear(img, params, mask=None, var=None, psf=None, convolver=None,
+               fit_r_e=False, r_e_limits=None):
+    """
+    Forced photometry with a fixed Sersic shape. With X0, Y0, PA,
+    ell, n, and r_e fixed, the model is linear in I_e, so the
+    amplitude and its uncertainty are solved in closed form from
+    the variance-weighted, masked image. If fit_r_e is True, r_e is
+    also refined with a bounded one-dimensional search, solving for
+    I_e at each step.
+
+    Parameters
+    ----------
+    img : 2D ndarray
+        The image.
+    params : dict or Sersic
+        The shape parameters (I_e is ignored). X0 and Y0 are
+        1-indexed pixel coordinates, as in imfit.
+    mask : 2D ndarray, optional
+        Mask with 0 for good pixels and >0 for bad pixels.
+    var : 2D ndarray, optional
+        Variance image. If None, all pixels have unit weight.
+    psf : 2D ndarray or string, optional
+        PSF image (or fits file name), see fit.
+    convolver : hugs.imfit.sersic.PSFConvolver, optional
+        Convolver with cached PSF transforms.
+    fit_r_e : bool, optional
+        If True, refine r_e.
+    r_e_limits : tuple, optional
+        Search interval for r_e. If None, use (r_e/2, 2*r_e).
+
+    Returns
+    -------
+    results : dict
+        The results in the format of fit, with zero uncertainties
+        for the fixed parameters.
+    """
+    from .sersic import _profile
+
+    if not isinstance(params, dict):
+        params = params.params
+    values = np.array([params[p] for p in SERSIC_PARAMS], dtype=float)
+    X0, Y0, PA, ell, n, _, r_e = values
+    img = np.asarray(img, dtype=float)
+    good, weight = _weights(img, mask, var)
+    weight = weight[good]
+    data = img[good]*weight
+    x, y, crop, psf, convolver = _grid(img.shape, psf, convolver)
+    theta = np.deg2rad(PA + 90)
+    b_n = gammaincinv(2*n, 0.5)
+    dx, dy = x - X0, y - Y0
+
+    def solve(r_e):
+        model = _profile(dx, dy, 1.0, r_e, n, 1 - ell, np.cos(theta),
+                         np.sin(theta), b_n)
+        if psf is not None:
+            model = convolver(model, psf)
+        model = model[crop][good]*weight
+        norm = (model**2).sum()
+        I_e = (model*data).sum()/norm
+        return I_e, norm, ((data - I_e*model)**2).sum()
+
+    free = ['I_e']
+    if fit_r_e:
+        from scipy.optimize import minimize_scalar
+        free.append('r_e')
+        if r_e_limits is None:
+            r_e_limits = (r_e/2, 2*r_e)
+        r_e = minimize_scalar(lambda r: solve(r)[2], bounds=r_e_limits,
+                              method='bounded',
+                              options={'xatol': 1e-4*r_e}).x
+    I_e, norm, chisq = solve(r_e)
+    values[5:] = I_e, r_e
+
+    errors = np.zeros(len(SERSIC_PARAMS))
+    if fit_r_e:
+        # 2x2 Fisher matrix of (I_e, r_e)
+        model, jac = sersic_jacobian(x, y, *values)
+        jac = jac[..., 5:]
+        if psf is not None:
+            jac = np.moveaxis(convolver(np.moveaxis(jac, -1, 0), psf), 0, -1)
+        jac = jac[crop][good]*weight[:, None]
+        cov = np.linalg.pinv(jac.T.dot(jac))
+        errors[5:] = np.sqrt(np.clip(np.diag(cov), 0, None))
+    else:
+        errors[5] = 1/np.sqrt(norm)
+    return _results(values, errors, chisq, data.size - len(free))
+
+
+def fit_joint(imgs, configs, masks=None, variances=None, psfs=None,
+              convolver=None, band_r_e=False, max_nfev=None, quiet=True):
+    """
+    Fit Sersic models to the stamps of one object in several bands
+    at once. The position, PA, ellipticity, and Sersic index are
+    shared by all the bands, while each band has its own amplitude
+    and, if band_r_e is True, its own r_e. Each band is weighted by
+    its own variance and convolved with its own PSF, and the fit is
+    one bounded least-squares problem (see fit) over all the bands.
+
+    Parameters
+    ----------
+    imgs : list of 2D ndarrays
+        The image of each band (the sizes may differ).
+    configs : dict or list of dicts
+        Initial parameters and limits in the format of write_config,
+        for all the bands or for each band. The shared parameters
+        are taken from the first config.
+    masks : list of 2D ndarrays, optional
+        Mask of each band, with 0 for good pixels and >0 for bad.
+    variances : list of 2D ndarrays, optional
+        Variance image of each band.
+    psfs : list, optional
+        PSF image (or fits file name, or None) of each band.
+    convolver : hugs.imfit.sersic.PSFConvolver, optional
+        Convolver with cached PSF transforms.
+    band_r_e : bool, optional
+        If True, fit r_e separately in each band.
+    max_nfev : int, optional
+        Maximum number of function evaluations.
+    quiet : bool, optional
+        If False, print the progress of the fit.
+
+    Returns
+    -------
+    results : list of dicts
+        The results of each band in the format of fit. The shared
+        parameters (and their uncertainties) are the same in all the
+        bands, and reduced_chisq is that of the joint fit.
+    """
+    from scipy.optimize import least_squares
+
+    num = len(imgs)
+    if isinstance(configs, dict):
+        configs = [configs]*num
+    masks = [None]*num if masks is None else masks
+    variances = [None]*num if variances is None else variances
+    psfs = [None]*num if psfs is None else psfs
+    per_band = ['I_e', 'r_e'] if band_r_e else ['I_e']
+
+    # column of each band's parameters in the joint parameter vector
+    cols = np.zeros((num, len(SERSIC_PARAMS)), dtype=int)
+    values, lower, upper, free = [], [], [], []
+    for b, config in enumerate(configs):
+        parsed = parse_config(config)
+        for i, p in enumerate(SERSIC_PARAMS):
+            if b==0 or p in per_band:
+                cols[b, i] = len(values)
+                for lst, val in zip([values, lower, upper, free], parsed):
+                    lst.append(val[i])
+            else:
+                cols[b, i] = cols[0, i]
+    values, lower, upper, free = [np.array(a) for a in
+                                  [values, lower, upper, free]]
+    values = np.clip(values, lower, upper)
+
+    bands = []
+    for b in range(num):
+        img = np.asarray(imgs[b], dtype=float)
+        good, weight = _weights(img, masks[b], variances[b])
+        x, y, crop, psf, convolver = _grid(img.shape, psfs[b], convolver)
+        bands.append((img[good], weight[good], good, x, y, crop, psf))
+    data = np.concatenate([band[0]*band[1] for band in bands])
+    weight = np.concatenate([band[1] for band in bands])
+
+    def model_jac(p):
+        params = values.copy()
+        params[free] = p
+        models, jacs = [], []
+        for b, (_, _, good, x, y, crop, psf) in enumerate(bands):
+            model, jac = sersic_jacobian(x, y, *params[cols[b]])
+            if psf is not None:
+                model = convolver(model, psf)
+                jac = np.moveaxis(
+                    convolver(np.moveaxis(jac, -1, 0), psf), 0, -1)
+            full = np.zeros((good.sum(), len(values)))
+            full[:, cols[b]] = jac[crop][good]
+            models.append(model[crop][good])
+            jacs.append(full[:, free])
+        return np.concatenate(models), np.concatenate(jacs)
+
+    cache = {}
+
+    def evaluate(p):
+        key = p.tobytes()
+        if key not in cache:
+            cache.clear()
+            cache[key] = model_jac(p)
+        return cache[key]
+
+    def residuals(p):
+        return evaluate(p)[0]*weight - data
+
+    def jacobian(p):
+        return evaluate(p)[1]*weight[:, None]
+
+    result = least_squares(residuals, values[free], jac=jacobian,
+                           bounds=(lower[free], upper[free]),
+                           x_scale='jac', method='trf', max_nfev=max_nfev,
+                           verbose=0 if quiet else 1)
+
+    jac = result.jac
+    cov = np.linalg.pinv(jac.T.dot(jac))
+    errors = np.zeros(len(values))
+    errors[free] = np.sqrt(np.clip(np.diag(cov), 0, None))
+    params = values.copy()
+    params[free] = result.x
+    dof = data.size - free.sum()
+    return [_results(params[cols[b]], errors[cols[b]], 2*result.cost, dof)
+            for b in range(num)]
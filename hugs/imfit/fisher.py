@@ -0,0 +1,160 @@
+"""
+Fisher-matrix uncertainties of Sersic fits from the analytic
+Jacobian of the profile.
+"""
+from __future__ import division, print_function
+
+import numpy as np
+from scipy.special import gammaincinv
+
+from .core import SERSIC_PARAMS
+from .sersic import Sersic
+
+__all__ = ['sersic_jacobian', 'fisher_covariance']
+
+
+def _db_n(n, step=1e-5):
+    """
+    Derivative of b_n with respect to n (central difference).
+    """
+    return (gammaincinv(2*(n + step), 0.5) -
+            gammaincinv(2*(n - step), 0.5))/(2*step)
+
+
+def sersic_jacobian(x, y, X0, Y0, PA, ell, n, I_e, r_e):
+    """
+    Sersic profile and its analytic derivatives with respect to
+    the parameters, in imfit's convention (see Sersic). All the
+    inputs broadcast against each other, so a batch of fits can
+    be evaluated at once by giving the parameters trailing axes.
+
+    Returns
+    -------
+    model : ndarray
+        The profile.
+    jac : ndarray
+        The derivatives, with a last axis of length 7 in the
+        order of SERSIC_PARAMS (X0, Y0, PA, ell, n, I_e, r_e).
+        Derivatives with respect to PA are per degree.
+    """
+    q = 1 - ell
+    theta = np.deg2rad(PA + 90)
+    cos_theta, sin_theta = np.cos(theta), np.sin(theta)
+    b_n = gammaincinv(2*n, 0.5)
+    dx, dy = x - X0, y - Y0
+    x_maj = dx*cos_theta + dy*sin_theta
+    x_min = dy*cos_theta - dx*sin_theta
+    a2, b2 = r_e**2, (q*r_e)**2
+    z = np.sqrt(x_maj**2/a2 + x_min**2/b2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = z**(1/n)
+        model = I_e*np.exp(-b_n*(t - 1))
+        # dI/dz and z*dz/dp for each geometric parameter
+        dI_dz_over_z = -model*b_n*t/(n*z**2)
+        dI_dz_over_z[z==0] = 0
+        log_z = np.log(np.where(z > 0, z, 1))
+    z_dz = [-cos_theta*x_maj/a2 + sin_theta*x_min/b2,
+            -sin_theta*x_maj/a2 - cos_theta*x_min/b2,
+            np.pi/180*x_maj*x_min*(1/a2 - 1/b2),
+            x_min**2/(b2*q),
+            None,
+            None,
+            -z**2/r_e]
+    jac = [dI_dz_over_z*d if d is not None else None for d in z_dz]
+    jac[4] = -model*(_db_n(n)*(t - 1) - b_n*t*log_z/n**2)
+    jac[5] = model/I_e
+    jac = np.stack(np.broadcast_arrays(*jac), axis=-1)
+    return model, jac
+
+
+def _param_arrays(params):
+    """
+    Parameter arrays of one or many fits, and whether the input
+    is a single fit.
+    """
+    if isinstance(params, Sersic):
+        params = params.params
+    values = [np.asarray(params[p], dtype=float) for p in SERSIC_PARAMS]
+    single = all(v.ndim==0 for v in values)
+    return [np.atleast_1d(v) for v in values], single
+
+
+def fisher_covariance(params, var, mask=None, psf=None, fixed=[],
+                      batch_size=64):
+    """
+    Fisher-matrix covariance of Sersic fits, F = J^T W J, where J is
+    the analytic Jacobian of the model on the stamp pixels and W is
+    the inverse variance of the unmasked pixels. This is the
+    covariance of the best fit for Gaussian noise to first order,
+    at the cost of one model evaluation per fit.
+
+    Parameters
+    ----------
+    params : Sersic, SersicCatalog, or dict
+        Best-fit parameters of one or N fits (imfit's convention,
+        with 1-indexed X0 and Y0).
+    var : 2D or 3D ndarray
+        Variance stamp, or an N x ny x nx stack of variance stamps.
+    mask : 2D or 3D ndarray, optional
+        Pixels to exclude (nonzero values are masked).
+    psf : 2D ndarray or string, optional
+        PSF used in the fit, which the Jacobian is convolved with.
+    fixed : list, optional
+        Parameters that were held fixed, which are excluded from
+        the covariance.
+    batch_size : int, optional
+        Number of fits evaluated per vectorized pass.
+
+    Returns
+    -------
+    cov : ndarray
+        The covariance matrices (N x k x k, or k x k for a single
+        fit), where k is the number of free parameters in the order
+        of SERSIC_PARAMS.
+    errors : dict
+        The 1-sigma uncertainty of each free parameter (named as
+        the imfit errors, e.g. r_e_err).
+    """
+    values, single = _param_arrays(params)
+    num = len(values[0])
+    var = np.asarray(var, dtype=float)
+    var = np.broadcast_to(var, (num,) + var.shape[-2:])
+    if mask is not None:
+        mask = np.broadcast_to(mask, var.shape)
+    free = [i for i, p in enumerate(SERSIC_PARAMS) if p not in fixed]
+    ny, nx = var.shape[1:]
+    pad_y, pad_x = 0, 0
+    if psf is not None:
+        from .sersic import default_convolver
+        psf = default_convolver.load(psf)
+        pad_y, pad_x = psf.shape[0]//2, psf.shape[1]//2
+    # 1-indexed pixel coordinates, as in imfit (see engine._grid)
+    y, x = np.mgrid[1 - pad_y:ny + pad_y + 1, 1 - pad_x:nx + pad_x + 1]
+
+    fisher = np.empty((num, len(free), len(free)))
+    for lo in range(0, num, batch_size):
+        hi = min(lo + batch_size, num)
+        batch = [v[lo:hi, None, None] for v in values]
+        _, jac = sersic_jacobian(x, y, *batch)
+        jac = jac[..., free]
+        if psf is not None:
+            # all the planes of the batch are convolved in one call
+            jac = default_convolver(np.moveaxis(jac, -1, 1), psf)
+            jac = np.moveaxis(jac[..., pad_y:pad_y + ny, pad_x:pad_x + nx],
+                              1, -1)
+        with np.errstate(divide='ignore'):
+            weight = np.where(var[lo:hi] > 0, 1/var[lo:hi], 0)
+        if mask is not None:
+            weight = np.where(mask[lo:hi], 0, weight)
+        weighted = jac*weight[..., None]
+        fisher[lo:hi] = np.einsum('nyxi,nyxj->nij', weighted, jac,
+                                  optimize=True)
+
+    cov = np.linalg.pinv(fisher)
+    errs = np.sqrt(np.clip(np.diagonal(cov, axis1=1, axis2=2), 0, None))
+    errors = dict((SERSIC_PARAMS[k]+'_err', errs[:, i])
+                  for i, k in enumerate(free))
+    if single:
+        cov = cov[0]
+        errors = dict((k, float(v[0])) for k, v in errors.items())
+    return cov, errors
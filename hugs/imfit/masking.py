@@ -6,13 +6,14 @@ from __future__ import division, print_function
 
 import numpy as np
 import scipy.ndimage as ndimage
-from astropy.io import fits
 from astropy.convolution import Gaussian2DKernel
 
 import lsst.afw.image as afwImage
 import lsst.afw.detection as afwDetect
 import sep
 
+from ..imtools import native_byteorder, write_fits
+
 
 __all__ = ['get_hsc_pipe_mask', 'meas_back', 
            'detect_sources', 'make_seg_mask', 
@@ -22,11 +23,11 @@ __all__ = ['get_hsc_pipe_mask', 'meas_back',
 def _byteswap(arr):
     """
     If array is in big-endian byte order (as astropy.io.fits
-    always returns), swap to little-endian for SEP.
+    always returns), swap to little-endian for SEP. Arrays
+    already in native order (e.g., from imtools.LazyFits)
+    are used without a copy.
     """
-    if arr.dtype.byteorder=='>':
-        arr = arr.byteswap().newbyteorder()
-    return arr
+    return native_byteorder(arr)
 
 
 def _outside_circle(cat, xc, yc, r):
@@ -37,17 +38,43 @@ def _outside_circle(cat, xc, yc, r):
     return np.sqrt((cat['x']-xc)**2 + (cat['y']-yc)**2) > r
 
 
-def get_hsc_pipe_mask(mask, gal_pos):
+def _mask_planes(header):
+    """
+    Bit of each mask plane, from the MP_ keys of an hscPipe
+    mask header.
+    """
+    return dict((key[3:], header[key]) for key in header 
+                if key.startswith('MP_'))
+
+
+def _pipe_mask_array(mask, gal_pos, planes):
+    """
+    Photo mask from an hscPipe mask array (see get_hsc_pipe_mask),
+    where the detection footprints are the 8-connected regions 
+    of the DETECTED plane.
+    """
+    mask = np.asarray(mask)
+    det, _ = ndimage.label(mask & (1 << planes['DETECTED']), np.ones((3, 3)))
+    i, j = int(gal_pos[1]), int(gal_pos[0])
+    det[det==det[i, j]] = 0
+    bright = mask & (1 << planes['BRIGHT_OBJECT'])
+    return ((det>0) | (bright>0)).astype(int)
+
+
+def get_hsc_pipe_mask(mask, gal_pos, planes=None):
     """
     Generate photo mask from hsc pipeline mask, where the
     source is in the center of the image.
 
     Parameters
     ----------
-    mask : lsst.afw.image.MaskU
-        Mask object generated from hscPipe.
+    mask : lsst.afw.image.MaskU or 2D ndarray
+        Mask object generated from hscPipe, or its array.
     gal_pos : tuple
         The (x, y) position of the galaxy.
+    planes : dict, optional
+        Bit of each mask plane, which is needed if mask is an 
+        array (e.g., from the MP_ keys of the mask header).
 
     Returns
     -------
@@ -55,6 +82,8 @@ def get_hsc_pipe_mask(mask, gal_pos):
         Photometry mask, where masked pixels = 1 and
         all other pixels = 0. 
     """
+    if planes is not None:
+        return _pipe_mask_array(mask, gal_pos, planes)
 
     bitmask_thresh = afwDetect.Threshold(
         mask.getPlaneBitMask(['DETECTED']), afwDetect.Threshold.BITMASK)
@@ -225,7 +254,7 @@ def detect_sources(img, thresh, backsize, backffrac=0.5,
 def make_mask(masked_image, thresh=1.5, backsize=50, backffrac=0.5,
               out_fn=None, gal_pos='center', seg_rmin=100.0, obj_rmin=20.0, 
               grow_sig=6.0, mask_thresh=0.02, grow_obj=4.5, kern_sig=5.0, 
-              sep_extract_kws={}):
+              sep_extract_kws={}, compress=None):
     """
     Generate a mask for galaxy photometry using SEP. Many of these
     parameters are those of SEP, so see its documentation for 
@@ -233,8 +262,10 @@ def make_mask(masked_image, thresh=1.5, backsize=50, backffrac=0.5,
 
     Parameters
     ----------
-    masked_image : lsst.afw.image.MaskedImageF
-        Masked image object from hscPipe.
+    masked_image : lsst.afw.image.MaskedImageF or tuple
+        Masked image object from hscPipe, or an in-memory stamp
+        (img, mask, var, headers), e.g. from a StampArchive, 
+        whose mask header gives the mask planes.
     thresh : float, optional
         Detection threshold for source extraction.  
     backsize : int
@@ -261,7 +292,14 @@ def make_mask(masked_image, thresh=1.5, backsize=50, backffrac=0.5,
     sep_extract_kws: dict, optional
         Keywords from sep.extract.
     out_fn : string, optional
-        If not None, save the mask with this file name. 
+        If not None, save the mask with this file name. The mask
+        is saved as uint8.
+    compress : string, optional
+        Tile-compression algorithm for the saved mask (e.g., 
+        'PLIO_1' or 'RICE_1'). See hugs.imtools.write_fits. Note
+        that compressed masks are stored in extension 1, which 
+        imfit does not read, so they are only for the scipy engine 
+        and other astropy readers (imfit.run refuses them).
         
     Returns
     -------
@@ -271,8 +309,13 @@ def make_mask(masked_image, thresh=1.5, backsize=50, backffrac=0.5,
         a segmentation, object, and  HSC's detection footprints.
     """
 
-    img = masked_image.getImage().getArray().copy()
-    mask = masked_image.getMask().getArray().copy()
+    if isinstance(masked_image, tuple):
+        img, mask = masked_image[0].copy(), masked_image[1].copy()
+        pipe_mask, planes = mask, _mask_planes(masked_image[3][1])
+    else:
+        img = masked_image.getImage().getArray().copy()
+        mask = masked_image.getMask().getArray().copy()
+        pipe_mask, planes = masked_image.getMask(), None
 
     if gal_pos=='center':
         gal_x, gal_y = (img.shape[1]/2, img.shape[0]/2)
@@ -284,7 +327,7 @@ def make_mask(masked_image, thresh=1.5, backsize=50, backffrac=0.5,
     # Generate mask from hscPipe footprints.
     #################################################################
 
-    hsc_bad_mask = get_hsc_pipe_mask(masked_image.getMask(), gal_pos)
+    hsc_bad_mask = get_hsc_pipe_mask(pipe_mask, gal_pos, planes)
     
     #################################################################
     # Detect sources in image to mask before we do photometry.
@@ -317,6 +360,6 @@ def make_mask(masked_image, thresh=1.5, backsize=50, backffrac=0.5,
     final_mask = (seg_mask | obj_mask | hsc_bad_mask).astype(int)
 
     if out_fn is not None:
-        fits.writeto(out_fn, final_mask, clobber=True)
+        write_fits(out_fn, final_mask.astype(np.uint8), compress=compress)
 
     return final_mask
@@ -1,13 +1,23 @@
 from __future__ import division, print_function
                       
 
+from collections import OrderedDict
 import numpy as np
-from scipy.special import gammaincinv, gamma
+from scipy.special import gammaincinv, gamma, gammaln
+try:
+    from scipy import fft as _fft
+except ImportError:
+    _fft = np.fft
 
 from .core import SERSIC_PARAMS
 from ..utils import pixscale
 
-__all__ = ['Sersic']
+__all__ = ['Sersic', 'SersicCatalog', 'sersic_b_n_f_n', 'PSFConvolver']
+
+DERIVED = ['q', 'theta', 'r_circ', 'b_n', 'mu_e', 'mu_0', 'mu_e_ave', 'm_tot']
+
+# b_n and f_n interpolation tables, keyed by (n_min, n_max, size)
+_tables = {}
 
 
 class Sersic(object):
@@ -72,9 +82,12 @@ class Sersic(object):
         img = self.I_e* np.exp(-self.b_n * (z ** (1/self.n) - 1))
         return img
 
-    def array(self, shape, logscale=False):
+    def array(self, shape, logscale=False, accuracy=None, max_factor=51,
+              psf=None, convolver=None):
         """
-        Get 2D array of Sersic model.
+        Get 2D array of Sersic model, where X0 and Y0 are in the 
+        0-indexed pixels of the array (subtract 1 from the 1-indexed
+        positions of imfit and imfit.engine).
 
         Parameters
         ----------
@@ -82,12 +95,461 @@ class Sersic(object):
             Shape of output image.
         logscale : bool, optional
             If True, convert image to log scale.
+        accuracy : float, optional
+            If not None, the pixels near the center, where sampling
+            the profile at the pixel center is biased by more than
+            accuracy*I_e, are averaged over subpixels. The rest of 
+            the pixels are sampled at their centers. 
+        max_factor : int, optional
+            Maximum oversampling factor along each axis.
+        psf : 2D ndarray or string, optional
+            PSF image (or fits file name) to convolve the model 
+            with. As in imfit, the model is rendered on a grid that 
+            is padded by the PSF size before the convolution. 
+        convolver : PSFConvolver, optional
+            Convolver with the cached PSF transforms. If None, 
+            use default_convolver.
 
         Returns
         -------
         img : 2D ndarray
             Model array with input shape.
         """
-        y, x = np.indices(shape)
-        img = self.__call__(x, y)
+        if psf is not None:
+            convolver = default_convolver if convolver is None else convolver
+            psf = convolver.load(psf)
+            ny, nx = shape
+            pad_y, pad_x = psf.shape[0]//2, psf.shape[1]//2
+            img = np.zeros((ny + 2*pad_y, nx + 2*pad_x))
+            self.render(img, tol=0, origin=(-pad_x, -pad_y), 
+                        accuracy=accuracy, max_factor=max_factor)
+            img = convolver(img, psf)[pad_y:pad_y + ny, pad_x:pad_x + nx]
+        elif accuracy is None:
+            y, x = np.indices(shape)
+            img = self.__call__(x, y)
+        else:
+            img = self.render(np.zeros(shape), tol=0, accuracy=accuracy,
+                              max_factor=max_factor)
         return np.log10(img) if logscale else img
+
+    def radius(self, tol):
+        """
+        Semi-major axis beyond which the profile is below tol.
+        """
+        return _tol_radius(self.I_e, self.r_e, self.n, self.b_n, tol)
+
+    def render(self, canvas, tol=1e-4, origin=(0, 0), max_radius=None,
+               accuracy=None, max_factor=51):
+        """
+        Add the model to an image in place, evaluating it only
+        within the bounding box of the ellipse where the profile 
+        is above tol.
+
+        Parameters
+        ----------
+        canvas : 2D ndarray
+            Image (e.g., float32 or float64) to add the model to.
+        tol : float, optional
+            Surface brightness (in image units) at which the 
+            profile is truncated.
+        origin : tuple, optional
+            Pixel (x, y) of the canvas's lower-left pixel in 
+            the frame of X0 and Y0.
+        max_radius : float, optional
+            Maximum truncation radius in pixels.
+        accuracy : float, optional
+            Accuracy (in units of I_e) of the adaptive oversampling 
+            of the center (see array). If None, sample pixel centers.
+        max_factor : int, optional
+            Maximum oversampling factor along each axis.
+
+        Returns
+        -------
+        canvas : 2D ndarray
+            The input canvas.
+        """
+        radius = self.radius(tol)
+        if max_radius is not None:
+            radius = min(radius, max_radius)
+        _render(canvas, self.X0 - origin[0], self.Y0 - origin[1], self.I_e,
+                self.r_e, self.n, self.q, np.deg2rad(self.theta), self.b_n,
+                radius, accuracy, max_factor)
+        return canvas
+
+
+class PSFConvolver(object):
+    """
+    FFT convolution of model images with a PSF. The padded FFT 
+    shape (a fast length for each axis) and the transform of the 
+    PSF are cached for each (image shape, PSF), so repeated renders
+    on the same grid only transform the model. PSFs given as fits 
+    file names are read and normalized once.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of PSF transforms to keep in memory.
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._psfs = {}
+        self._ffts = OrderedDict()
+
+    def load(self, psf):
+        """
+        Read (if psf is a file name) and normalize a PSF.
+        """
+        if isinstance(psf, np.ndarray):
+            return psf
+        if psf not in self._psfs:
+            from astropy.io import fits
+            data = fits.getdata(psf).astype(float)
+            data /= data.sum()
+            data.setflags(write=False)
+            self._psfs[psf] = data
+        return self._psfs[psf]
+
+    def _psf_fft(self, psf, shape):
+        from scipy.fftpack import next_fast_len
+        key = (shape, psf.shape, hash(psf.tobytes()))
+        if key in self._ffts:
+            self._ffts[key] = fft = self._ffts.pop(key)
+        else:
+            fft_shape = tuple(next_fast_len(n + k - 1) 
+                              for n, k in zip(shape, psf.shape))
+            fft = fft_shape, _fft.rfft2(psf/psf.sum(), fft_shape)
+            self._ffts[key] = fft
+            while len(self._ffts) > self.maxsize:
+                self._ffts.popitem(last=False)
+        return fft
+
+    def clear(self):
+        """
+        Empty the caches.
+        """
+        self._psfs.clear()
+        self._ffts.clear()
+
+    def __call__(self, img, psf):
+        """
+        Convolve an image with a PSF (array or fits file name).
+        If img has more than two dimensions, each image in the 
+        stack (the last two axes) is convolved.
+
+        Returns
+        -------
+        conv : ndarray
+            Convolved image with the same shape as img, where the
+            PSF center is at pixel (ny//2, nx//2) of the PSF and 
+            pixels outside the image are taken to be zero.
+        """
+        psf = self.load(psf)
+        ny, nx = img.shape[-2:]
+        fft_shape, psf_fft = self._psf_fft(psf, (ny, nx))
+        conv = _fft.irfft2(_fft.rfft2(img, fft_shape)*psf_fft, fft_shape)
+        pad_y, pad_x = psf.shape[0]//2, psf.shape[1]//2
+        return conv[..., pad_y:pad_y + ny, pad_x:pad_x + nx]
+
+
+default_convolver = PSFConvolver()
+
+
+def _tol_radius(I_e, r_e, n, b_n, tol):
+    """
+    Radius where I_e*exp(-b_n*((r/r_e)^(1/n) - 1)) = tol.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        arg = 1 + np.log(np.divide(I_e, tol))/b_n
+    return np.where(arg > 0, r_e*np.clip(arg, 0, None)**n, 0.0)
+
+
+def _profile(dx, dy, I_e, r_e, n, q, cos_theta, sin_theta, b_n):
+    x_maj = dx*cos_theta + dy*sin_theta
+    x_min = dy*cos_theta - dx*sin_theta
+    z = np.sqrt((x_maj/r_e)**2 + (x_min/(q*r_e))**2)
+    return I_e*np.exp(-b_n*(z**(1/n) - 1))
+
+
+def _oversample_radius(r_e, n, q, b_n, accuracy):
+    """
+    Semi-major axis beyond which sampling the profile at pixel 
+    centers has an error below accuracy (in units of I_e). The error
+    is estimated from the Laplacian of the profile, which for a 
+    pixel is ~ |del^2 I|/24 = I u|u - 1|/(24 n^2 r^2), where 
+    u = b_n (r/r_e)^(1/n) and r is reduced by q along the minor axis.
+    """
+    r = r_e*np.geomspace(1e-4, 1e3, 1024)
+    u = b_n*(r/r_e)**(1/n)
+    error = np.exp(b_n - u)*u*np.abs(u - 1)/(24*(n*q*r)**2)
+    above = np.nonzero(error > accuracy)[0]
+    return r[min(above[-1] + 1, r.size - 1)] if above.size else 0.0
+
+
+def _oversample(img, x_lo, y_lo, X0, Y0, I_e, r_e, n, q, theta, b_n, 
+                accuracy, max_factor):
+    """
+    Replace the pixel-center values of img near the center of the 
+    profile with sub-pixel averages. Each pixel within the 
+    oversampling radius is split into factor x factor subpixels, 
+    where factor ~ sqrt(estimated error/accuracy).
+    """
+    radius = _oversample_radius(r_e, n, q, b_n, accuracy)
+    if radius==0:
+        return
+    cos_theta, sin_theta = np.cos(theta), np.sin(theta)
+    half_x = radius*np.hypot(cos_theta, q*sin_theta) + 1
+    half_y = radius*np.hypot(sin_theta, q*cos_theta) + 1
+    ny, nx = img.shape
+    i_lo = max(int(np.floor(Y0 - half_y)) - y_lo, 0)
+    i_hi = min(int(np.ceil(Y0 + half_y)) + 1 - y_lo, ny)
+    j_lo = max(int(np.floor(X0 - half_x)) - x_lo, 0)
+    j_hi = min(int(np.ceil(X0 + half_x)) + 1 - x_lo, nx)
+    if i_lo >= i_hi or j_lo >= j_hi:
+        return
+    i, j = np.mgrid[i_lo:i_hi, j_lo:j_hi]
+    dx, dy = (j + x_lo - X0).ravel(), (i + y_lo - Y0).ravel()
+    x_maj = dx*cos_theta + dy*sin_theta
+    x_min = dy*cos_theta - dx*sin_theta
+    r = np.hypot(x_maj, x_min/q)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = b_n*(r/r_e)**(1/n)
+        error = np.exp(b_n - u)*u*np.abs(u - 1)/(24*(n*q*r)**2)
+    # the pixel that contains the center (where r ~ 0) gets max_factor
+    error[~np.isfinite(error) | (np.abs(dx) < 1) & (np.abs(dy) < 1)] = np.inf
+    factor = np.ceil(np.sqrt(error/accuracy))
+    factor = np.clip(np.nan_to_num(factor), 1, max_factor).astype(int)
+    i, j = i.ravel(), j.ravel()
+    for f in np.unique(factor[factor > 1]):
+        sel = factor==f
+        sub = (np.arange(f) + 0.5)/f - 0.5
+        sub_dx = (dx[sel, None] + sub[None, :])[:, None, :]
+        sub_dy = (dy[sel, None] + sub[None, :])[:, :, None]
+        values = _profile(sub_dx, sub_dy, I_e, r_e, n, q, 
+                          cos_theta, sin_theta, b_n)
+        img[i[sel], j[sel]] = values.mean(axis=(1, 2))
+
+
+def _render(canvas, X0, Y0, I_e, r_e, n, q, theta, b_n, radius, 
+            accuracy=None, max_factor=51):
+    """
+    Add one Sersic to canvas within the bounding box of the ellipse
+    with semi-major axis radius, oversampling the center if an 
+    accuracy is given.
+    """
+    if radius <= 0:
+        return
+    ny, nx = canvas.shape
+    radius = min(radius, np.hypot(abs(X0) + nx, abs(Y0) + ny)/q)
+    cos_theta, sin_theta = np.cos(theta), np.sin(theta)
+    half_x = radius*np.hypot(cos_theta, q*sin_theta)
+    half_y = radius*np.hypot(sin_theta, q*cos_theta)
+    x_lo, x_hi = max(int(np.floor(X0 - half_x)), 0), \
+                 min(int(np.ceil(X0 + half_x)) + 1, nx)
+    y_lo, y_hi = max(int(np.floor(Y0 - half_y)), 0), \
+                 min(int(np.ceil(Y0 + half_y)) + 1, ny)
+    if x_lo >= x_hi or y_lo >= y_hi:
+        return
+    dx = np.arange(x_lo, x_hi) - X0
+    dy = (np.arange(y_lo, y_hi) - Y0)[:, None]
+    x_maj = dx*cos_theta + dy*sin_theta
+    x_min = dy*cos_theta - dx*sin_theta
+    z = x_maj/r_e
+    np.square(z, out=z)
+    x_min /= q*r_e
+    np.square(x_min, out=x_min)
+    z += x_min
+    # (z^2)^(1/2n) = z^(1/n)
+    np.power(z, 0.5/n, out=z)
+    z -= 1
+    z *= -b_n
+    np.exp(z, out=z)
+    z *= I_e
+    if accuracy is not None:
+        _oversample(z, x_lo, y_lo, X0, Y0, I_e, r_e, n, q, theta, b_n,
+                    accuracy, max_factor)
+    canvas[y_lo:y_hi, x_lo:x_hi] += z
+
+
+def _b_n_f_n_table(n_range, size):
+    key = float(n_range[0]), float(n_range[1]), int(size)
+    if key not in _tables:
+        log_n = np.linspace(np.log(key[0]), np.log(key[1]), key[2])
+        b_n, f_n = sersic_b_n_f_n(np.exp(log_n))
+        _tables[key] = log_n, np.log(b_n), np.log(f_n)
+    return _tables[key]
+
+
+def sersic_b_n_f_n(n, interp=False, n_range=(0.01, 10.0), size=4096):
+    """
+    The Sersic b_n and f_n = gamma(2n) n exp(b_n)/b_n^2n 
+    (Graham & Driver 2005) for an array of indices.
+
+    Parameters
+    ----------
+    n : array-like
+        Sersic indices.
+    interp : bool, optional
+        If True, interpolate (in log space) precomputed tables
+        over n_range, which is ~15 times faster than 
+        gammaincinv and accurate to ~1e-5 in b_n and ~1e-7 in f_n. 
+        Indices outside n_range are computed exactly.
+    n_range : tuple, optional
+        Range of the interpolation tables.
+    size : int, optional
+        Number of points of the interpolation tables.
+
+    Returns
+    -------
+    b_n, f_n : ndarrays
+    """
+    n = np.asarray(n, dtype=float)
+    if not interp:
+        b_n = gammaincinv(2*n, 0.5)
+        log_f_n = gammaln(2*n) + np.log(n) + b_n - 2*n*np.log(b_n)
+        return b_n, np.exp(log_f_n)
+    scalar = n.ndim==0
+    n = np.atleast_1d(n)
+    log_n, log_b_n, log_f_n = _b_n_f_n_table(n_range, size)
+    # the table is uniform in log(n), so no search is needed
+    x = (np.log(n) - log_n[0])/(log_n[1] - log_n[0])
+    idx = np.clip(x.astype(int), 0, size - 2)
+    w = x - idx
+    b_n = np.exp(log_b_n[idx] + w*(log_b_n[idx + 1] - log_b_n[idx]))
+    f_n = np.exp(log_f_n[idx] + w*(log_f_n[idx + 1] - log_f_n[idx]))
+    outside = (n < n_range[0]) | (n > n_range[1])
+    if outside.any():
+        b_n[outside], f_n[outside] = sersic_b_n_f_n(n[outside])
+    if scalar:
+        return b_n[0], f_n[0]
+    return b_n, f_n
+
+
+class SersicCatalog(object):
+    """
+    Columnar catalog of Sersic fits backed by a structured array, 
+    where the derived quantities of Sersic (b_n, mu_0, m_tot, etc.)
+    are computed for all the fits with single numpy calls.
+
+    Parameters
+    ----------
+    params : structured ndarray, astropy Table, dict, or list of dicts
+        Sersic parameters in imfit's convention (see Sersic), 
+        with any errors (e.g., r_e_err) and reduced_chisq. A list 
+        of dicts is the output of imfit.read_results for each fit. 
+    zpt : float, optional
+        Magnitude zero point.
+    interp : bool, optional
+        If True, use interpolation tables for b_n and f_n 
+        (see sersic_b_n_f_n).
+
+    Notes
+    -----
+    Columns are accessed as attributes or items (e.g., cat.m_tot or
+    cat['m_tot']); an integer item returns a Sersic object for that
+    fit, and a slice or boolean mask returns a new SersicCatalog.
+    """
+
+    def __init__(self, params, zpt=27.0, interp=False):
+        self.zpt = zpt
+        self.interp = interp
+        if isinstance(params, list):
+            names = [k for k in params[0].keys()]
+            params = dict((k, [p[k] for p in params]) for k in names)
+        if isinstance(params, dict):
+            names = list(params.keys())
+        else:
+            names = list(params.dtype.names if hasattr(params, 'dtype')
+                         else params.colnames)
+        names = [k for k in names if k not in DERIVED]
+        missing = [k for k in SERSIC_PARAMS if k not in names]
+        assert not missing, 'missing parameters: '+str(missing)
+        size = len(params[names[0]])
+        dtype = [(str(k), 'f8') for k in names + DERIVED]
+        self.data = np.zeros(size, dtype=dtype)
+        for k in names:
+            self.data[k] = params[k]
+        self.compute()
+
+    @classmethod
+    def from_imfit(cls, fns, **kwargs):
+        """
+        Build a catalog from imfit results files.
+        """
+        from .core import read_results
+        return cls([read_results(fn) for fn in fns], **kwargs)
+
+    def compute(self):
+        """
+        Calculate the derived quantities of all the fits.
+        """
+        d = self.data
+        d['q'] = 1 - d['ell']
+        d['theta'] = d['PA'] + 90
+        d['r_circ'] = d['r_e']*np.sqrt(d['q'])
+        d['b_n'], f_n = sersic_b_n_f_n(d['n'], self.interp)
+        d['mu_e'] = self.zpt - 2.5*np.log10(d['I_e']/pixscale**2)
+        d['mu_0'] = d['mu_e'] - 2.5*d['b_n']/np.log(10)
+        d['mu_e_ave'] = d['mu_e'] - 2.5*np.log10(f_n)
+        A_eff = np.pi*(d['r_circ']*pixscale)**2
+        d['m_tot'] = d['mu_e_ave'] - 2.5*np.log10(2*A_eff)
+
+    @property
+    def colnames(self):
+        return list(self.data.dtype.names)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getattr__(self, name):
+        data = self.__dict__.get('data')
+        if data is not None and name in data.dtype.names:
+            return data[name]
+        raise AttributeError(name)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.data[key]
+        if np.isscalar(key):
+            row = self.data[key]
+            params = dict((k, float(row[k])) for k in self.colnames 
+                          if k not in DERIVED)
+            return Sersic(params, self.zpt)
+        new = SersicCatalog.__new__(SersicCatalog)
+        new.zpt, new.interp = self.zpt, self.interp
+        new.data = self.data[key]
+        return new
+
+    def radius(self, tol):
+        """
+        Semi-major axes beyond which the profiles are below tol.
+        """
+        return _tol_radius(self.I_e, self.r_e, self.n, self.b_n, tol)
+
+    def render(self, canvas, tol=1e-4, origin=(0, 0), max_radius=None,
+               accuracy=None, max_factor=51):
+        """
+        Add all the models to an image in place. Each model is 
+        evaluated only within the bounding box of the ellipse where
+        it is above tol, so painting many small models into a 
+        patch-sized image costs in proportion to their footprints.
+        See Sersic.render for the parameters.
+        """
+        radius = self.radius(tol)
+        if max_radius is not None:
+            radius = np.minimum(radius, max_radius)
+        theta = np.deg2rad(self.theta)
+        X0 = self.X0 - origin[0]
+        Y0 = self.Y0 - origin[1]
+        columns = [X0, Y0, self.I_e, self.r_e, self.n, self.q, theta, 
+                   self.b_n, radius]
+        for row in zip(*[c.tolist() for c in columns]):
+            _render(canvas, *row, accuracy=accuracy, max_factor=max_factor)
+        return canvas
+
+    def to_table(self):
+        """
+        Return the catalog as an astropy Table.
+        """
+        from astropy.table import Table
+        return Table(self.data)
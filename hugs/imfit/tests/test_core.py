@@ -0,0 +1,13 @@
+from __future__ import division, print_function
+
+import numpy as np
+import pytest
+from ...imtools import write_fits
+from ..core import run
+
+
+def test_run_compressed_mask(tmpdir):
+    mask_fn = str(tmpdir.join('mask.fits'))
+    write_fits(mask_fn, np.zeros((20, 20), dtype=np.uint8), compress='PLIO_1')
+    with pytest.raises(AssertionError):
+        run('img.fits', str(tmpdir.join('config.txt')), mask_fn)
@@ -0,0 +1,158 @@
+from __future__ import division, print_function
+
+import numpy as np
+from ..core import SERSIC_PARAMS
+from ..fisher import sersic_jacobian
+from ..sersic import PSFConvolver
+from .. import engine
+
+TRUTH = {'X0': 31.2, 'Y0': 29.7, 'PA': 35.0, 'ell': 0.3, 'n': 0.9,
+         'I_e': 0.8, 'r_e': 7.0}
+
+
+def _mock(shape=(60, 60), psf=None, sigma=0.02, seed=5):
+    y, x = np.mgrid[1:shape[0] + 1, 1:shape[1] + 1]
+    model = sersic_jacobian(x, y, *[TRUTH[p] for p in SERSIC_PARAMS])[0]
+    if psf is not None:
+        model = PSFConvolver()(model, psf)
+    rng = np.random.RandomState(seed)
+    img = model + rng.normal(0, sigma, shape)
+    return img, np.full(shape, sigma**2)
+
+
+def test_parse_config():
+    config = {'X0': [30, 25, 35], 'Y0': [30, 25, 35], 'PA': 10.0,
+              'ell': [0.2, 0, 0.99], 'n': [1.0, 'fixed'], 'I_e': 1.0,
+              'r_e': 5.0}
+    values, lower, upper, free = engine.parse_config(config)
+    assert list(free)==[True, True, True, True, False, True, True]
+    assert lower[0]==25 and upper[3]==0.99
+    assert lower[-1] > 0
+
+
+def test_fit():
+    y, x = np.mgrid[-6:7, -6:7]
+    psf = np.exp(-(x**2 + y**2)/(2*1.5**2))
+    img, var = _mock(psf=psf)
+    mask = np.zeros(img.shape, dtype=int)
+    mask[:5] = 1
+    img[:5] = 1e3
+    config = {'X0': [30, 25, 35], 'Y0': [30, 25, 35], 'PA': [20.0, 0, 180],
+              'ell': [0.2, 0, 0.99], 'n': [1.0, 0.1, 5], 'I_e': 0.5,
+              'r_e': 5.0}
+    results = engine.fit(img, config, mask, var, psf)
+    for p in SERSIC_PARAMS:
+        assert abs(results[p] - TRUTH[p]) < 5*results[p+'_err']
+    assert abs(results['reduced_chisq'] - 1) < 0.1
+
+    config['n'] = [0.9, 'fixed']
+    results = engine.fit(img, config, mask, var, psf)
+    assert results['n']==0.9 and results['n_err']==0
+
+
+def test_fit_batch():
+    y, x = np.mgrid[-6:7, -6:7]
+    psf = np.exp(-(x**2 + y**2)/(2*1.5**2))
+    stamps = [_mock(psf=psf, seed=seed) for seed in range(4)]
+    imgs, variances = [np.array(a) for a in zip(*stamps)]
+    config = {'X0': [30, 25, 35], 'Y0': [30, 25, 35], 'PA': [20.0, 0, 180],
+              'ell': [0.2, 0, 0.99], 'n': [1.0, 0.1, 5], 'I_e': 0.5,
+              'r_e': 5.0}
+    configs = [config]*3 + [dict(config, n=[0.9, 'fixed'])]
+    results = engine.fit_batch(imgs, configs, variances=variances,
+                               psfs=psf)
+    for i, res in enumerate(results):
+        single = engine.fit(imgs[i], configs[i], var=variances[i], psf=psf)
+        for p in SERSIC_PARAMS:
+            assert abs(res[p] - TRUTH[p]) < 5*res[p+'_err'] + 1e-12
+            assert abs(res[p] - single[p]) < 0.01*single[p+'_err'] + 1e-8
+        assert abs(res['reduced_chisq'] - 1) < 0.1
+    assert results[-1]['n']==0.9 and results[-1]['n_err']==0
+
+    # the PA limits span a period, so the fit can cross them
+    config['PA'] = [170.0, 0, 180]
+    results = engine.fit_batch(imgs[:1], config, variances=variances[:1],
+                               psfs=[psf])
+    assert abs(results[0]['PA'] - TRUTH['PA']) < 1
+
+
+def test_fit_batch_passes():
+    # HSC-size stamps, several per vectorized pass
+    y, x = np.mgrid[-5:6, -5:6]
+    psf = np.exp(-(x**2 + y**2)/(2*1.5**2))
+    shape = (357, 357)
+    assert engine._pass_size((shape[0] + 10)*(shape[1] + 10), 2**28) > 1
+    assert engine._pass_size(shape[0]*shape[1], 2**20)==1
+    stamps = [_mock(shape, psf, seed=seed) for seed in range(3)]
+    imgs, variances = [np.array(a) for a in zip(*stamps)]
+    config = {'X0': [30, 25, 35], 'Y0': [30, 25, 35], 'PA': [20.0, 0, 180],
+              'ell': [0.2, 0, 0.99], 'n': [1.0, 0.1, 5], 'I_e': 0.5,
+              'r_e': 5.0}
+    batched = engine.fit_batch(imgs, config, variances=variances, 
+                               psfs=psf, max_iter=5)
+    single = engine.fit_batch(imgs, config, variances=variances, 
+                              psfs=psf, max_iter=5, batch_size=1)
+    for res, exp in zip(batched, single):
+        for p in SERSIC_PARAMS:
+            assert np.isclose(res[p], exp[p], rtol=1e-10)
+
+
+def test_fit_linear():
+    y, x = np.mgrid[-6:7, -6:7]
+    psf = np.exp(-(x**2 + y**2)/(2*1.5**2))
+    img, var = _mock(psf=psf)
+    results = engine.fit_linear(img, dict(TRUTH, I_e=0.1), var=var, psf=psf)
+    assert abs(results['I_e'] - TRUTH['I_e']) < 5*results['I_e_err']
+    assert results['r_e']==TRUTH['r_e'] and results['r_e_err']==0
+
+    # refining r_e agrees with the nonlinear fit
+    params = dict(TRUTH, r_e=1.3*TRUTH['r_e'])
+    results = engine.fit_linear(img, params, var=var, psf=psf, fit_r_e=True)
+    config = dict((p, [params[p], 'fixed']) for p in SERSIC_PARAMS[:5])
+    config.update(I_e=0.5, r_e=params['r_e'])
+    full = engine.fit(img, config, var=var, psf=psf)
+    for p in ['I_e', 'r_e']:
+        assert abs(results[p] - full[p]) < 0.01*full[p+'_err']
+        assert np.isclose(results[p+'_err'], full[p+'_err'], rtol=1e-3)
+    assert results['X0_err']==0
+
+
+def test_fit_joint():
+    imgs, variances, psfs = [], [], []
+    for seed, sigma in enumerate([1.2, 1.8]):
+        y, x = np.mgrid[-7:8, -7:8]
+        psf = np.exp(-(x**2 + y**2)/(2*sigma**2))
+        img, var = _mock(psf=psf, seed=seed)
+        imgs.append(img)
+        variances.append(var)
+        psfs.append(psf)
+    config = {'X0': [30, 25, 35], 'Y0': [30, 25, 35], 'PA': [20.0, 0, 180],
+              'ell': [0.2, 0, 0.99], 'n': [1.0, 0.1, 5], 'I_e': 0.5,
+              'r_e': 5.0}
+    results = engine.fit_joint(imgs, config, variances=variances, psfs=psfs)
+    single = engine.fit(imgs[0], config, var=variances[0], psf=psfs[0])
+    for p in SERSIC_PARAMS:
+        assert results[0][p]==results[1][p] or p=='I_e'
+        for res in results:
+            assert abs(res[p] - TRUTH[p]) < 5*res[p+'_err']
+    assert results[0]['n_err'] < single['n_err']
+
+    results = engine.fit_joint(imgs, config, variances=variances, psfs=psfs,
+                               band_r_e=True)
+    assert results[0]['r_e']!=results[1]['r_e']
+    assert results[0]['n']==results[1]['n']
+
+
+def test_fit_coarse():
+    y, x = np.mgrid[-7:8, -7:8]
+    psf = np.exp(-(x**2 + y**2)/(2*1.5**2))
+    img, var = _mock(psf=psf)
+    mask = np.zeros(img.shape, dtype=bool)
+    mask[5:12, 40:50] = True
+    config = {'X0': [30, 25, 35], 'Y0': [30, 25, 35], 'PA': [20.0, 0, 180],
+              'ell': [0.2, 0, 0.99], 'n': [1.0, 0.1, 5], 'I_e': 0.5,
+              'r_e': 5.0}
+    full = engine.fit(img, config, mask, var, psf)
+    results = engine.fit(img, config, mask, var, psf, coarse=2)
+    for p in SERSIC_PARAMS:
+        assert abs(results[p] - full[p]) < 0.2*full[p+'_err']
@@ -0,0 +1,70 @@
+from __future__ import division, print_function
+
+import numpy as np
+from ..core import SERSIC_PARAMS
+from ..sersic import Sersic, SersicCatalog
+from ..fisher import sersic_jacobian, fisher_covariance
+
+PARAMS = {'X0': 20.3, 'Y0': 18.6, 'PA': 35.0, 'ell': 0.3, 'n': 1.3,
+          'I_e': 0.5, 'r_e': 6.0}
+
+
+def test_jacobian():
+    y, x = np.mgrid[0:40, 0:40]
+    values = [PARAMS[p] for p in SERSIC_PARAMS]
+    model, jac = sersic_jacobian(x, y, *values)
+    assert np.allclose(model, Sersic(PARAMS)(x, y))
+    for i in range(len(values)):
+        step = 1e-6*max(abs(values[i]), 1)
+        hi, lo = list(values), list(values)
+        hi[i] += step
+        lo[i] -= step
+        numeric = (sersic_jacobian(x, y, *hi)[0] -
+                   sersic_jacobian(x, y, *lo)[0])/(2*step)
+        assert np.allclose(jac[..., i], numeric, rtol=1e-4, atol=1e-7)
+
+
+def test_fisher_covariance():
+    var = np.full((40, 40), 0.01)
+    cov, errors = fisher_covariance(Sersic(PARAMS), var)
+    assert cov.shape==(7, 7)
+    assert np.allclose(np.sqrt(np.diag(cov))[-1], errors['r_e_err'])
+
+    # batches give the same covariances as single fits
+    cat = SersicCatalog(dict((k, [v, v*1.01]) for k, v in PARAMS.items()))
+    batch_cov, batch_errors = fisher_covariance(
+        cat, np.stack([var, 2*var]), batch_size=1)
+    assert np.allclose(batch_cov[0], cov)
+    assert np.allclose(batch_errors['n_err'][1]**2, batch_cov[1, 4, 4])
+
+    # fixed parameters and masked pixels
+    mask = np.zeros(var.shape, dtype=bool)
+    mask[:, :10] = True
+    cov_fixed, errors_fixed = fisher_covariance(
+        PARAMS, var, mask, fixed=['X0', 'Y0'])
+    assert cov_fixed.shape==(5, 5)
+    assert 'X0_err' not in errors_fixed
+
+
+def test_fisher_engine():
+    from .. import engine
+    y, x = np.mgrid[-6:7, -6:7]
+    psf = np.exp(-(x**2 + y**2)/(2*1.5**2))
+    psf /= psf.sum()
+
+    # noiseless stamp with a variance gradient and a masked corner
+    shape = (40, 44)
+    x, y, crop, _, convolver = engine._grid(shape, psf)
+    values = [PARAMS[p] for p in SERSIC_PARAMS]
+    img = convolver(sersic_jacobian(x, y, *values)[0], psf)[crop]
+    var = 0.01*(1 + np.linspace(0, 3, shape[1]))*np.ones(shape)
+    mask = np.zeros(shape, dtype=int)
+    mask[25:, 28:] = 1
+
+    config = dict((p, [v, v - 5, v + 5]) for p, v in PARAMS.items())
+    config.update(PA=[30.0, 0, 180], ell=[0.2, 0, 0.99], n=[1.0, 0.1, 5],
+                  I_e=[0.4, 0, 10], r_e=[5.0, 0.5, 20])
+    results = engine.fit(img, config, mask, var, psf)
+    _, errors = fisher_covariance(results, var, mask, psf)
+    for p in SERSIC_PARAMS:
+        assert np.isclose(errors[p+'_err'], results[p+'_err'], rtol=1e-3)
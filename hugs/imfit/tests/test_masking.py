@@ -0,0 +1,26 @@
+from __future__ import division, print_function
+
+import numpy as np
+from astropy.io import fits
+from ..masking import get_hsc_pipe_mask, _mask_planes
+
+
+def test_pipe_mask_array():
+    header = fits.Header([('MP_DETECTED', 5), ('MP_BRIGHT_OBJECT', 9), 
+                          ('MP_EDGE', 4)])
+    planes = _mask_planes(header)
+    assert planes=={'DETECTED': 5, 'BRIGHT_OBJECT': 9, 'EDGE': 4}
+
+    mask = np.zeros((30, 30), dtype='i4')
+    mask[10:20, 10:20] |= 1 << 5   # the galaxy
+    mask[2:5, 2:5] |= 1 << 5       # another source
+    mask[5, 5] |= 1 << 5           # diagonal neighbor of it
+    mask[25:28, 0:3] |= 1 << 9     # bright object
+    mask[0, :] |= 1 << 4           # edge (not masked)
+
+    photo_mask = get_hsc_pipe_mask(mask, (15, 15), planes)
+    expected = np.zeros(mask.shape, dtype=int)
+    expected[2:5, 2:5] = 1
+    expected[5, 5] = 1
+    expected[25:28, 0:3] = 1
+    assert np.array_equal(photo_mask, expected)
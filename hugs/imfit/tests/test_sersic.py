@@ -0,0 +1,106 @@
+from __future__ import division, print_function
+
+import numpy as np
+from ..sersic import Sersic, SersicCatalog, sersic_b_n_f_n
+
+
+def _random_params(size, seed=3):
+    rng = np.random.RandomState(seed)
+    params = {'X0': rng.uniform(0, 100, size),
+              'Y0': rng.uniform(0, 100, size),
+              'PA': rng.uniform(0, 180, size),
+              'ell': rng.uniform(0, 0.9, size),
+              'n': rng.uniform(0.2, 4, size),
+              'I_e': rng.uniform(0.01, 1, size),
+              'r_e': rng.uniform(2, 50, size),
+              'r_e_err': rng.uniform(0, 1, size)}
+    return params
+
+
+def test_catalog():
+    params = _random_params(50)
+    cat = SersicCatalog(params)
+    for i in range(len(cat)):
+        sersic = Sersic(dict((k, v[i]) for k, v in params.items()))
+        for name in ['b_n', 'mu_0', 'mu_e_ave', 'm_tot', 'r_circ']:
+            assert np.allclose(cat[name][i], getattr(sersic, name))
+        assert cat[i].r_e_err==params['r_e_err'][i]
+    assert len(cat[cat.n > 1])==(params['n'] > 1).sum()
+
+
+def test_interp():
+    n = np.concatenate([np.random.uniform(0.01, 10, 1000), [0.005, 12.0]])
+    b_n, f_n = sersic_b_n_f_n(n)
+    b_n_interp, f_n_interp = sersic_b_n_f_n(n, interp=True)
+    assert np.allclose(b_n_interp, b_n, rtol=1e-4)
+    assert np.allclose(f_n_interp, f_n, rtol=1e-6)
+    for n in [1.3, 0.005, 12.0]:
+        b_n, f_n = sersic_b_n_f_n(n, interp=True)
+        assert np.ndim(b_n)==np.ndim(f_n)==0
+        assert np.allclose([b_n, f_n], sersic_b_n_f_n(n), rtol=1e-4)
+    cat = SersicCatalog(_random_params(1000), interp=True)
+    exact = SersicCatalog(cat.data)
+    assert np.allclose(cat.m_tot, exact.m_tot, atol=1e-5)
+
+
+def test_render():
+    params = {'X0': 40.3, 'Y0': 52.7, 'PA': 30.0, 'ell': 0.4, 'n': 0.8,
+              'I_e': 1.0, 'r_e': 8.0}
+    sersic = Sersic(params)
+    canvas = np.zeros((100, 90), dtype=np.float32)
+    sersic.render(canvas, tol=1e-6)
+    assert np.allclose(canvas, sersic.array(canvas.shape), atol=1e-6)
+
+    tol = 1e-2
+    canvas = np.zeros((100, 90))
+    sersic.render(canvas, tol=tol)
+    model = sersic.array(canvas.shape)
+    assert np.allclose(canvas[model > tol], model[model > tol])
+    assert (canvas==0).sum() > 0
+
+    cat = SersicCatalog(_random_params(20))
+    canvas = np.zeros((150, 150))
+    cat.render(canvas, tol=0, origin=(-10, -20))
+    model = 0
+    y, x = np.indices(canvas.shape)
+    for i in range(len(cat)):
+        model += cat[i](x - 10, y - 20)
+    assert np.allclose(canvas, model)
+
+
+def test_oversample():
+    params = {'X0': 20.3, 'Y0': 21.6, 'PA': 20.0, 'ell': 0.3, 'n': 2.5,
+              'I_e': 1.0, 'r_e': 3.0}
+    sersic = Sersic(params)
+    factor = 101
+    y, x = np.mgrid[0:40, 0:40]
+    sub = (np.arange(factor) + 0.5)/factor - 0.5
+    truth = sersic(x[..., None, None] + sub[None, :],
+                   y[..., None, None] + sub[:, None]).mean(axis=(2, 3))
+    center = sersic.array(truth.shape)
+    oversampled = sersic.array(truth.shape, accuracy=1e-3)
+    assert np.abs(center - truth).max() > 0.1
+    assert np.abs(oversampled - truth).max() < 3e-3
+    # pixels far from the center are sampled at their centers
+    assert (oversampled==center).mean() > 0.5
+
+
+def test_psf_convolution(tmpdir):
+    from astropy.io import fits
+    from scipy.signal import fftconvolve
+    from ..sersic import PSFConvolver
+    params = {'X0': 30.3, 'Y0': 25.6, 'PA': 20.0, 'ell': 0.3, 'n': 1.0,
+              'I_e': 1.0, 'r_e': 6.0}
+    sersic = Sersic(params)
+    y, x = np.mgrid[-6:6:13j, -6:6:13j]
+    psf = np.exp(-(x**2 + y**2)/(2*1.5**2))
+    psf_fn = str(tmpdir.join('psf.fits'))
+    fits.writeto(psf_fn, psf)
+    convolver = PSFConvolver()
+    model = sersic.array((60, 50), psf=psf_fn, convolver=convolver)
+    padded = Sersic(dict(params, X0=36.3, Y0=31.6)).array((72, 62))
+    expected = fftconvolve(padded, psf/psf.sum(), 'same')[6:-6, 6:-6]
+    assert np.allclose(model, expected)
+    assert np.allclose(sersic.array((60, 50), psf=psf_fn, 
+                                    convolver=convolver), model)
+    assert len(convolver._ffts)==1
@@ -0,0 +1,22 @@
+from __future__ import division, print_function
+
+import numpy as np
+from ..core import SERSIC_PARAMS
+from ..fisher import sersic_jacobian
+from .. import engine, viz
+
+
+def test_model():
+    params = {'X0': 31.2, 'Y0': 29.7, 'PA': 35.0, 'ell': 0.3, 'n': 0.9,
+              'I_e': 0.8, 'r_e': 7.0}
+    y, x = np.mgrid[-7:8, -7:8]
+    psf = np.exp(-(x**2 + y**2)/(2*1.5**2))
+    psf /= psf.sum()
+    for p in [None, psf]:
+        x, y, crop, p, convolver = engine._grid((60, 55), p)
+        expected = sersic_jacobian(x, y, *[params[k] for k in 
+                                           SERSIC_PARAMS])[0]
+        if p is not None:
+            expected = convolver(expected, p)
+        model = viz._model(params, (60, 55), p)
+        assert np.allclose(model, expected[crop])
@@ -15,14 +15,28 @@ from toolbox.image import zscale
 
 __all__ = ['imfit_results']
 
+def _model(mod_params, shape, psf_fn=None):
+    """
+    Model image of a fit. The fit positions are 1-indexed (as in 
+    imfit and imfit.engine), while Sersic.array renders on 0-indexed
+    pixels.
+    """
+    params = dict(mod_params)
+    params['X0'] = params['X0'] - 1
+    params['Y0'] = params['Y0'] - 1
+    return Sersic(params).array(shape, psf=psf_fn)
+
+
 def img_mod_res(img_fn, mod_params, mask_fn=None, cmap=plt.cm.gray_r, 
                 save_fn=None, show=True, band='i', subplots=None, 
-                titles=True, **kwargs):
+                titles=True, psf_fn=None, **kwargs):
     """
-    Show imfit results: image, model, and residual.
+    Show imfit results: image, model, and residual. If psf_fn is 
+    given, the model is convolved with the PSF (as in the fit). 
+    The image and mask can be given as fits file names or arrays.
     """
 
-    img = fits.getdata(img_fn)
+    img = img_fn if isinstance(img_fn, np.ndarray) else fits.getdata(img_fn)
 
     if subplots is None:
         fig, axes = plt.subplots(1, 3, **kwargs)
@@ -31,7 +45,7 @@ def img_mod_res(img_fn, mod_params, mask_fn=None, cmap=plt.cm.gray_r,
         fig, axes = subplots
 
     s = Sersic(mod_params)
-    model = s.array(img.shape)
+    model = _model(mod_params, img.shape, psf_fn)
     res = img - model
 
     vmin, vmax = zscale(img)
@@ -51,7 +65,8 @@ def img_mod_res(img_fn, mod_params, mask_fn=None, cmap=plt.cm.gray_r,
         axes[i].set_title(titles[i], fontsize=20, y=1.01)
 
     if mask_fn is not None:
-        mask = fits.getdata(mask_fn)
+        mask = mask_fn if isinstance(mask_fn, np.ndarray) else \
+               fits.getdata(mask_fn)
         mask = mask.astype(float)
         mask[mask==0.0] = np.nan
         axes[0].imshow(mask, origin='lower', alpha=0.4, 
@@ -1,4 +1,6 @@
 from .core import *
 from .rmedian import *
 from .cutout import *
+from .matched import *
+from .archive import *
 from . import kernels
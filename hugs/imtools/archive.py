@@ -0,0 +1,169 @@
+"""
+Run-level archive of postage stamps, which replaces the per-band
+fits files of a stamp run with a single HDF5 file.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import numpy as np
+
+__all__ = ['StampArchive']
+
+PLANES = ['img', 'mask', 'var']
+
+
+class StampArchive(object):
+    """
+    Single-file HDF5 archive of the (image, mask, variance) stamps of
+    a run, indexed by (candidate number, band). Each plane is stored
+    as its own chunked dataset under /<num>/<band>/, with the fits
+    header of the plane saved as an attribute, so any stamp can be
+    read without touching the others. Several workers can read the
+    same archive at once.
+
+    Parameters
+    ----------
+    fn : string
+        Archive file name.
+    mode : string, optional
+        'r' to read, 'a' to read/write (created if needed),
+        or 'w' to create (truncate if exists).
+    compression : string, optional
+        HDF5 compression filter for the stamps ('gzip', 'lzf',
+        or None).
+
+    Notes
+    -----
+    Example usage:
+    with StampArchive('stamps.h5') as archive:
+        header, img, mask, var = archive.read(0, 'i')
+    """
+
+    def __init__(self, fn, mode='r', compression='gzip'):
+        import h5py
+        self.fn = fn
+        self.compression = compression
+        self._file = h5py.File(fn, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, key):
+        num, band = key
+        return '{}/{}'.format(num, band.lower()) in self._file
+
+    def close(self):
+        self._file.close()
+
+    def candidates(self):
+        """
+        Sorted candidate numbers in the archive.
+        """
+        return sorted(int(num) for num in self._file.keys())
+
+    def bands(self, num):
+        """
+        Bands that are available for a candidate.
+        """
+        return sorted(self._file[str(num)].keys())
+
+    def keys(self):
+        """
+        List of all (candidate number, band) keys.
+        """
+        return [(num, band) for num in self.candidates()
+                for band in self.bands(num)]
+
+    def write(self, num, band, img, mask, var, headers=None):
+        """
+        Add a stamp to the archive.
+
+        Parameters
+        ----------
+        num : int
+            Candidate number.
+        band : string
+            Photometric band.
+        img, mask, var : 2D ndarrays
+            The image, mask, and variance stamps.
+        headers : list of fits headers, optional
+            Headers of the image, mask, and variance planes.
+        """
+        group = self._file.require_group('{}/{}'.format(num, band.lower()))
+        headers = [None]*3 if headers is None else headers
+        for name, data, header in zip(PLANES, [img, mask, var], headers):
+            if name in group:
+                del group[name]
+            data = np.asarray(data)
+            data = data.astype(data.dtype.newbyteorder('='), copy=False)
+            dset = group.create_dataset(
+                name, data=data, chunks=data.shape,
+                compression=self.compression)
+            if header is not None:
+                dset.attrs['header'] = header.tostring()
+
+    def add_fits(self, num, band, fn):
+        """
+        Add a multi-extension fits stamp (f[1], f[2], f[3] = image,
+        mask, variance) to the archive.
+        """
+        from astropy.io import fits
+        with fits.open(fn) as hdulist:
+            planes = [hdulist[ext].data for ext in [1, 2, 3]]
+            headers = [hdulist[ext].header for ext in [1, 2, 3]]
+            self.write(num, band, *planes, headers=headers)
+
+    def header(self, num, band, plane='img'):
+        """
+        Fits header of one of the planes of a stamp.
+        """
+        from astropy.io import fits
+        dset = self._file['{}/{}/{}'.format(num, band.lower(), plane)]
+        header = dset.attrs.get('header')
+        return None if header is None else fits.Header.fromstring(header)
+
+    def read(self, num, band):
+        """
+        Read a stamp from the archive.
+
+        Returns
+        -------
+        img_head : fits header
+            The header associated with the image.
+        img, mask, var : ndarray
+            The image, mask, and variance stamps.
+        """
+        group = self._file['{}/{}'.format(num, band.lower())]
+        img, mask, var = [group[name][()] for name in PLANES]
+        return self.header(num, band), img, mask, var
+
+    def stamp(self, num, band):
+        """
+        Read a stamp as (img, mask, var, headers), the in-memory
+        stamp format of the fitting tasks (see tasks.fit_candy).
+        """
+        group = self._file['{}/{}'.format(num, band.lower())]
+        planes = [group[name][()] for name in PLANES]
+        headers = [self.header(num, band, name) for name in PLANES]
+        return tuple(planes) + (headers,)
+
+    def to_fits(self, num, band, fn):
+        """
+        Write a stamp to a multi-extension fits file with the same
+        structure as the DAS stamps (for programs that need files,
+        like imfit).
+
+        Returns
+        -------
+        fn : string
+            The fits file name.
+        """
+        from .core import write_fits
+        group = self._file['{}/{}'.format(num, band.lower())]
+        planes = [group[name][()] for name in PLANES]
+        headers = [self.header(num, band, name) for name in PLANES]
+        write_fits(fn, planes, headers)
+        return fn
@@ -4,7 +4,7 @@ from __future__ import (absolute_import, division, print_function,
 import numpy as np
 from astropy.io import fits
 
-__all__=['open_fits']
+__all__=['open_fits', 'write_fits', 'LazyFits', 'native_byteorder']
 
 def open_fits(fn, muilti_ext=True):
     """
@@ -27,7 +27,187 @@ def open_fits(fn, muilti_ext=True):
         img, mask, var = hdulist[1].data, hdulist[2].data, hdulist[3].data
         img_head = hdulist[1].header
     else:
-        img = hdulist[0].data
-        img_head = hdulist[0].header
+        ext = 0 if hdulist[0].header['NAXIS'] else 1
+        img = hdulist[ext].data
+        img_head = hdulist[ext].header
     return (img_head, img, mask, var) if muilti_ext else (img_head, img)
 
+
+
+def write_fits(fn, data, header=None, compress=None, tile_shape=None,
+               quantize_level=16.0, overwrite=True):
+    """
+    Write image(s) to a fits file, optionally with tile compression.
+
+    Parameters
+    ----------
+    fn : string
+        Fits file name.
+    data : ndarray or list of ndarrays
+        Image to write. If a list (e.g., [img, mask, var]), each
+        array is written to its own extension after an empty
+        primary HDU, following the structure of HSC coadds.
+    header : fits header or list of headers, optional
+        Header(s) for the image(s).
+    compress : string, optional
+        If not None, the tile-compression algorithm: 'RICE_1',
+        'GZIP_1', 'GZIP_2', 'PLIO_1', or 'HCOMPRESS_1'. Compressed
+        images are always written to extensions, so single images
+        end up in f[1]. Readers (e.g., cutouts_from_fits) decode
+        only the tiles that overlap the requested pixels.
+    tile_shape : tuple, optional
+        Shape of the compression tiles. If None, each row is a tile.
+    quantize_level : float, optional
+        Quantization level for floating-point images, which makes
+        RICE/GZIP compression lossy. Use 0 with GZIP for lossless
+        compression of floats.
+    overwrite : bool, optional
+        If True, overwrite existing file.
+    """
+    multi_ext = isinstance(data, (list, tuple))
+    data = data if multi_ext else [data]
+    headers = header if isinstance(header, (list, tuple)) else \
+              [header]*len(data)
+
+    if compress is None:
+        if multi_ext:
+            hdus = [fits.PrimaryHDU()]
+            hdus += [fits.ImageHDU(d, h) for d, h in zip(data, headers)]
+        else:
+            hdus = [fits.PrimaryHDU(data[0], headers[0])]
+    else:
+        hdus = [fits.PrimaryHDU()]
+        for d, h in zip(data, headers):
+            hdus.append(fits.CompImageHDU(
+                d, h, compression_type=compress, tile_shape=tile_shape,
+                quantize_level=quantize_level))
+    fits.HDUList(hdus).writeto(fn, overwrite=overwrite)
+
+
+def native_byteorder(arr, inplace=False):
+    """
+    Convert array to native byte order (astropy.io.fits always
+    returns big-endian arrays). Arrays that are already native
+    are returned as is.
+
+    Parameters
+    ----------
+    arr : ndarray
+        Input array.
+    inplace : bool, optional
+        If True and arr is writeable, swap the bytes of its buffer
+        in place and return a native-order view of it, which avoids
+        a copy. The input array object must not be used afterwards.
+
+    Returns
+    -------
+    arr : ndarray
+        Array in native byte order.
+    """
+    if arr.dtype.isnative:
+        return arr
+    native_dtype = arr.dtype.newbyteorder('=')
+    if inplace and arr.flags.writeable:
+        return arr.byteswap(inplace=True).view(native_dtype)
+    return arr.astype(native_dtype)
+
+
+class LazyFits(object):
+    """
+    Lazy, context-managed access to a fits file. Each extension is
+    loaded (or memory mapped) only when it is first accessed and is
+    converted to native byte order once, into a copy that leaves the
+    HDU data (and its section) untouched. Later accesses return the
+    same array. If a multi-extension fits file, we assume the
+    structure is f[0], f[1], f[2], f[3] = header, image, mask,
+    variance. Tile-compressed files (see write_fits) have the same
+    structure, and their sections decode only the tiles that overlap
+    the requested pixels.
+
+    Parameters
+    ----------
+    fn : string
+        Fits file name.
+    multi_ext : bool, optional
+        If False, the image is in the primary HDU.
+    memmap : bool, optional
+        If True, memory map the data, so extensions that are never
+        accessed, or are only read through sections, are not loaded.
+
+    Notes
+    -----
+    Example usage:
+    with LazyFits(fn) as f:
+        obj, seg = imfit.masking.detect_sources(f.img, 1.5, 50)
+    """
+
+    def __init__(self, fn, multi_ext=True, memmap=True):
+        self.fn = fn
+        self.multi_ext = multi_ext
+        self.memmap = memmap
+        self._hdulist = None
+        self._data = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def hdulist(self):
+        if self._hdulist is None:
+            self._hdulist = fits.open(self.fn, memmap=self.memmap)
+        return self._hdulist
+
+    def close(self):
+        """
+        Close the file. Arrays that were already accessed
+        remain valid.
+        """
+        if self._hdulist is not None:
+            self._hdulist.close()
+            self._hdulist = None
+
+    def section(self, ext):
+        """
+        Get the section of an extension, which reads (and, for
+        tile-compressed images, decodes) only the sliced pixels.
+        """
+        return self.hdulist[ext].section
+
+    def get(self, ext):
+        """
+        Get the data of an extension in native byte order.
+        """
+        if ext not in self._data:
+            data = self.hdulist[ext].data
+            if data is not None:
+                data = native_byteorder(data)
+            self._data[ext] = data
+        return self._data[ext]
+
+    @property
+    def _img_ext(self):
+        # compressed single images are stored in the first extension
+        if self.multi_ext or (self.hdulist[0].header['NAXIS']==0):
+            return 1
+        return 0
+
+    @property
+    def header(self):
+        return self.hdulist[self._img_ext].header
+
+    @property
+    def img(self):
+        return self.get(self._img_ext)
+
+    @property
+    def mask(self):
+        assert self.multi_ext, 'no mask in single-extension file'
+        return self.get(2)
+
+    @property
+    def var(self):
+        assert self.multi_ext, 'no variance in single-extension file'
+        return self.get(3)
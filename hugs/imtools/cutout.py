@@ -1,7 +1,9 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
-__all__  = ['cutout']
+import numpy as np
+
+__all__  = ['cutout', 'cutouts', 'cutouts_from_fits']
 
 
 def cutout(data, coord, header=None, size=301, write=None):
@@ -49,3 +51,184 @@ def cutout(data, coord, header=None, size=301, write=None):
         header = cutout.wcs.to_header() if header is not None else None
         fits.writeto(write, cutout.data, header, clobber=True)
 
+
+
+def _stamp_origins(coords, header, size):
+    """
+    Lower-left pixels (x0, y0) of stamps centered on coords,
+    following the rounding of astropy's Cutout2D.
+    """
+    coords = np.atleast_2d(np.asarray(coords, dtype=float))
+    ny, nx = (size, size) if np.isscalar(size) else size
+    if header is None:
+        x, y = coords[:, 0], coords[:, 1]
+    else:
+        from astropy import wcs
+        w = wcs.WCS(header)
+        x, y = w.all_world2pix(coords[:, 0], coords[:, 1], 0)
+    x0 = np.ceil(x - nx/2).astype(int)
+    y0 = np.ceil(y - ny/2).astype(int)
+    return np.column_stack([x0, y0]), (ny, nx)
+
+
+def cutouts(data, coords, header=None, size=301, fill_value=np.nan,
+            stack=True):
+    """
+    Generate postage stamps at many positions at once. The stamp
+    bounds follow astropy's Cutout2D, but stamps that extend past
+    the edge of the image are padded with fill_value.
+
+    Parameters
+    ----------
+    data : 2D ndarray
+        The data from the fits file.
+    coords : array-like
+        N x 2 array of central coordinates. If header is None,
+        then the unit is pixels (x, y), else ra and dec in degrees.
+    header : Fits header, optional
+        The fits header, which must have WCS info. All coordinates
+        are transformed to pixels with a single WCS call.
+    size : int, array-like, optional
+        The size of the cutout array along each axis (ny, nx).
+        If an integer is given, will get a square.
+    fill_value : scalar, optional
+        Value for the pixels of edge stamps that are off the image.
+    stack : bool, optional
+        If True, return the stamps as a single N x ny x nx array.
+        Otherwise, return a list in which stamps that are fully
+        inside the image are views into data (no copy) and only
+        edge stamps are padded copies.
+
+    Returns
+    -------
+    stamps : 3D ndarray or list of 2D ndarrays
+        The postage stamps.
+    origins : N x 2 ndarray
+        Pixel (x, y) of each stamp's lower-left pixel in data. To
+        get a stamp's WCS, subtract its origin from CRPIX1/CRPIX2.
+    """
+    data = np.asarray(data)
+    origins, shape = _stamp_origins(coords, header, size)
+    stamps = _cut(data, origins, shape, fill_value, stack)
+    return stamps, origins
+
+
+def _cut(data, origins, shape, fill_value, stack=True):
+    """
+    Cut stamps of the given shape with lower-left pixels at origins.
+    """
+    ny, nx = shape
+    x0, y0 = origins.T
+    inside = (x0 >= 0) & (y0 >= 0) & \
+             (x0 + nx <= data.shape[1]) & (y0 + ny <= data.shape[0])
+
+    def _edge_stamp(i, dtype):
+        stamp = np.full((ny, nx), fill_value, dtype=dtype)
+        ylo, xlo = max(y0[i], 0), max(x0[i], 0)
+        yhi = min(y0[i] + ny, data.shape[0])
+        xhi = min(x0[i] + nx, data.shape[1])
+        if (yhi > ylo) and (xhi > xlo):
+            stamp[ylo - y0[i]:yhi - y0[i], xlo - x0[i]:xhi - x0[i]] = \
+                data[ylo:yhi, xlo:xhi]
+        return stamp
+
+    dtype = np.result_type(data.dtype, fill_value).newbyteorder('=')
+    if not stack:
+        return [data[y0[i]:y0[i] + ny, x0[i]:x0[i] + nx] if inside[i]
+                else _edge_stamp(i, dtype) for i in range(len(x0))]
+
+    stamps = np.empty((len(x0), ny, nx), dtype=dtype)
+    if not isinstance(data, np.ndarray):
+        inside[:] = False
+    if inside.any():
+        from numpy.lib.stride_tricks import as_strided
+        windows = as_strided(
+            data, shape=(data.shape[0] - ny + 1, data.shape[1] - nx + 1,
+                         ny, nx), strides=data.strides*2, writeable=False)
+        # gather in file order, so memory-mapped data is read sequentially
+        idx = np.where(inside)[0]
+        idx = idx[np.lexsort((x0[idx], y0[idx]))]
+        stamps[idx] = windows[y0[idx], x0[idx]]
+    for i in np.where(~inside)[0]:
+        stamps[i] = _edge_stamp(i, dtype)
+
+    return stamps
+
+
+def _lazy_data(hdu):
+    """
+    Array-like access to the data of an image HDU (opened with
+    memmap=True) that reads only the pixels that are sliced: the
+    memory map of the raw data when it is stored unscaled, otherwise
+    the HDU section.
+    """
+    from astropy.io import fits
+    scaled = (hdu.header.get('BSCALE', 1)!=1) or \
+             (hdu.header.get('BZERO', 0)!=0)
+    if not (scaled or isinstance(hdu, fits.CompImageHDU)):
+        return hdu.data
+    return _SectionArray(hdu.section, hdu.shape)
+
+
+class _SectionArray(object):
+    """
+    Minimal array interface for an HDU section, so that stamps
+    can be cut from it without loading the full image.
+    """
+
+    def __init__(self, section, shape):
+        self.section = section
+        self.shape = shape
+        self.dtype = section[0:1, 0:1].dtype
+        self.ndim = len(shape)
+
+    def __getitem__(self, key):
+        return self.section[key]
+
+
+def cutouts_from_fits(fn, coords, size=301, exts=[1, 2, 3],
+                      pixel_coords=False):
+    """
+    Cut postage stamps straight from a (coadd) fits file without
+    loading the full images. The file is memory mapped, and only the
+    pixels overlapping the stamps are read (through the HDU section
+    for scaled or compressed data), so workers cutting stamps from
+    the same patch share the OS page cache.
+
+    Parameters
+    ----------
+    fn : string
+        Fits file name. By default, we assume the structure is
+        f[0], f[1], f[2], f[3] = header, image, mask, variance.
+    coords : array-like
+        N x 2 array of central coordinates: ra and dec in degrees,
+        or pixels (x, y) if pixel_coords is True.
+    size : int, array-like, optional
+        The size of the cutout array along each axis (ny, nx).
+    exts : list, optional
+        The extensions to cut. The WCS is read from the first one.
+    pixel_coords : bool, optional
+        If True, coords are in pixels.
+
+    Returns
+    -------
+    stamps : list of 3D ndarrays
+        An N x ny x nx stack (in native byte order) for each
+        extension. Off-image pixels are NaN for floating-point
+        planes and NO_DATA for integer (mask) planes.
+    origins : N x 2 ndarray
+        Pixel (x, y) of each stamp's lower-left pixel in the image.
+    """
+    from astropy.io import fits
+    from ..utils import bit_flag_dict
+
+    stamps = []
+    with fits.open(fn, memmap=True) as hdulist:
+        header = None if pixel_coords else hdulist[exts[0]].header
+        origins, shape = _stamp_origins(coords, header, size)
+        for ext in exts:
+            data = _lazy_data(hdulist[ext])
+            fill = np.nan if data.dtype.kind=='f' else bit_flag_dict['NO_DATA']
+            stamps.append(_cut(data, origins, shape, fill))
+
+    return stamps, origins
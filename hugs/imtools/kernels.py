@@ -1,13 +1,146 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import os
+from collections import OrderedDict
 import numpy as np
-from astropy.convolution import discretize_model
 
-def exponential(alpha, size, norm=True, mode='center', factor=10):
+MODES = ['center', 'linear_interp', 'oversample', 'integrate']
+
+
+def _exp_model(alpha):
+    return lambda x, y: np.exp(-np.sqrt(x**2 + y**2)/alpha)
+
+
+def _gauss_legendre(lo, hi, npts):
+    """
+    Gauss-Legendre nodes and weights for integrating over
+    the intervals [lo, hi], where lo and hi are arrays.
+    """
+    nodes, weights = np.polynomial.legendre.leggauss(npts)
+    half = 0.5*(hi - lo)[:, None]
+    mid = 0.5*(hi + lo)[:, None]
+    return mid + half*nodes, half*weights
+
+
+def _discretize_exponential(alpha, size, mode='center', factor=10):
+    """
+    Discretize the exponential model with numpy. The center,
+    linear_interp, and oversample modes follow the grids of
+    astropy.convolution.discretize_model. The integrate mode
+    uses factor-point Gauss-Legendre quadrature along each axis,
+    where the central pixel is split into quadrants so that the
+    cusp of the profile falls on the quadrature boundaries.
+    """
+    model = _exp_model(alpha)
+    lo, hi = -(int(size) - 1) // 2, (int(size) - 1) // 2 + 1
+    if mode=='center':
+        x = np.arange(lo, hi)
+        kern = model(x, x[:, None])
+    elif mode=='linear_interp':
+        x = np.arange(lo - 0.5, hi + 0.5)
+        values = model(x, x[:, None])
+        values = 0.5*(values[1:, :] + values[:-1, :])
+        kern = 0.5*(values[:, 1:] + values[:, :-1])
+    elif mode=='oversample':
+        x = np.linspace(lo - 0.5*(1 - 1/factor), hi - 0.5*(1 + 1/factor),
+                        num=int((hi - lo)*factor))
+        values = model(x, x[:, None])
+        shape = (x.size//factor, factor, x.size//factor, factor)
+        kern = values.reshape(shape).mean(axis=3).mean(axis=1)
+    elif mode=='integrate':
+        half = int(size)//2
+        edges = np.insert(np.arange(lo - 0.5, hi + 0.5), half + 1, 0.0)
+        x, w = _gauss_legendre(edges[:-1], edges[1:], int(factor))
+        values = model(x[None, None, :, :], x[:, :, None, None])
+        kern = np.einsum('ia,iakb,kb->ik', w, values, w)
+        kern[half] += kern[half + 1]
+        kern = np.delete(kern, half + 1, axis=0)
+        kern[:, half] += kern[:, half + 1]
+        kern = np.delete(kern, half + 1, axis=1)
+    else:
+        raise Exception('Invalid mode: '+mode)
+    return kern
+
+
+class KernelBank(object):
+    """
+    Bank of 2D exponential kernels keyed by (alpha, size, mode, factor).
+    Kernels are kept in an in-process LRU cache and, optionally, in an
+    on-disk cache that can be shared between processes and runs.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of kernels to keep in memory.
+    cache_dir : string, optional
+        If not None, kernels are saved to and loaded from
+        .npy files in this directory.
+    """
+
+    def __init__(self, maxsize=128, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self._kernels = OrderedDict()
+
+    def __len__(self):
+        return len(self._kernels)
+
+    def _key(self, alpha, size, mode, factor):
+        assert size%2!=0, 'ERROR: size must be odd'
+        assert mode in MODES, 'mode must be one of '+str(MODES)
+        factor = int(factor) if mode in ['oversample', 'integrate'] else 1
+        return float(alpha), int(size), mode, factor
+
+    def _cache_fn(self, key):
+        fn = 'exponential-{!r}-{}-{}-{}.npy'.format(*key)
+        return os.path.join(self.cache_dir, fn)
+
+    def clear(self):
+        """
+        Empty the in-memory cache.
+        """
+        self._kernels.clear()
+
+    def get(self, alpha, size, norm=True, mode='center', factor=10):
+        """
+        Get a kernel from the bank, building it if needed. See
+        exponential for the parameters.
+
+        Returns
+        -------
+        kern : 2D ndarray
+            The convolution kernel, which is a copy of the
+            cached kernel and is safe to modify.
+        """
+        key = self._key(alpha, size, mode, factor)
+        kern = self._kernels.pop(key, None)
+        if kern is None:
+            cache_fn = self._cache_fn(key) if self.cache_dir else None
+            if cache_fn and os.path.isfile(cache_fn):
+                kern = np.load(cache_fn)
+            else:
+                kern = _discretize_exponential(*key)
+                if cache_fn:
+                    tmp_fn = cache_fn+'.{}.tmp'.format(os.getpid())
+                    with open(tmp_fn, 'wb') as file:
+                        np.save(file, kern)
+                    os.rename(tmp_fn, cache_fn)
+            kern.setflags(write=False)
+        self._kernels[key] = kern
+        while len(self._kernels) > self.maxsize:
+            self._kernels.popitem(last=False)
+        return kern/kern.sum() if norm else kern.copy()
+
+
+default_bank = KernelBank()
+
+
+def exponential(alpha, size, norm=True, mode='center', factor=10, bank=None):
     """
     Generate 2D, radially symmetric exponential kernel The kernels are 
-    discretized using astropy.convolution.discretize_model.
+    discretized with numpy on the grids used by
+    astropy.convolution.discretize_model and are cached in a KernelBank.
 
     Parameters
     ----------
@@ -22,16 +155,14 @@ def exponential(alpha, size, norm=True, mode='center', factor=10):
         'center', 'oversample', 'linear_interp', 
         or 'integrate'. See astropy docs for details. 
     factor : float or int
-        Factor of oversampling. 
+        Factor of oversampling. For 'integrate', the
+        number of quadrature points per pixel and axis.
+    bank : KernelBank, optional
+        The kernel bank to use. If None, use default_bank.
     Returns
     -------
     kern : 2D ndarray
         The convolution kernel. 
     """
-    assert size%2!=0, 'ERROR: size must be odd'
-    x_range = (-(int(size) - 1) // 2, (int(size) - 1) // 2 + 1)
-    model = lambda x, y: np.exp(-np.sqrt(x**2 + y**2)/alpha)
-    kern = discretize_model(model, x_range, x_range, mode=mode, factor=factor)
-    if norm:
-        kern /= kern.sum()
-    return kern
+    bank = default_bank if bank is None else bank
+    return bank.get(alpha, size, norm, mode, factor)
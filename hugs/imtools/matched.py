@@ -0,0 +1,197 @@
+"""
+Multi-scale matched filtering for low-surface-brightness detection.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import numpy as np
+from . import kernels
+
+__all__ = ['MultiScaleFilter', 'lsb_significance']
+
+
+class MultiScaleFilter(object):
+    """
+    Matched filter an image with exponential kernels of several scale
+    lengths using overlap-add FFT convolution. The transforms of the
+    kernels are cached for each padded FFT shape, so filtering many
+    patches of the same size reuses them.
+
+    Parameters
+    ----------
+    alphas : array-like
+        Scale lengths of the exponential kernels in pixels.
+    kern_size : int, optional
+        Size of the kernels. If None, each kernel extends
+        to 4 scale lengths from its center.
+    tile_size : int, optional
+        Size of the overlap-add tiles. Each tile is padded
+        to a fast FFT length of tile_size + kern_size - 1.
+    n_jobs : int, optional
+        Number of scales to filter in parallel (threads).
+    kern_kws : dict, optional
+        Keyword args for kernels.exponential.
+    """
+
+    def __init__(self, alphas, kern_size=None, tile_size=1024, n_jobs=1,
+                 kern_kws={}):
+        self.alphas = np.atleast_1d(alphas).astype(float)
+        self.tile_size = tile_size
+        self.n_jobs = n_jobs
+        self.kernels = []
+        for alpha in self.alphas:
+            size = kern_size if kern_size else 2*int(np.ceil(4*alpha)) + 1
+            self.kernels.append(kernels.exponential(alpha, size, **kern_kws))
+        self._kern_ffts = {}
+
+    def _kernel_fft(self, idx, fft_shape, squared=False):
+        key = (idx, fft_shape, squared)
+        if key not in self._kern_ffts:
+            kern = self.kernels[idx]**2 if squared else self.kernels[idx]
+            self._kern_ffts[key] = np.fft.rfft2(kern, fft_shape)
+        return self._kern_ffts[key]
+
+    def convolve(self, img, idx, squared=False):
+        """
+        Convolve image with one of the kernels using overlap-add.
+
+        Parameters
+        ----------
+        img : 2D ndarray
+            The image, where NaNs must already be replaced.
+        idx : int
+            Index of the kernel.
+        squared : bool, optional
+            If True, convolve with the squared kernel (used
+            to propagate the variance).
+
+        Returns
+        -------
+        conv : 2D ndarray
+            Convolved image with the same shape as img. Pixels
+            outside the image are taken to be zero.
+        """
+        from scipy.fftpack import next_fast_len
+        ny, nx = img.shape
+        ksize = self.kernels[idx].shape[0]
+        ty, tx = min(self.tile_size, ny), min(self.tile_size, nx)
+        fft_shape = (next_fast_len(ty + ksize - 1),
+                     next_fast_len(tx + ksize - 1))
+        kern_fft = self._kernel_fft(idx, fft_shape, squared)
+
+        conv = np.zeros((ny + ksize - 1, nx + ksize - 1))
+        for y0 in range(0, ny, ty):
+            for x0 in range(0, nx, tx):
+                tile = img[y0:y0 + ty, x0:x0 + tx]
+                by, bx = tile.shape
+                tile_conv = np.fft.irfft2(
+                    np.fft.rfft2(tile, fft_shape)*kern_fft, fft_shape)
+                conv[y0:y0 + by + ksize - 1, x0:x0 + bx + ksize - 1] += \
+                    tile_conv[:by + ksize - 1, :bx + ksize - 1]
+        pad = ksize//2
+        return conv[pad:pad + ny, pad:pad + nx]
+
+    def significance(self, img, idx, var):
+        """
+        Significance map for one scale: the filtered image divided
+        by the propagated noise. Pixels where var is zero do not
+        contribute.
+        """
+        num = self.convolve(img, idx)
+        if np.isscalar(var):
+            noise = np.sqrt(var*(self.kernels[idx]**2).sum())
+        else:
+            noise = np.sqrt(np.clip(self.convolve(var, idx, True), 0, None))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sig = num/noise
+        return sig
+
+    def __call__(self, img, var=None, mask=None):
+        """
+        Filter image with all the kernels.
+
+        Parameters
+        ----------
+        img : 2D ndarray
+            Background-subtracted image.
+        var : 2D ndarray or float, optional
+            Variance image or a single variance. If None, the
+            variance is estimated from the MAD of the image.
+        mask : 2D ndarray, optional
+            Pixels to exclude (nonzero values are masked).
+            NaN pixels are also excluded.
+
+        Returns
+        -------
+        sig : 2D ndarray
+            Maximum significance over all scales.
+        alpha : 2D ndarray
+            Scale length of the kernel with the maximum
+            significance at each pixel.
+        """
+        img = np.asarray(img, dtype=float)
+        bad = np.isnan(img)
+        if mask is not None:
+            bad |= np.asarray(mask).astype(bool)
+        if var is None:
+            good = img[~bad]
+            var = (1.4826*np.median(np.abs(good - np.median(good))))**2
+        if bad.any():
+            img = np.where(bad, 0.0, img)
+            var = np.where(bad, 0.0, var)
+
+        scales = range(len(self.kernels))
+        pool = None
+        if self.n_jobs==1:
+            sig_maps = map(lambda idx: self.significance(img, idx, var),
+                           scales)
+        else:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(self.n_jobs)
+            sig_maps = pool.imap(lambda idx: self.significance(img, idx, var),
+                                 scales)
+
+        sig = np.full(img.shape, -np.inf)
+        alpha = np.zeros(img.shape)
+        try:
+            for idx, sig_map in enumerate(sig_maps):
+                better = sig_map > sig
+                sig[better] = sig_map[better]
+                alpha[better] = self.alphas[idx]
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        sig[bad] = np.nan
+
+        return sig, alpha
+
+
+def lsb_significance(img, alphas, var=None, mask=None, **kwargs):
+    """
+    Maximum matched-filter significance of diffuse sources over a
+    set of exponential scale lengths. See MultiScaleFilter for
+    details; build a MultiScaleFilter directly to reuse the kernel
+    transforms across many patches.
+
+    Parameters
+    ----------
+    img : 2D ndarray
+        Background-subtracted image.
+    alphas : array-like
+        Scale lengths of the exponential kernels in pixels.
+    var : 2D ndarray or float, optional
+        Variance image or a single variance.
+    mask : 2D ndarray, optional
+        Pixels to exclude (nonzero values are masked).
+    kwargs : dict, optional
+        Keyword args for MultiScaleFilter.
+
+    Returns
+    -------
+    sig : 2D ndarray
+        Maximum significance over all scales.
+    alpha : 2D ndarray
+        Scale length with the maximum significance.
+    """
+    return MultiScaleFilter(alphas, **kwargs)(img, var, mask)
@@ -1,9 +1,23 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import warnings
+from functools import partial
+
 import numpy as np
 
-__all__ = ['rmedian']
+try:
+    from numba import njit
+    _jit = njit(nogil=True)
+    _HAS_NUMBA = True
+except ImportError:
+    _jit = lambda func: func
+    _HAS_NUMBA = False
+
+__all__ = ['rmedian', 'rmedian_error']
+
+ENGINES = ['footprint', 'histogram']
+
 
 def _ring(r_inner, r_outer, dtype=np.int, invert=False):
     """
@@ -38,7 +52,458 @@ def _ring(r_inner, r_outer, dtype=np.int, invert=False):
     return fp
 
 
-def rmedian(data, r_inner, r_outer, **kwargs):
+def _offsets(fp):
+    """
+    Pixel offsets of a footprint with respect to its center.
+
+    Returns the offsets of the full footprint followed by the
+    offsets of the pixels that enter the footprint when it
+    slides one pixel along +x and +y and the offsets of the
+    pixels that leave it. The added offsets are relative to
+    the new center and the removed offsets to the old one.
+    Sliding along -x swaps the +x entering and leaving sets.
+    """
+    fp = np.asarray(fp).astype(bool)
+    cy, cx = fp.shape[0]//2, fp.shape[1]//2
+    padded = np.pad(fp, 1, mode='constant')
+
+    def _where(arr):
+        dy, dx = np.nonzero(arr)
+        return (dy - cy).astype(np.int64), (dx - cx).astype(np.int64)
+
+    full = _where(fp)
+    add_x = _where(fp & ~padded[1:-1, 2:])
+    rem_x = _where(fp & ~padded[1:-1, :-2])
+    add_y = _where(fp & ~padded[2:, 1:-1])
+    rem_y = _where(fp & ~padded[:-2, 1:-1])
+    return full, add_x, rem_x, add_y, rem_y
+
+
+@_jit
+def _fenwick_update(tree, idx, delta):
+    idx += 1
+    while idx < tree.shape[0]:
+        tree[idx] += delta
+        idx += idx & -idx
+
+
+@_jit
+def _fenwick_select(tree, k, top):
+    """
+    Return the index of the k-th (0-based) smallest
+    element stored in the Fenwick tree.
+    """
+    pos = 0
+    step = top
+    while step > 0:
+        nxt = pos + step
+        if nxt < tree.shape[0] and tree[nxt] <= k:
+            pos = nxt
+            k -= tree[nxt]
+        step //= 2
+    return pos
+
+
+@_jit
+def _shift_window(tree, ranks, cy, cx, add_dy, add_dx, oy, ox, rem_dy, rem_dx):
+    """
+    Move the window from (oy, ox) to (cy, cx) and return
+    the change in the number of valid pixels.
+    """
+    dcount = 0
+    for i in range(add_dy.shape[0]):
+        r = ranks[cy + add_dy[i], cx + add_dx[i]]
+        if r >= 0:
+            _fenwick_update(tree, r, 1)
+            dcount += 1
+    for i in range(rem_dy.shape[0]):
+        r = ranks[oy + rem_dy[i], ox + rem_dx[i]]
+        if r >= 0:
+            _fenwick_update(tree, r, -1)
+            dcount -= 1
+    return dcount
+
+
+@_jit
+def _slide_median(ranks, sorted_vals, out, cy0, cx0, fp_dy, fp_dx,
+                  add_x_dy, add_x_dx, rem_x_dy, rem_x_dx,
+                  add_y_dy, add_y_dx, rem_y_dy, rem_y_dx):
+    """
+    Snake the footprint across the image, keeping the ranks
+    of the pixels inside it in a Fenwick tree. Only the pixels
+    on the leading and trailing edges are touched per step.
+    """
+    ny, nx = out.shape
+    n_ranks = sorted_vals.shape[0]
+    tree = np.zeros(n_ranks + 1, dtype=np.int32)
+    top = 1
+    while top*2 <= n_ranks:
+        top *= 2
+
+    count = 0
+    for i in range(fp_dy.shape[0]):
+        r = ranks[cy0 + fp_dy[i], cx0 + fp_dx[i]]
+        if r >= 0:
+            _fenwick_update(tree, r, 1)
+            count += 1
+
+    x = 0
+    for y in range(ny):
+        cy = cy0 + y
+        if y > 0:
+            count += _shift_window(tree, ranks, cy, cx0 + x, add_y_dy,
+                                   add_y_dx, cy - 1, cx0 + x,
+                                   rem_y_dy, rem_y_dx)
+        for step in range(nx):
+            if step > 0:
+                if y%2 == 0:
+                    x += 1
+                    count += _shift_window(tree, ranks, cy, cx0 + x,
+                                           add_x_dy, add_x_dx, cy,
+                                           cx0 + x - 1, rem_x_dy, rem_x_dx)
+                else:
+                    x -= 1
+                    count += _shift_window(tree, ranks, cy, cx0 + x,
+                                           rem_x_dy, rem_x_dx, cy,
+                                           cx0 + x + 1, add_x_dy, add_x_dx)
+            if count > 0:
+                out[y, x] = sorted_vals[_fenwick_select(tree, count//2, top)]
+            else:
+                out[y, x] = np.nan
+    return out
+
+
+def _histogram_median(padded, fp, invalid=None):
+    """
+    Median filter a padded image with a sliding order-statistic
+    window. The cost per pixel scales with the perimeter of the
+    footprint rather than its area.
+
+    Parameters
+    ----------
+    padded : 2D ndarray
+        Image padded by half the footprint size on each side.
+    fp : 2D ndarray
+        Filter footprint with odd dimensions.
+    invalid : 2D bool ndarray, optional
+        Pixels to exclude from the median (same shape as padded).
+        NaN pixels are always excluded.
+
+    Returns
+    -------
+    filtered_data : 2D ndarray
+        The filtered image without the padding. Pixels whose
+        footprint contains no valid pixels are set to NaN.
+    """
+    cy, cx = fp.shape[0]//2, fp.shape[1]//2
+    shape = (padded.shape[0] - 2*cy, padded.shape[1] - 2*cx)
+
+    valid = ~np.isnan(padded) if padded.dtype.kind=='f' else \
+            np.ones(padded.shape, dtype=bool)
+    if invalid is not None:
+        valid &= ~invalid
+    vals = padded[valid]
+    order = np.argsort(vals, kind='mergesort')
+    rank_dtype = np.int32 if vals.size < 2**31 else np.int64
+    ranks = np.full(padded.shape, -1, dtype=rank_dtype)
+    flat_ranks = np.empty(vals.size, dtype=rank_dtype)
+    flat_ranks[order] = np.arange(vals.size, dtype=rank_dtype)
+    ranks[valid] = flat_ranks
+    sorted_vals = vals[order]
+    del vals, order, flat_ranks
+
+    out_dtype = padded.dtype
+    if (invalid is not None) and (out_dtype.kind!='f'):
+        out_dtype = np.float64
+    out = np.empty(shape, dtype=out_dtype)
+    full, add_x, rem_x, add_y, rem_y = _offsets(fp)
+    return _slide_median(ranks, sorted_vals, out, cy, cx, full[0], full[1],
+                         add_x[0], add_x[1], rem_x[0], rem_x[1],
+                         add_y[0], add_y[1], rem_y[0], rem_y[1])
+
+
+def _reflect(idx, n):
+    """
+    Map indices into an axis of length n, where out-of-bounds
+    indices are mirrored like scipy's 'reflect' boundary mode
+    (d c b a | a b c d | d c b a).
+    """
+    idx = np.asarray(idx) % (2*n)
+    return np.where(idx >= n, 2*n - 1 - idx, idx)
+
+
+def _tile_bounds(shape, tile_size):
+    """
+    Generate the (y0, y1, x0, x1) bounds of the tiles.
+    """
+    for y0 in range(0, shape[0], tile_size):
+        for x0 in range(0, shape[1], tile_size):
+            yield (y0, min(y0 + tile_size, shape[0]),
+                   x0, min(x0 + tile_size, shape[1]))
+
+
+def _tile_pixel_bytes(dtype, engine):
+    """
+    Peak bytes per pixel of a tile (with its halo) while it is
+    filtered: the tile and its filtered copy for the footprint
+    engine, plus the sort order, ranks, and Fenwick tree for the
+    histogram engine (measured).
+    """
+    itemsize = np.dtype(dtype).itemsize
+    return 2*itemsize if engine=='footprint' else 3*itemsize + 18
+
+
+def _tile_size(max_memory, pad, n_jobs, pixel_bytes):
+    """
+    Largest tile size for which n_jobs tiles with halos of pad
+    pixels fit in max_memory bytes.
+    """
+    side = int(np.sqrt(max_memory/(n_jobs*pixel_bytes))) - 2*pad
+    assert side > 0, 'max_memory is too small for the ring'
+    return side
+
+
+_worker_args = {}
+
+
+def _init_tile_worker(args):
+    """
+    Keep the shared arguments in a worker process of a process
+    pool, so that the full image is sent once per worker rather
+    than once per task.
+    """
+    _worker_args['args'] = args
+
+
+def _process_task(func, task):
+    return func(_worker_args['args'], task)
+
+
+def _filter_tile(args, bounds):
+    """
+    Ring-median filter a single tile with a halo of r_outer
+    pixels, which is cut from the full image in args, a
+    (data, mask, fp, engine) tuple.
+    """
+    data, mask, fp, engine = args
+    y0, y1, x0, x1 = bounds
+    pad = fp.shape[0]//2
+    rows = _reflect(np.arange(y0 - pad, y1 + pad), data.shape[0])
+    cols = _reflect(np.arange(x0 - pad, x1 + pad), data.shape[1])
+    tile = data[np.ix_(rows, cols)]
+    if engine=='footprint':
+        from scipy.ndimage import median_filter
+        filtered = median_filter(tile, footprint=fp)
+        filtered = filtered[pad:pad + y1 - y0, pad:pad + x1 - x0]
+    else:
+        tile_mask = None if mask is None else mask[np.ix_(rows, cols)]
+        filtered = _histogram_median(tile, fp, tile_mask)
+    return bounds, filtered
+
+
+def _filter_stamps(args, bounds):
+    """
+    Ring-median filter the stamps i0 to i1 of the stamp cube
+    in args, a (data, mask, fp, engine) tuple.
+    """
+    data, mask, fp, engine = args
+    i0, i1 = bounds
+    if engine=='footprint':
+        from scipy.ndimage import median_filter
+        filtered = median_filter(data[i0:i1], footprint=fp[None])
+    else:
+        pad = fp.shape[0]//2
+        rows = _reflect(np.arange(-pad, data.shape[1] + pad), data.shape[1])
+        cols = _reflect(np.arange(-pad, data.shape[2] + pad), data.shape[2])
+        filtered = []
+        for i in range(i0, i1):
+            stamp = data[i][np.ix_(rows, cols)]
+            stamp_mask = None if mask is None else mask[i][np.ix_(rows, cols)]
+            filtered.append(_histogram_median(stamp, fp, stamp_mask))
+        filtered = np.array(filtered)
+    return bounds, filtered
+
+
+def _map_tiles(func, tasks, args, n_jobs, use_processes):
+    """
+    Map func(args, task) over the tasks in a thread or process 
+    pool and yield the results in the order they finish. Threads 
+    get args bound to func, so concurrent calls do not share any 
+    state; worker processes get args once through the pool 
+    initializer.
+    """
+    if n_jobs==1:
+        for task in tasks:
+            yield func(args, task)
+        return
+    if use_processes:
+        from multiprocessing import Pool
+        pool = Pool(n_jobs, _init_tile_worker, (args,))
+        func = partial(_process_task, func)
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(n_jobs)
+        func = partial(func, args)
+    try:
+        for result in pool.imap_unordered(func, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _output_dtype(data, engine, mask):
+    if (engine=='histogram') and (mask is not None) and \
+       (data.dtype.kind!='f'):
+        return np.float64
+    return data.dtype
+
+
+def _tiled_rmedian(data, fp, engine, mask, tile_size, n_jobs, use_processes):
+    """
+    Filter the image tile by tile and stitch the tiles into
+    the output array. Only the tile bounds are sent through
+    the pool, so the number of tiles held in memory at once
+    is set by n_jobs.
+    """
+    filtered_data = np.empty(data.shape, _output_dtype(data, engine, mask))
+    tiles = _tile_bounds(data.shape, tile_size)
+    results = _map_tiles(_filter_tile, tiles, (data, mask, fp, engine),
+                         n_jobs, use_processes)
+    for (y0, y1, x0, x1), filtered in results:
+        filtered_data[y0:y1, x0:x1] = filtered
+    return filtered_data
+
+
+def _stack_rmedian(data, fp, engine, mask, n_jobs, use_processes):
+    """
+    Filter a cube of equal-size stamps with a single footprint.
+    The stamps are split into chunks, which are filtered in one
+    call each (for the footprint engine) and in parallel if
+    n_jobs > 1.
+    """
+    filtered_data = np.empty(data.shape, _output_dtype(data, engine, mask))
+    n_chunks = min(len(data), 4*n_jobs if n_jobs > 1 else 1)
+    edges = np.linspace(0, len(data), n_chunks + 1).astype(int)
+    chunks = zip(edges[:-1], edges[1:])
+    results = _map_tiles(_filter_stamps, chunks, (data, mask, fp, engine),
+                         n_jobs, use_processes)
+    for (i0, i1), filtered in results:
+        filtered_data[i0:i1] = filtered
+    return filtered_data
+
+
+def _block_reduce(data, factor, mask=None):
+    """
+    Average the image in factor x factor blocks, ignoring NaN
+    and masked pixels. The image is mirrored at its upper edges
+    to a multiple of factor.
+    """
+    ny, nx = data.shape
+    pad = ((0, -ny%factor), (0, -nx%factor))
+    data = np.pad(data, pad, mode='symmetric')
+    valid = ~np.isnan(data) if data.dtype.kind=='f' else \
+            np.ones(data.shape, dtype=bool)
+    if mask is not None:
+        valid &= ~np.pad(mask, pad, mode='symmetric')
+    shape = (data.shape[0]//factor, factor, data.shape[1]//factor, factor)
+    total = np.where(valid, data, 0).reshape(shape).sum(axis=(1, 3))
+    count = valid.reshape(shape).sum(axis=(1, 3))
+    with np.errstate(invalid='ignore'):
+        coarse = total/count
+    return coarse.astype(np.result_type(data.dtype, np.float32))
+
+
+def _upsample(coarse, factor, shape):
+    """
+    Bilinearly interpolate a block-reduced image back to the
+    full-resolution shape, where coarse pixel i is centered on
+    full-resolution pixel factor*i + (factor - 1)/2.
+    """
+    def _weights(n_fine, n_coarse):
+        x = (np.arange(n_fine) + 0.5)/factor - 0.5
+        x = np.clip(x, 0, n_coarse - 1)
+        i0 = np.minimum(np.floor(x).astype(int), max(n_coarse - 2, 0))
+        i1 = np.minimum(i0 + 1, n_coarse - 1)
+        return i0, i1, (x - i0).astype(coarse.dtype)
+
+    i0, i1, w = _weights(shape[0], coarse.shape[0])
+    img = coarse[i0]*(1 - w[:, None]) + coarse[i1]*w[:, None]
+    i0, i1, w = _weights(shape[1], coarse.shape[1])
+    return img[:, i0]*(1 - w) + img[:, i1]*w
+
+
+def rmedian_error(data, r_inner, r_outer, approx_factor, n_samples=1000,
+                  mask=None, filtered_data=None, random_state=None, **kwargs):
+    """
+    Measure the error of the approximate (block-reduced) ring median
+    against exact ring medians computed at randomly sampled pixels.
+
+    Parameters
+    ----------
+    data : 2D ndarray
+        Input image array.
+    r_inner, r_outer : int
+        The inner and outer radii of the ring in pixels.
+    approx_factor : int
+        Block-reduction factor of the approximate mode.
+    n_samples : int, optional
+        Number of pixels at which to compute the exact median.
+    mask : ndarray, optional
+        Masked pixels (see rmedian).
+    filtered_data : 2D ndarray, optional
+        Output of the approximate mode, if it has already been
+        computed. Otherwise, it will be computed here.
+    random_state : int or np.random.RandomState, optional
+        Seed or random state for selecting the sampled pixels.
+    kwargs : dict, optional
+        Keyword args for rmedian.
+
+    Returns
+    -------
+    error : dict
+        The 'median', 'p95', and 'max' absolute error of the
+        approximate mode at the sampled pixels, and 'sigma',
+        the MAD-based standard deviation of the image, so that
+        the errors can be quoted in units of the image noise.
+    """
+    data = np.asarray(data)
+    if filtered_data is None:
+        filtered_data = rmedian(data, r_inner, r_outer, mask=mask,
+                                approx_factor=approx_factor, **kwargs)
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+
+    fp = _ring(r_inner, r_outer, invert=kwargs.get('invert', False))
+    (dy, dx), _, _, _, _ = _offsets(fp)
+    y = random_state.randint(0, data.shape[0], n_samples)
+    x = random_state.randint(0, data.shape[1], n_samples)
+    rows = _reflect(y[:, None] + dy, data.shape[0])
+    cols = _reflect(x[:, None] + dx, data.shape[1])
+
+    ring = data[rows, cols].astype(np.float64)
+    invalid = np.isnan(ring)
+    if mask is not None:
+        invalid |= np.asarray(mask).astype(bool)[rows, cols]
+    ring[invalid] = np.inf
+    ring.sort(axis=1)
+    k = (~invalid).sum(axis=1)//2
+    exact = ring[np.arange(n_samples), k]
+
+    err = np.abs(filtered_data[y, x] - exact)
+    err = err[np.isfinite(err)]
+    finite = data[np.isfinite(data)]
+    sigma = 1.4826*np.median(np.abs(finite - np.median(finite)))
+    error = {'median': np.median(err),
+             'p95': np.percentile(err, 95),
+             'max': err.max(),
+             'sigma': sigma}
+    return error
+
+
+def rmedian(data, r_inner, r_outer, engine='footprint', mask=None,
+            tile_size=None, n_jobs=1, use_processes=False,
+            approx_factor=None, max_memory=None, **kwargs):
     """
     Median filter image with a ring footprint. This
     function produces results similar to the IRAF 
@@ -47,14 +512,109 @@ def rmedian(data, r_inner, r_outer, **kwargs):
     Parameters
     ----------
     data : ndarray
-        Input image array 
+        Input image array or a cube of equal-size images
+        (N x H x W), which are filtered independently with a
+        single footprint.
     r_inner : int
         The inner radius of the ring in pixels.
     r_outer : int
         The outer radius of the ring in pixels.
+    engine : str, optional
+        'footprint' passes the ring to scipy.ndimage.median_filter,
+        whose cost grows with the area of the ring. 'histogram'
+        slides a running order statistic across the image, so the
+        cost grows with the ring perimeter; it gives the same output
+        as 'footprint'. It is only faster when compiled with numba:
+        without numba, it falls back to 'footprint' with a warning, 
+        except for masks and NaN pixels, which only it handles (and
+        which then run in pure python, with a warning).
+    mask : ndarray, optional
+        Pixels to exclude from the median, where nonzero values
+        are masked. NaN pixels are also excluded. Pixels with no
+        valid pixels within their ring are set to NaN. Requires
+        the 'histogram' engine (and numba to be fast).
+    tile_size : int, optional
+        If not None, filter the image in tiles of this size (with
+        halos of r_outer pixels) and stitch them together. The
+        output is identical to the untiled call. Besides the input
+        and output images, the peak memory is that of the n_jobs 
+        tiles filtered at once, n_jobs*B*(tile_size + 2*r_outer)^2
+        bytes, where B is twice the item size of data for the 
+        footprint engine and three times the item size plus 18 for
+        the histogram engine (e.g., 8 and 30 for float32). With 
+        use_processes, each worker also holds a copy of the image 
+        (and mask). Only for 2D images.
+    n_jobs : int, optional
+        Number of tiles (or chunks of a stamp cube) to filter
+        in parallel.
+    use_processes : bool, optional
+        If True, use a process pool instead of a thread pool. The
+        histogram engine releases the GIL when compiled with numba,
+        but the footprint engine needs processes to run in parallel.
+    approx_factor : int, optional
+        If greater than 1, run in approximate mode: average the image
+        in approx_factor x approx_factor blocks, ring-median filter it
+        with radii scaled down by approx_factor, and bilinearly
+        interpolate the result back to full resolution. The cost drops
+        by roughly approx_factor^4. Use rmedian_error to measure the
+        error against the exact filter. Only for 2D images.
+    max_memory : float, optional
+        If given (and tile_size is None), filter in the largest tiles
+        whose peak memory (see tile_size) is below max_memory bytes.
+
+    Returns
+    -------
+    filtered_data : ndarray
+        The ring-median filtered image.
     """
-    from scipy.ndimage import median_filter
+    assert engine in ENGINES, 'engine must be one of '+str(ENGINES)
+    data = np.asarray(data)
+    if mask is not None:
+        mask = np.asarray(mask).astype(bool)
+
+    if (approx_factor is not None) and (approx_factor > 1):
+        assert data.ndim==2, 'approx_factor is only for 2D images'
+        coarse = _block_reduce(data, approx_factor, mask)
+        if np.isnan(coarse).any():
+            engine = 'histogram'
+        coarse = rmedian(coarse, r_inner/approx_factor,
+                         r_outer/approx_factor, engine, None,
+                         tile_size, n_jobs, use_processes, 
+                         max_memory=max_memory, **kwargs)
+        return _upsample(coarse, approx_factor, data.shape)
 
+    assert (engine=='histogram') or (mask is None),\
+        'mask requires the histogram engine'
+    if (engine=='histogram') and not _HAS_NUMBA:
+        if (mask is None) and not (data.dtype.kind=='f' and 
+                                   np.isnan(data).any()):
+            warnings.warn('numba is not installed, so the histogram '
+                          'engine falls back to the footprint engine')
+            engine = 'footprint'
+        else:
+            warnings.warn('numba is not installed, so the histogram '
+                          'engine runs in pure python, which is slower '
+                          'than the footprint engine')
     fp = _ring(r_inner, r_outer, **kwargs)
-    filtered_data = median_filter(data, footprint=fp)
+    if (max_memory is not None) and (tile_size is None):
+        assert data.ndim==2, 'max_memory is only for 2D images'
+        tile_size = _tile_size(max_memory, fp.shape[0]//2, n_jobs, 
+                               _tile_pixel_bytes(data.dtype, engine))
+
+    if data.ndim==3:
+        assert tile_size is None, 'tile_size is only for 2D images'
+        filtered_data = _stack_rmedian(
+            data, fp, engine, mask, n_jobs, use_processes)
+    elif tile_size is not None:
+        filtered_data = _tiled_rmedian(
+            data, fp, engine, mask, tile_size, n_jobs, use_processes)
+    elif engine=='footprint':
+        from scipy.ndimage import median_filter
+        filtered_data = median_filter(data, footprint=fp)
+    else:
+        pad = fp.shape[0]//2
+        padded = np.pad(data, pad, mode='symmetric')
+        if mask is not None:
+            mask = np.pad(mask, pad, mode='symmetric')
+        filtered_data = _histogram_median(padded, fp, mask)
     return filtered_data
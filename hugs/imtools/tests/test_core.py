@@ -0,0 +1,79 @@
+from __future__ import division, print_function
+
+import numpy as np
+from astropy.io import fits
+from ..core import LazyFits
+
+
+def _write_coadd(fn):
+    np.random.seed(8)
+    img = np.random.normal(size=(20, 30)).astype('>f4')
+    mask = np.arange(600, dtype='>i4').reshape(20, 30)
+    var = np.full((20, 30), 4.0, dtype='>f4')
+    hdus = [fits.PrimaryHDU()] + [fits.ImageHDU(d) for d in [img, mask, var]]
+    fits.HDUList(hdus).writeto(fn)
+    return img, mask, var
+
+
+def test_lazy_fits(tmpdir):
+
+    fn = str(tmpdir.join('coadd.fits'))
+    img, mask, var = _write_coadd(fn)
+
+    for memmap in [True, False]:
+        with LazyFits(fn, memmap=memmap) as f:
+            assert f.img.dtype.isnative
+            assert np.array_equal(f.img, img)
+            assert f.get(1) is f.img
+            assert np.array_equal(f.get(1), img)
+            assert np.array_equal(f.mask, mask)
+            assert np.array_equal(f.var, var)
+            # the HDU data and sections are unchanged by get
+            assert np.array_equal(f.hdulist[1].data, img)
+            assert np.array_equal(f.section(1)[2:6, 3:9], img[2:6, 3:9])
+            assert np.array_equal(f.section(2)[5:7, :], mask[5:7, :])
+        assert f._hdulist is None
+        assert np.array_equal(f.img, img)
+
+
+def test_write_fits(tmpdir):
+
+    from ..core import write_fits
+
+    np.random.seed(9)
+    img = np.random.normal(size=(40, 50)).astype('f4')
+    mask = (np.random.random(img.shape) < 0.2).astype(np.uint8)
+    var = np.full(img.shape, 2.0, dtype='f4')
+
+    fn = str(tmpdir.join('single.fits'))
+    write_fits(fn, img)
+    assert np.array_equal(fits.getdata(fn, 0), img)
+
+    fn = str(tmpdir.join('multi.fits'))
+    write_fits(fn, [img, mask, var])
+    with LazyFits(fn) as f:
+        assert np.array_equal(f.img, img)
+        assert np.array_equal(f.mask, mask)
+        assert np.array_equal(f.var, var)
+
+    # compressed single images are in extension 1
+    fn = str(tmpdir.join('mask-comp.fits'))
+    write_fits(fn, mask, compress='PLIO_1', tile_shape=(8, 50))
+    assert fits.getheader(fn, 0)['NAXIS']==0
+    assert np.array_equal(fits.getdata(fn), mask)
+    with LazyFits(fn, multi_ext=False) as f:
+        assert np.array_equal(f.img, mask)
+        assert np.array_equal(f.section(1)[10:20, 5:9], mask[10:20, 5:9])
+
+    fn = str(tmpdir.join('multi-comp.fits'))
+    write_fits(fn, [img, mask, var], compress='GZIP_1', quantize_level=0)
+    with LazyFits(fn) as f:
+        assert np.array_equal(f.section(1)[3:11, 30:45], img[3:11, 30:45])
+        assert np.array_equal(f.img, img)
+        assert np.array_equal(f.mask, mask)
+
+    # lossy compression of floats is quantized to ~sigma/16
+    fn = str(tmpdir.join('img-rice.fits'))
+    write_fits(fn, img, compress='RICE_1')
+    with LazyFits(fn, multi_ext=False) as f:
+        assert np.abs(f.img - img).max() < 0.1
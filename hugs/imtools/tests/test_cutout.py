@@ -0,0 +1,68 @@
+from __future__ import division, print_function
+
+import numpy as np
+from astropy.io import fits
+from astropy.nddata import Cutout2D
+from ..cutout import cutouts, cutouts_from_fits
+
+# interior stamps, including half-pixel centers, and edge stamps
+COORDS = np.array([[40.0, 30.0], [20.5, 33.5], [57.3, 41.8],
+                   [2.0, 3.0], [75.0, 10.0], [40.0, 58.6]])
+
+
+def _image(shape=(60, 80), dtype='f4'):
+    np.random.seed(7)
+    return np.random.normal(size=shape).astype(dtype)
+
+
+def _expected(data, size):
+    return [Cutout2D(data, tuple(c), size, mode='partial',
+                     fill_value=np.nan).data for c in COORDS]
+
+
+def test_cutouts():
+
+    data = _image()
+
+    for size in [11, (9, 14)]:
+        stamps, origins = cutouts(data, COORDS, size=size)
+        for stamp, exp in zip(stamps, _expected(data, size)):
+            assert np.array_equal(stamp, exp, equal_nan=True)
+        x0, y0 = origins[0]
+        ny, nx = stamps.shape[1:]
+        assert np.array_equal(stamps[0], data[y0:y0 + ny, x0:x0 + nx])
+
+    stamps, _ = cutouts(data, COORDS, size=11, stack=False)
+    assert np.shares_memory(stamps[0], data)
+    assert not np.shares_memory(stamps[3], data)
+    for stamp, exp in zip(stamps, _expected(data, 11)):
+        assert np.array_equal(stamp, exp, equal_nan=True)
+
+
+def test_cutouts_from_fits(tmpdir):
+
+    data = _image()
+    mask = (np.arange(data.size).reshape(data.shape) % 7).astype('i4')
+    expected = _expected(data, 15)
+
+    fn = str(tmpdir.join('patch.fits'))
+    hdus = [fits.PrimaryHDU(), fits.ImageHDU(data), fits.ImageHDU(mask)]
+    fits.HDUList(hdus).writeto(fn)
+
+    comp_fn = str(tmpdir.join('patch-comp.fits'))
+    hdus = [fits.PrimaryHDU(),
+            fits.CompImageHDU(data, compression_type='GZIP_1',
+                              quantize_level=0.0),
+            fits.CompImageHDU(mask, compression_type='RICE_1')]
+    fits.HDUList(hdus).writeto(comp_fn)
+
+    for f in [fn, comp_fn]:
+        (img, msk), origins = cutouts_from_fits(f, COORDS, size=15,
+                                                exts=[1, 2],
+                                                pixel_coords=True)
+        assert img.dtype.isnative
+        for stamp, exp in zip(img, expected):
+            assert np.array_equal(stamp, exp, equal_nan=True)
+        x0, y0 = origins[0]
+        assert np.array_equal(msk[0], mask[y0:y0 + 15, x0:x0 + 15])
+        assert (msk[3][np.isnan(img[3])]==256).all()
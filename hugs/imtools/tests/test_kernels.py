@@ -0,0 +1,31 @@
+from __future__ import division, print_function
+
+import numpy as np
+from .. import kernels
+
+
+def test_exponential():
+
+    from astropy.convolution import discretize_model
+
+    alpha, size = 4.0, 31
+    x_range = (-(size - 1) // 2, (size - 1) // 2 + 1)
+    model = lambda x, y: np.exp(-np.sqrt(x**2 + y**2)/alpha)
+
+    for mode in ['center', 'linear_interp', 'oversample']:
+        kern = kernels.exponential(alpha, size, norm=False, mode=mode)
+        astropy_kern = discretize_model(model, x_range, x_range, mode=mode)
+        assert np.allclose(kern, astropy_kern, rtol=1e-12, atol=0)
+
+def test_kernel_bank(tmpdir):
+
+    bank = kernels.KernelBank(maxsize=2, cache_dir=str(tmpdir))
+
+    kern = bank.get(2.0, 11, mode='integrate')
+    kern *= 2
+    assert np.isclose(bank.get(2.0, 11, mode='integrate').sum(), 1.0)
+
+    bank.get(3.0, 11)
+    bank.get(4.0, 11)
+    assert len(bank)==2
+    assert len(tmpdir.listdir())==3
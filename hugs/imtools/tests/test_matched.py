@@ -0,0 +1,41 @@
+from __future__ import division, print_function
+
+import threading
+import numpy as np
+import pytest
+from ..matched import MultiScaleFilter
+
+
+def test_overlap_add():
+
+    from scipy.signal import fftconvolve
+
+    np.random.seed(6)
+    img = np.random.normal(size=(130, 97))
+    msf = MultiScaleFilter([1.5, 4.0], tile_size=40)
+
+    for idx, kern in enumerate(msf.kernels):
+        conv = msf.convolve(img, idx)
+        assert np.allclose(conv, fftconvolve(img, kern, mode='same'))
+
+def test_significance():
+
+    np.random.seed(7)
+    img = np.random.normal(size=(128, 128))
+    img[40:60, 40:60] += 1.0
+
+    sig, alpha = MultiScaleFilter([1.0, 3.0, 6.0], n_jobs=2)(img, 1.0)
+
+    assert sig[50, 50] > 5
+    assert alpha[50, 50] > 1.0
+
+def test_pool_closed_on_error(monkeypatch):
+
+    def _fail(self, img, idx, var):
+        raise ValueError('bad scale')
+
+    monkeypatch.setattr(MultiScaleFilter, 'significance', _fail)
+    num_threads = threading.active_count()
+    with pytest.raises(ValueError):
+        MultiScaleFilter([1.0, 3.0], n_jobs=2)(np.zeros((32, 32)), 1.0)
+    assert threading.active_count()==num_threads
@@ -0,0 +1,125 @@
+from __future__ import division, print_function
+
+import sys
+import warnings
+import numpy as np
+from ..rmedian import rmedian, rmedian_error, _ring
+
+_module = sys.modules[rmedian.__module__]
+
+
+def _use_histogram(monkeypatch):
+    # run the histogram engine even if numba is not installed
+    monkeypatch.setattr(_module, '_HAS_NUMBA', True)
+
+
+def test_histogram_engine(monkeypatch):
+
+    _use_histogram(monkeypatch)
+
+    np.random.seed(1)
+    data = np.random.normal(size=(37, 29)).astype('f4')
+    data[10, 10] = data[11, 12]
+
+    footprint = rmedian(data, 2, 6)
+    histogram = rmedian(data, 2, 6, engine='histogram')
+
+    assert histogram.dtype==footprint.dtype
+    assert np.array_equal(histogram, footprint)
+
+def test_histogram_engine_mask():
+
+    np.random.seed(2)
+    data = np.random.normal(size=(21, 21))
+    mask = np.random.random(data.shape) < 0.3
+    data[0, 0] = np.nan
+
+    filtered = rmedian(data, 1, 4, engine='histogram', mask=mask)
+
+    fp = _ring(1, 4).astype(bool)
+    padded = np.pad(data, 4, mode='symmetric')
+    bad = np.pad(mask, 4, mode='symmetric') | np.isnan(padded)
+    for i, j in [(0, 0), (5, 17), (10, 10), (20, 3)]:
+        ring = padded[i:i+9, j:j+9][fp & ~bad[i:i+9, j:j+9]]
+        assert filtered[i, j]==np.sort(ring)[ring.size//2]
+
+def test_numba_fallback(monkeypatch):
+
+    monkeypatch.setattr(_module, '_HAS_NUMBA', False)
+    np.random.seed(7)
+    data = np.random.normal(size=(30, 30))
+    mask = np.random.random(data.shape) < 0.3
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        filtered = rmedian(data, 2, 6, engine='histogram')
+        rmedian(data, 2, 6, engine='histogram', mask=mask)
+    assert 'footprint engine' in str(caught[0].message)
+    assert 'pure python' in str(caught[1].message)
+    assert np.array_equal(filtered, rmedian(data, 2, 6))
+
+def test_tiled(monkeypatch):
+
+    np.random.seed(3)
+    data = np.random.normal(size=(45, 38)).astype('f4')
+
+    untiled = rmedian(data, 2, 7)
+    _use_histogram(monkeypatch)
+
+    for engine in ['footprint', 'histogram']:
+        tiled = rmedian(data, 2, 7, engine=engine, tile_size=16, n_jobs=2)
+        assert tiled.dtype==untiled.dtype
+        assert np.array_equal(tiled, untiled)
+
+    tiled = rmedian(data, 2, 7, tile_size=16, n_jobs=2, use_processes=True)
+    assert np.array_equal(tiled, untiled)
+
+    # two float32 tiles of 16 + 2*7 pixels with the footprint engine
+    assert _module._tile_size(2*8*30**2, 7, 2, 8)==16
+    tiled = rmedian(data, 2, 7, n_jobs=2, max_memory=2*8*30**2)
+    assert np.array_equal(tiled, untiled)
+
+def test_tiled_concurrent(monkeypatch):
+
+    from multiprocessing.pool import ThreadPool
+
+    np.random.seed(6)
+    images = [np.random.normal(size=(40, 40)) for i in range(4)]
+    radii = [(1, 4), (2, 6), (1, 5), (3, 7)]
+    expected = [rmedian(img, *r) for img, r in zip(images, radii)]
+    _use_histogram(monkeypatch)
+
+    def _run(i):
+        return rmedian(images[i], *radii[i], engine='histogram',
+                       tile_size=8, n_jobs=2)
+
+    pool = ThreadPool(4)
+    results = pool.map(_run, range(4))
+    pool.close()
+    for res, exp in zip(results, expected):
+        assert np.array_equal(res, exp)
+
+def test_approx():
+
+    np.random.seed(4)
+    data = np.random.normal(size=(83, 70))
+
+    approx = rmedian(data, 4, 16, approx_factor=4)
+    error = rmedian_error(data, 4, 16, 4, n_samples=200,
+                          filtered_data=approx, random_state=4)
+
+    assert approx.shape==data.shape
+    assert error['max'] < 0.5*error['sigma']
+
+def test_stamp_cube(monkeypatch):
+
+    np.random.seed(5)
+    cube = np.random.normal(size=(6, 25, 25)).astype('f4')
+
+    loop = np.array([rmedian(stamp, 2, 6) for stamp in cube])
+    _use_histogram(monkeypatch)
+
+    for engine in ['footprint', 'histogram']:
+        filtered = rmedian(cube, 2, 6, engine=engine, n_jobs=2)
+        assert filtered.shape==cube.shape
+        assert np.array_equal(filtered, loop)
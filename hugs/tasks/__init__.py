@@ -1,2 +1,3 @@
 from .sersic_fit import *
 from .stamps import *
+from .pipeline import *
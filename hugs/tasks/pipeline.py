@@ -0,0 +1,195 @@
+"""
+Streaming download -> mask -> fit pipeline for postage-stamp candidates.
+"""
+from __future__ import division, print_function
+
+import os
+import threading
+from functools import partial
+from six.moves import queue
+from astropy.table import Table, vstack
+
+from .. import utils
+from ..datasets import hsc
+from . import stamps
+
+__all__ = ['run_pipeline']
+
+_DONE = None
+
+
+def _fit_worker(args):
+    """
+    Mask and fit one candidate, saving its results to
+    imfit/candy-num-imfit-params.csv.
+    """
+    num, rundir, init_params, entry, kwargs = args
+    imfitdir = os.path.join(rundir, 'imfit')
+    try:
+        results = stamps.fit_candy(num, rundir, imfitdir, init_params,
+                                   stamp_index={num: entry}, **kwargs)
+    except Exception as error:
+        print('candy {} failed: {}'.format(num, error))
+        return num, False
+    results.write(_result_fn(imfitdir, num), overwrite=True)
+    return num, True
+
+
+def _result_fn(imfitdir, num):
+    return os.path.join(imfitdir, 'candy-{}-imfit-params.csv'.format(num))
+
+
+def run_pipeline(cat, rundir, downloader, bands='GRI', n_fit=1,
+                 queue_size=None, obj_type='candy', **kwargs):
+    """
+    Download, mask, and fit postage-stamp candidates as a stream.
+    The DAS downloader hands over the stamps of a chunk once the 
+    whole chunk has arrived (chunks are retried from scratch, so 
+    partial chunks are never used), and the candidates of the chunk
+    with all of their bands are then queued for masking and fitting,
+    so downloads and fits overlap. A candidate can thus wait for the
+    other chunk_size/len(bands) candidates of its chunk; a smaller 
+    downloader chunk_size hands them over sooner, at the cost of 
+    more requests. The
+    queue between the stages is bounded: when the fits fall behind,
+    the download threads block until a slot frees up.
+
+    The pipeline can be rerun on the same rundir to resume: chunks
+    that were already downloaded are not requested again, candidates
+    with stamps on disk are queued first, and candidates with saved
+    results are skipped.
+
+    Parameters
+    ----------
+    cat : astropy.table.Table
+        Candidate catalog (output from hugs_pipe).
+    rundir : string
+        Run directory for the stamps (imfit results are saved
+        in rundir/imfit).
+    downloader : hugs.datasets.das.DASDownloader
+        The stamp downloader.
+    bands : string or list, optional
+        Photometric bands to download and fit.
+    n_fit : int, optional
+        Number of candidates to fit in parallel (processes).
+    queue_size : int, optional
+        Maximum number of downloaded candidates waiting to be
+        fit. If None, use 2*n_fit.
+    obj_type : string, optional
+        Prefix of the stamp file names.
+    kwargs : dict, optional
+        Keyword args for fit_candy (e.g., save_figs, use_psf) and
+        hsc.make_query_coordlist.
+
+    Returns
+    -------
+    candy_params : astropy.table.Table
+        The fit results of all candidates, which are also saved to
+        rundir/imfit/candy-imfit-params.csv. Candidates whose fit 
+        failed are printed and left out (rerun to retry them).
+    """
+    from multiprocessing import Pool
+
+    utils.mkdir_if_needed(rundir)
+    imfitdir = os.path.join(rundir, 'imfit')
+    utils.mkdir_if_needed(imfitdir)
+    # DAS wants upper-case bands; the stamp files use lower case
+    query_bands = [band.upper() for band in bands]
+    bands = [band.lower() for band in bands]
+    queue_size = 2*n_fit if queue_size is None else queue_size
+
+    cat.write(os.path.join(rundir, 'candy.csv'), overwrite=True)
+    coordlist_fn = os.path.join(rundir, 'coordlist.txt')
+    query_kws = dict((k, kwargs.pop(k)) for k in ['size', 'rerun']
+                     if k in kwargs)
+    hsc.make_query_coordlist(cat, coordlist_fn, query_bands, **query_kws)
+
+    # candidates already downloaded (when resuming a run)
+    stamps.build_stamp_index(rundir, cat, obj_type)
+    stamp_index = dict((num, entry) for num, entry in
+                       stamps.read_stamp_index(rundir).items()
+                       if num < len(cat))
+    ready = queue.Queue(queue_size)
+    lock = threading.Lock()
+
+    def add_stamp(line, fn):
+        num, band = divmod(line, len(bands))
+        rerun = fn.split('-')[-1].replace('_', '-')
+        new_fn = obj_type+'-{}-{}-{}'.format(num, bands[band], rerun)
+        os.rename(os.path.join(rundir, fn), os.path.join(rundir, new_fn))
+        with lock:
+            entry = stamp_index.setdefault(num, {
+                'files': {}, 'tract': cat['tract'][num],
+                'patch': cat['patch'][num]})
+            entry['files'][bands[band]] = new_fn
+            complete = len(entry['files'])==len(bands)
+        if complete:
+            ready.put(num)
+
+    def download():
+        try:
+            for num in sorted(stamp_index):
+                if len(stamp_index[num]['files'])==len(bands):
+                    ready.put(num)
+            failed = downloader.download(coordlist_fn, rundir,
+                                         callback=add_stamp)
+            if failed:
+                print('failed chunks {}, rerun to resume'.format(failed))
+        finally:
+            ready.put(_DONE)
+
+    # start the fit processes before any threads, so they are not 
+    # forked while the download threads hold locks
+    pool = Pool(n_fit)
+    thread = threading.Thread(target=download)
+    thread.daemon = True
+    thread.start()
+
+    # fit candidates as they arrive, keeping at most
+    # queue_size + n_fit candidates in flight
+    slots = threading.BoundedSemaphore(n_fit)
+    failed = []
+
+    def fit_done(result):
+        num, success = result
+        if not success:
+            failed.append(num)
+        slots.release()
+
+    def fit_error(num, error):
+        print('candy {} failed: {}'.format(num, error))
+        failed.append(num)
+        slots.release()
+
+    while True:
+        num = ready.get()
+        if num is _DONE:
+            break
+        if os.path.isfile(_result_fn(imfitdir, num)):
+            continue
+        slots.acquire()
+        args = (num, rundir, stamps.candy_init_params(cat, num),
+                stamp_index[num], kwargs)
+        pool.apply_async(_fit_worker, (args,), callback=fit_done, 
+                         error_callback=partial(fit_error, num))
+    pool.close()
+    pool.join()
+    thread.join()
+    if failed:
+        print('failed candidates {}, rerun to retry'.format(sorted(failed)))
+
+    index = [(num, band, fn) for num, entry in sorted(stamp_index.items())
+             for band, fn in sorted(entry['files'].items())]
+    if index:
+        stamps._write_stamp_index(rundir, *zip(*index), cat=cat)
+
+    candy_params = []
+    for num in range(len(cat)):
+        fn = _result_fn(imfitdir, num)
+        if os.path.isfile(fn):
+            candy_params.append(Table.read(fn))
+    candy_params = vstack(candy_params) if candy_params else Table()
+    candy_params.write(os.path.join(imfitdir, 'candy-imfit-params.csv'),
+                       overwrite=True)
+
+    return candy_params
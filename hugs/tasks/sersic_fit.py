@@ -11,7 +11,8 @@ import lsst.afw.image
 from .. import imtools
 from .. import imfit
  
-__all__ = ['sersic_fit', 'DEFAULT_PARAMS', 'DEFAULT_MASK']
+__all__ = ['sersic_fit', 'sersic_fit_batch', 'sersic_fit_joint', 
+           'DEFAULT_PARAMS', 'DEFAULT_MASK']
 
 
 DEFAULT_PARAMS = {'X0': None , # If None, use center +/- 30 pix
@@ -35,50 +36,27 @@ DEFAULT_MASK = {'thresh': 1.5,
                                     'deblend_cont': 0.001}}
 
 
-def sersic_fit(img_fn, init_params={}, prefix='fit', clean='both', 
-               visualize=False, photo_mask_fn=None, mask_kwargs={}, 
-               delta_pos=50.0, psf_fn=None, quiet=False, band_label='i'):
+def _masked_image(img_fn):
     """
-    Perform 2D galaxy fit using the hugs.imfit module, 
-    which use imfit and SEP. Most of the work in this function is 
-    getting all the input parameters ready for imfit (which uses 
-    file names) and SEP (which uses numpy arrays).
+    Masked image and its image and variance arrays, from a fits 
+    file or an in-memory stamp (img, mask, var, headers), which 
+    is used as is.
+    """
+    if isinstance(img_fn, tuple):
+        return img_fn, img_fn[0], img_fn[2]
+    mi = lsst.afw.image.MaskedImageF(img_fn)
+    return mi, mi.getImage().getArray(), mi.getVariance().getArray()
 
-    Parameters
-    ----------
-    img_fn : string
-        Fits file name of masked image.
-    init_params : dict, optional
-        Initial imfit parameters that are different from defaults given 
-        by DEFAULT_PARAMS.
-    prefix : str, optional
-        Prefix for all files generate by this function. Can include
-        full path if you want files saved in a specific directory. 
-    clean : string, optional
-        Files to remove after fitting (mask, config, or both).
-    visualize : bool, optional
-        If True, plot results.
-    photo_mask_fn : string
-        File name of photometry mask. If None, it will be created
-        using sep. 
-    mask_kwargs : dict, optional
-        Any parameter for hugs.imfit.make_mask except masked_image
-        and out_fn, which are set in this function. Can also
-    delta_pos : float, optional
-        Uncertainty in position in pixels. Only used if X0=Y0=None, 
-        in which case the center of the image is assumed. 
-    psf_fn : str, optional
-        PSF fits file.
 
-    Returns
-    -------
-    sersic : hugs.imfit.sersic.Sersic 
-        Object containing the best-fit sersic model and associated
-        derived parameters.
+def _fit_setup(mi, init_params, prefix, photo_mask_fn, mask_kwargs, 
+               delta_pos, read_mask, write_mask=True):
     """
-
-    mi = lsst.afw.image.MaskedImageF(img_fn)
-    dim = mi.getDimensions()
+    Get the imfit config and photometry mask of a masked image
+    (see sersic_fit). The mask is only written to a fits file if
+    write_mask is True, in which case its file name is returned 
+    (otherwise None).
+    """
+    dim = mi[0].shape[::-1] if isinstance(mi, tuple) else mi.getDimensions()
 
     ######################################################################
     # Get the parameters for hugs.make_mask 
@@ -115,34 +93,280 @@ def sersic_fit(img_fn, init_params={}, prefix='fit', clean='both',
         mask_params['gal_pos'] = gal_pos
 
     ######################################################################
-    # Make the photometry mask and save it to a fits file.
+    # Make the photometry mask and save it to a fits file if needed.
     ######################################################################
 
     if photo_mask_fn is None:
-        photo_mask_fn = prefix+'_photo_mask.fits'
+        photo_mask_fn = prefix+'_photo_mask.fits' if write_mask else None
         photo_mask = imfit.make_mask(mi, out_fn=photo_mask_fn, **mask_params)
+    elif isinstance(photo_mask_fn, np.ndarray):
+        photo_mask, photo_mask_fn = photo_mask_fn, None
+        if write_mask:
+            photo_mask_fn = prefix+'_photo_mask.fits'
+            imtools.write_fits(photo_mask_fn, photo_mask.astype(np.uint8))
+    elif read_mask:
+        photo_mask = fits.getdata(photo_mask_fn)
+    else:
+        photo_mask = None
+
+    return imfit_config, photo_mask, photo_mask_fn
+
+
+def _clean_masks(photo_mask_fns):
+    for photo_mask_fn in photo_mask_fns:
+        if photo_mask_fn is not None:
+            os.remove(photo_mask_fn)
+
+
+def sersic_fit(img_fn, init_params={}, prefix='fit', clean='both', 
+               visualize=False, photo_mask_fn=None, mask_kwargs={}, 
+               delta_pos=50.0, psf_fn=None, quiet=False, band_label='i',
+               engine='imfit', coarse=None, return_mask=False):
+    """
+    Perform 2D galaxy fit using the hugs.imfit module, 
+    which use imfit and SEP. Most of the work in this function is 
+    getting all the input parameters ready for imfit (which uses 
+    file names) and SEP (which uses numpy arrays).
+
+    Parameters
+    ----------
+    img_fn : string or tuple
+        Fits file name of masked image, or an in-memory stamp 
+        (img, mask, var, headers) for the 'scipy' engine, which 
+        is fit without writing it to a file.
+    init_params : dict, optional
+        Initial imfit parameters that are different from defaults given 
+        by DEFAULT_PARAMS.
+    prefix : str, optional
+        Prefix for all files generate by this function. Can include
+        full path if you want files saved in a specific directory. 
+    clean : string, optional
+        Files to remove after fitting (mask, config, or both). With
+        the 'scipy' engine, a mask that is removed is never written.
+    visualize : bool, optional
+        If True, plot results.
+    photo_mask_fn : string or ndarray
+        File name of photometry mask, or the mask itself. If None, 
+        it will be created using sep. 
+    mask_kwargs : dict, optional
+        Any parameter for hugs.imfit.make_mask except masked_image
+        and out_fn, which are set in this function. Can also
+    delta_pos : float, optional
+        Uncertainty in position in pixels. Only used if X0=Y0=None, 
+        in which case the center of the image is assumed. 
+    psf_fn : str, optional
+        PSF fits file.
+    engine : string, optional
+        Fitting engine: 'imfit' runs the imfit executable, and 
+        'scipy' fits the arrays in-process (see imfit.engine), 
+        without a config file or a subprocess.
+    coarse : int, optional
+        If given, fit the stamp reduced in coarse x coarse blocks 
+        first, then refine at full resolution (see imfit.engine.fit).
+        Only for the 'scipy' engine.
+    return_mask : bool, optional
+        If True, also return the photometry mask, e.g., to reuse it
+        for forced photometry without reading it from a file.
+
+    Returns
+    -------
+    sersic : hugs.imfit.sersic.Sersic 
+        Object containing the best-fit sersic model and associated
+        derived parameters.
+    photo_mask : ndarray, if return_mask is True
+        The photometry mask.
+    """
+
+    assert engine in imfit.ENGINES, 'engine must be one of '+\
+        str(imfit.ENGINES)
+    assert coarse is None or engine=='scipy', 'coarse needs scipy engine'
+    assert engine=='scipy' or not isinstance(img_fn, tuple),\
+        'in-memory stamps need the scipy engine'
+
+    mi, img, var = _masked_image(img_fn)
+    clean_mask = (clean=='mask') or (clean=='both')
+    imfit_config, photo_mask, photo_mask_fn = _fit_setup(
+        mi, init_params, prefix, photo_mask_fn, mask_kwargs, delta_pos, 
+        engine=='scipy' or return_mask, 
+        engine=='imfit' or (photo_mask_fn is None and not clean_mask))
 
     ######################################################################
     # Run imfit. The best-fit params will be saved to out_fn. 
     ######################################################################
 
     config_fn = prefix+'_config.txt'
-    out_fn = prefix+'_bestfit_params.txt'
-    var_fn = img_fn+'[3]'
-    results = imfit.run(
-        img_fn+'[1]', config_fn, photo_mask_fn, var_fn,
-        out_fn=out_fn, config=imfit_config, psf_fn=psf_fn, quiet=quiet)
+    if engine=='scipy':
+        results = imfit.engine.fit(img, imfit_config, photo_mask, var, 
+                                   psf_fn, quiet=quiet, coarse=coarse)
+    else:
+        out_fn = prefix+'_bestfit_params.txt'
+        var_fn = img_fn+'[3]'
+        results = imfit.run(
+            img_fn+'[1]', config_fn, photo_mask_fn, var_fn,
+            out_fn=out_fn, config=imfit_config, psf_fn=psf_fn, quiet=quiet)
 
     if visualize:
         imfit.viz.img_mod_res(
-            img_fn, results, photo_mask_fn, figsize=(16,6),
-            band=band_label)
+            img, results, 
+            photo_mask_fn if photo_mask is None else photo_mask, 
+            figsize=(16,6), band=band_label, psf_fn=psf_fn)
 
-    if (clean=='mask') or (clean=='both'):
-        os.remove(photo_mask_fn)
-    if (clean=='config') or (clean=='both'):
+    if clean_mask:
+        _clean_masks([photo_mask_fn])
+    if ((clean=='config') or (clean=='both')) and engine=='imfit':
         os.remove(config_fn)
 
     sersic = imfit.Sersic(results)
 
-    return sersic
+    return (sersic, photo_mask) if return_mask else sersic
+
+
+def sersic_fit_batch(img_fns, init_params={}, prefixes=None, clean='both',
+                     photo_mask_fns=None, mask_kwargs={}, delta_pos=50.0, 
+                     psf_fns=None, return_masks=False, **kwargs):
+    """
+    Fit many stamps at once with the batched Levenberg-Marquardt 
+    fitter (see hugs.imfit.engine.fit_batch). Each stamp is set up 
+    as in sersic_fit, and stamps of the same size are fit together.
+
+    Parameters
+    ----------
+    img_fns : list of strings or tuples
+        Fits file names of the masked images, or in-memory stamps 
+        (see sersic_fit).
+    init_params : dict or list of dicts, optional
+        Initial imfit parameters for all stamps or for each stamp.
+    prefixes : list of strings, optional
+        File prefix of each stamp (for the photometry masks). If 
+        None, use 'fit-0', 'fit-1', ...
+    clean : string, optional
+        If 'mask' or 'both', the photometry masks are not written 
+        to (or are removed from) the disk.
+    photo_mask_fns : list, optional
+        Photometry mask file name or array (or None to make it) of 
+        each stamp.
+    mask_kwargs : dict, optional
+        Parameters for hugs.imfit.make_mask (see sersic_fit). 
+    delta_pos : float, optional
+        Uncertainty in position in pixels (see sersic_fit).
+    psf_fns : string or list, optional
+        PSF fits file for all stamps or for each stamp.
+    return_masks : bool, optional
+        If True, also return the photometry masks.
+    kwargs : dict, optional
+        Keyword args for hugs.imfit.engine.fit_batch.
+
+    Returns
+    -------
+    sersics : list of hugs.imfit.sersic.Sersic
+        The best-fit model of each stamp.
+    photo_masks : list of ndarrays, if return_masks is True
+        The photometry mask of each stamp.
+    """
+    num = len(img_fns)
+    if isinstance(init_params, dict):
+        init_params = [init_params]*num
+    if prefixes is None:
+        prefixes = ['fit-{}'.format(i) for i in range(num)]
+    photo_mask_fns = list(photo_mask_fns or [None]*num)
+    if not isinstance(psf_fns, list):
+        psf_fns = [psf_fns]*num
+    clean_mask = (clean=='mask') or (clean=='both')
+
+    stamps = []
+    for i, img_fn in enumerate(img_fns):
+        mi, img, var = _masked_image(img_fn)
+        config, photo_mask, photo_mask_fns[i] = _fit_setup(
+            mi, init_params[i], prefixes[i], photo_mask_fns[i], 
+            mask_kwargs, delta_pos, True, 
+            photo_mask_fns[i] is None and not clean_mask)
+        stamps.append((img.copy(), photo_mask, var.copy(), config))
+
+    # stamps of the same size are fit together
+    groups = {}
+    for i, stamp in enumerate(stamps):
+        groups.setdefault(stamp[0].shape, []).append(i)
+    results = [None]*num
+    for group in groups.values():
+        imgs, masks, variances, configs = zip(*[stamps[i] for i in group])
+        batch = imfit.engine.fit_batch(
+            np.array(imgs), list(configs), np.array(masks), 
+            np.array(variances), [psf_fns[i] for i in group], **kwargs)
+        for i, res in zip(group, batch):
+            results[i] = res
+
+    if clean_mask:
+        _clean_masks(photo_mask_fns)
+
+    sersics = [imfit.Sersic(res) for res in results]
+    if return_masks:
+        return sersics, [stamp[1] for stamp in stamps]
+    return sersics
+
+
+def sersic_fit_joint(img_fns, init_params={}, prefixes=None, clean='both',
+                     mask_kwargs={}, delta_pos=50.0, psf_fns=None, 
+                     band_r_e=False, quiet=True, return_masks=False):
+    """
+    Fit the stamps of one object in several bands at once with a 
+    shared shape (see hugs.imfit.engine.fit_joint). Each band is set 
+    up as in sersic_fit, with its own photometry mask.
+
+    Parameters
+    ----------
+    img_fns : list of strings or tuples
+        Fits file names of the masked images of each band, or 
+        in-memory stamps (see sersic_fit).
+    init_params : dict, optional
+        Initial imfit parameters that are different from defaults 
+        given by DEFAULT_PARAMS.
+    prefixes : list of strings, optional
+        File prefix of each band (for the photometry masks). If None, 
+        use 'fit-0', 'fit-1', ...
+    clean : string, optional
+        If 'mask' or 'both', the photometry masks are not written 
+        to (or are removed from) the disk.
+    mask_kwargs : dict, optional
+        Parameters for hugs.imfit.make_mask (see sersic_fit). 
+    delta_pos : float, optional
+        Uncertainty in position in pixels (see sersic_fit).
+    psf_fns : list, optional
+        PSF fits file (or None) of each band.
+    band_r_e : bool, optional
+        If True, fit r_e separately in each band.
+    return_masks : bool, optional
+        If True, also return the photometry masks.
+
+    Returns
+    -------
+    sersics : list of hugs.imfit.sersic.Sersic
+        The best-fit model of each band.
+    photo_masks : list of ndarrays, if return_masks is True
+        The photometry mask of each band.
+    """
+    num = len(img_fns)
+    if prefixes is None:
+        prefixes = ['fit-{}'.format(i) for i in range(num)]
+    clean_mask = (clean=='mask') or (clean=='both')
+
+    imgs, masks, variances, configs, photo_mask_fns = [], [], [], [], []
+    for img_fn, prefix in zip(img_fns, prefixes):
+        mi, img, var = _masked_image(img_fn)
+        config, photo_mask, photo_mask_fn = _fit_setup(
+            mi, init_params, prefix, None, mask_kwargs, delta_pos, True, 
+            not clean_mask)
+        imgs.append(img)
+        variances.append(var)
+        masks.append(photo_mask)
+        configs.append(config)
+        photo_mask_fns.append(photo_mask_fn)
+
+    results = imfit.engine.fit_joint(imgs, configs, masks, variances, 
+                                     psf_fns, band_r_e=band_r_e, 
+                                     quiet=quiet)
+
+    if clean_mask:
+        _clean_masks(photo_mask_fns)
+
+    sersics = [imfit.Sersic(res) for res in results]
+    return (sersics, masks) if return_masks else sersics
@@ -2,20 +2,111 @@ from __future__ import division, print_function
                       
 
 import os
+from collections import OrderedDict
 import numpy as np
 import matplotlib.pyplot as plt
 from astropy.table import Table, vstack, hstack
 
-from .sersic_fit import sersic_fit
+from .sersic_fit import sersic_fit, sersic_fit_batch, sersic_fit_joint
 from .. import utils
 from ..datasets import hsc
 from .. import imfit
+from .. import imtools
 
-__all__ = ['get_candy_stamps', 'fit_candy', 'run_batch_fit']
+__all__ = ['get_candy_stamps', 'fit_candy', 'fit_candy_block', 
+           'run_batch_fit', 'build_stamp_index', 'read_stamp_index', 'coadd_fn', 
+           'iter_local_stamps', 'get_local_stamps', 'candy_init_params']
+
+ARCHIVE_FN = 'stamps.h5'
+FORCED = ['fit', 'linear', 'linear_r_e']
+INDEX_FN = 'stamp-index.csv'
+
+
+def _write_stamp_index(rundir, nums, bands, files, cat=None):
+    index = Table([np.asarray(nums, dtype=int), bands, files], 
+                  names=['num', 'band', 'fn'])
+    if cat is not None and 'tract' in cat.colnames:
+        index['tract'] = cat['tract'][index['num']]
+        index['patch'] = cat['patch'][index['num']]
+    # write to a temporary file first, so readers never see a partial index
+    index_fn = os.path.join(rundir, INDEX_FN)
+    index.write(index_fn+'.tmp', format='ascii.csv', overwrite=True)
+    os.rename(index_fn+'.tmp', index_fn)
+    return index
+
+
+def build_stamp_index(rundir, cat=None, obj_type='candy'):
+    """
+    Build the stamp index of a run with a single directory listing 
+    and save it next to candy.csv (rundir/stamp-index.csv). 
+
+    Parameters
+    ----------
+    rundir : string
+        Path to the stamp fits files (obj_type-num-band-rerun).
+    cat : astropy.table.Table, optional
+        Candidate catalog with tract and patch columns. If None, 
+        rundir/candy.csv is used if it exists.
+    obj_type : string, optional
+        Prefix of the stamp file names.
+
+    Returns
+    -------
+    index : astropy.table.Table
+        Table with columns num, band, fn (file name relative to
+        rundir), and tract, patch (if known).
+    """
+    rows = []
+    for fn in os.listdir(rundir):
+        parts = fn.split('-')
+        if parts[0]==obj_type and fn[-5:]=='.fits' and parts[1].isdigit():
+            rows.append((int(parts[1]), parts[2], fn))
+    rows.sort()
+    if cat is None:
+        cat_fn = os.path.join(rundir, 'candy.csv')
+        cat = Table.read(cat_fn) if os.path.isfile(cat_fn) else None
+    nums, bands, files = zip(*rows) if rows else ([], [], [])
+    return _write_stamp_index(rundir, nums, bands, files, cat)
+
+
+def read_stamp_index(rundir, build=True):
+    """
+    Read the stamp index of a run into a dict for O(1) lookups. 
+
+    Parameters
+    ----------
+    rundir : string
+        Path to the stamp fits files.
+    build : bool, optional
+        If True, build the index if rundir has none. With many 
+        processes (e.g., MPI ranks), build it in one of them and 
+        read it with build=False in the others.
+
+    Returns
+    -------
+    stamp_index : dict
+        stamp_index[num] = {'files': {band: fn}, 'tract': tract, 
+        'patch': patch}, where fn is relative to rundir. 
+    """
+    index_fn = os.path.join(rundir, INDEX_FN)
+    if build and not os.path.isfile(index_fn):
+        index = build_stamp_index(rundir)
+    else:
+        index = Table.read(index_fn)
+    has_patch = 'tract' in index.colnames
+    stamp_index = {}
+    for row in index:
+        entry = stamp_index.setdefault(int(row['num']), {
+            'files': OrderedDict(),
+            'tract': int(row['tract']) if has_patch else None,
+            'patch': str(row['patch']) if has_patch else None})
+        entry['files'][str(row['band'])] = str(row['fn'])
+    return stamp_index
 
 
 def get_candy_stamps(cat, label=None, bands='GRI', 
-                     outdir=None, obj_type='candy', **kwargs):
+                     outdir=None, obj_type='candy', archive=False, 
+                     downloader=None, **kwargs):
     """
     Get postage stamps from database. 
 
@@ -29,6 +120,16 @@ def get_candy_stamps(cat, label=None, bands='GRI',
         Photometric bands to get. 
     outdir : string, optional
         Output directory.
+    archive : bool, optional
+        If True, pack the stamps into a single StampArchive 
+        (rundir/stamps.h5) keyed by (candidate, band) and remove 
+        the downloaded fits files. Otherwise, rename the fits files
+        to obj_type-num-band-rerun and save the stamp index 
+        (see build_stamp_index).
+    downloader : hugs.datasets.das.DASDownloader, optional
+        If not None, download the stamps in concurrent, resumable 
+        chunks (streamed into the archive if archive is True). 
+        Otherwise, use hsc.cutout_query.
     """
     
     if label is None:
@@ -43,110 +144,371 @@ def get_candy_stamps(cat, label=None, bands='GRI',
         outdir = os.path.join(utils.io, 'stamps')
 
     new_cat_fn = os.path.join(rundir, 'candy.csv')
-    cat.write(new_cat_fn)
+    cat.write(new_cat_fn, overwrite=True)
 
     coordlist_fn = os.path.join(rundir, 'coordlist.txt')
     hsc.make_query_coordlist(cat, coordlist_fn, bands, **kwargs)
-    hsc.cutout_query(coordlist_fn, outdir=rundir, **kwargs)
+    if downloader is not None:
+        if archive:
+            archive_fn = os.path.join(rundir, ARCHIVE_FN)
+            with imtools.StampArchive(archive_fn, 'a') as stamp_archive:
+                failed = downloader.download(
+                    coordlist_fn, rundir, stamp_archive, bands)
+        else:
+            failed = downloader.download(coordlist_fn, rundir)
+        assert not failed, 'ERROR: failed chunks {}, rerun to resume'.format(
+            failed)
+        if archive:
+            return
+    else:
+        hsc.cutout_query(coordlist_fn, outdir=rundir, **kwargs)
 
     # give stamps more useful names
     stamp_files = [f for f in os.listdir(rundir) if f[-4:]=='fits']
     stamp_files = sorted(stamp_files, key=lambda f: int(f.split('-')[0]))
     grouped_files = utils.grouper(stamp_files, len(bands))
 
+    if archive:
+        archive_fn = os.path.join(rundir, ARCHIVE_FN)
+        with imtools.StampArchive(archive_fn, 'w') as stamp_archive:
+            for num, files in enumerate(grouped_files):
+                for i in range(len(bands)):
+                    fn = os.path.join(rundir, files[i])
+                    stamp_archive.add_fits(num, bands[i], fn)
+                    os.remove(fn)
+        return
+
+    index = [], [], []
     for num, files in enumerate(grouped_files):
         for i in range(len(bands)):
             old_fn = files[i]
             rerun = old_fn.split('-')[-1]
             rerun = rerun.replace('_', '-')
             new_fn = obj_type+'-{}-{}-{}'.format(num, bands[i].lower(), rerun)
+            for col, val in zip(index, [num, bands[i].lower(), new_fn]):
+                col.append(val)
             old_fn = os.path.join(rundir, old_fn)
             new_fn = os.path.join(rundir, new_fn)
             os.rename(old_fn, new_fn)
+    _write_stamp_index(rundir, *index, cat=cat)
 
 
-def fit_candy(num, indir, outdir, init_params={}, save_figs=True,
-              mask_kwargs={}, tract=None, patch=None, 
-              use_psf=True, butler=None):
+def coadd_fn(tract, patch, band, hscdir=None, butler=None):
     """
-    Fit single candidate.
+    File name of a deepCoadd_calexp patch. If a butler is given, 
+    ask it for the file name. Otherwise, assume the standard HSC 
+    rerun layout in hscdir (default: $HSC_DIR). 
+    """
+    if butler is not None:
+        data_id = {'tract': tract, 'patch': patch, 'filter': 'HSC-'+band}
+        return butler.get('deepCoadd_calexp_filename', data_id, 
+                          immediate=True)[0]
+    hscdir = os.environ.get('HSC_DIR') if hscdir is None else hscdir
+    fn = 'calexp-HSC-{}-{}-{}.fits'.format(band, tract, patch)
+    return os.path.join(
+        hscdir, 'deepCoadd', 'HSC-'+band, str(tract), patch, fn)
 
-    Notes
-    -----
-    All bands are fit separately. Then, the band with the smallest
-    fractional error in r_eff is used as a reference for forced 
-    photometry on the other bands, where the position and sercic
-    index is held fixed. 
+
+def _stamp_header(header, x0, y0):
     """
-    import lsst.afw.image 
-    import lsst.afw.geom 
+    Shift a patch header to a stamp with lower-left pixel (x0, y0),
+    including the LSST xy0 (CRVAL1A, CRVAL2A) offsets.
+    """
+    header = header.copy()
+    for key in ['NAXIS1', 'NAXIS2', 'ZNAXIS1', 'ZNAXIS2']:
+        header.remove(key, ignore_missing=True)
+    if 'CRPIX1' in header:
+        header['CRPIX1'] -= x0
+        header['CRPIX2'] -= y0
+    if 'CRVAL1A' in header:
+        header['CRVAL1A'] += x0
+        header['CRVAL2A'] += y0
+    return header
+
+
+def _cut_patch(group):
+    """
+    Cut the image, mask, and variance stamps of all the candidates
+    in one (tract, patch), band by band.
+    """
+    from astropy.io import fits
+    fns, bands, nums, coords, size = group
+    stamps = []
+    for fn, band in zip(fns, bands):
+        (imgs, masks, variances), origins = imtools.cutouts_from_fits(
+            fn, coords, size)
+        with fits.open(fn, memmap=True) as hdulist:
+            heads = [hdulist[ext].header for ext in [1, 2, 3]]
+        for i, num in enumerate(nums):
+            headers = [_stamp_header(h, *origins[i]) for h in heads]
+            stamps.append(
+                (num, band, (imgs[i], masks[i], variances[i], headers)))
+    return stamps
+
+
+def _patch_stamps(stamps):
+    """
+    Stamps of a patch as stamps[num][band] = stamp.
+    """
+    patch_stamps = OrderedDict()
+    for num, band, stamp in stamps:
+        patch_stamps.setdefault(num, OrderedDict())[band] = stamp
+    return patch_stamps
+
+
+def _patch_groups(cat, bands='GRI', size=30, hscdir=None, butler=None, 
+                  block_size=None):
+    """
+    The candidates of each (tract, patch), with the patch files and 
+    stamp size for _cut_patch. If block_size is given, patches are 
+    split into groups of at most block_size candidates.
+    """
+    npix = 2*int(size/utils.pixscale) + 1
+    patches = OrderedDict()
+    for num, row in enumerate(cat):
+        key = int(row['tract']), str(row['patch'])
+        patches.setdefault(key, []).append(num)
+
+    groups = []
+    for (tract, patch), nums in patches.items():
+        fns = [coadd_fn(tract, patch, band.upper(), hscdir, butler) 
+               for band in bands]
+        step = block_size or len(nums)
+        for lo in range(0, len(nums), step):
+            block = nums[lo:lo + step]
+            coords = np.column_stack([cat['ra'][block], cat['dec'][block]])
+            groups.append((fns, [b.lower() for b in bands], block, coords, 
+                           npix))
+    return groups
+
+
+def _iter_local_patches(cat, bands='GRI', size=30, n_jobs=1, hscdir=None, 
+                        butler=None):
+    """
+    Cut the stamps of a catalog patch by patch (see iter_local_stamps)
+    and yield the stamps of each patch as stamps[num][band]. With 
+    n_jobs > 1, at most n_jobs patches are cut ahead of the consumer,
+    so the stamps in memory are bounded by a few patches.
+    """
+    groups = _patch_groups(cat, bands, size, hscdir, butler)
+    if n_jobs==1:
+        for group in groups:
+            yield _patch_stamps(_cut_patch(group))
+        return
+
+    from collections import deque
+    from multiprocessing import Pool
+    pool = Pool(n_jobs)
+    try:
+        pending = deque()
+        for group in groups:
+            pending.append(pool.apply_async(_cut_patch, (group,)))
+            if len(pending) > n_jobs:
+                yield _patch_stamps(pending.popleft().get())
+        while pending:
+            yield _patch_stamps(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+
+
+def iter_local_stamps(cat, bands='GRI', size=30, n_jobs=1, hscdir=None, 
+                      butler=None):
+    """
+    Cut postage stamps from the local deepCoadd_calexp patches 
+    instead of querying DAS. The candidates are grouped by 
+    (tract, patch), so each patch is opened once per band and all
+    of its stamps are cut in a single pass. The stamps are yielded
+    patch by patch, with all the bands of a patch together.
+
+    Parameters
+    ----------
+    cat : astropy.table.Table
+        Candidate catalog (candy.csv) with ra, dec, tract, and 
+        patch columns. The row number is the candidate number.
+    bands : string or list, optional
+        Photometric bands to cut. 
+    size : float, optional
+        Half width and height of the stamps in arcsec (as in 
+        hsc.make_query_coordlist).
+    n_jobs : int, optional
+        Number of patches to cut in parallel (processes).
+    hscdir : string, optional
+        HSC rerun directory (see coadd_fn).
+    butler : lsst.daf.persistence.Butler, optional
+        Butler used to find the patch files.
+
+    Yields
+    ------
+    num, band, stamp : int, string, tuple
+        Candidate number, band, and stamp, where stamp is 
+        (img, mask, var, headers), ready for StampArchive.write 
+        or fit_candy.
+    """
+    for patch_stamps in _iter_local_patches(cat, bands, size, n_jobs, 
+                                            hscdir, butler):
+        for num, num_stamps in patch_stamps.items():
+            for band, stamp in num_stamps.items():
+                yield num, band, stamp
+
+
+def get_local_stamps(cat, bands='GRI', size=30, n_jobs=1, archive_fn=None,
+                     **kwargs):
+    """
+    Cut all the postage stamps of a catalog from the local patches 
+    (see iter_local_stamps for the parameters). All the stamps are 
+    held in memory, so use iter_local_stamps (or run_batch_fit with
+    use_local) for full candidate lists.
+
+    Parameters
+    ----------
+    archive_fn : string, optional
+        If not None, also save the stamps to a StampArchive. 
+
+    Returns
+    -------
+    stamps : dict
+        stamps[num][band] = (img, mask, var, headers), which can 
+        be passed directly to fit_candy. 
+    """
+    stamps = {}
+    archive = None
+    if archive_fn is not None:
+        archive = imtools.StampArchive(archive_fn, 'w')
+    for num, band, stamp in iter_local_stamps(cat, bands, size, n_jobs, 
+                                              **kwargs):
+        stamps.setdefault(num, OrderedDict())[band] = stamp
+        if archive is not None:
+            archive.write(num, band, *stamp)
+    if archive is not None:
+        archive.close()
+    return stamps
+
+
+def _candy_patch(num, indir, tract=None, patch=None, stamp_index=None):
+    """
+    Tract and patch of a candidate, from the stamp index or the 
+    run catalog if they are not given.
+    """
+    if stamp_index is not None:
+        entry = stamp_index[num]
+        tract = entry['tract'] if tract is None else tract
+        patch = entry['patch'] if patch is None else patch
     if tract is None or patch is None:
         cat_fn = os.path.join(indir, 'candy.csv')
         cat = Table.read(cat_fn)
         tract, patch = cat['tract', 'patch'][num]
+    return tract, patch
 
-    psf_dir = os.path.join(os.environ.get('HUGS_PIPE_IO'), 'patch-psfs')
- 
-    files = [f for f in os.listdir(indir) if 
-             f.split('-')[-1]=='wide.fits' and int(f.split('-')[1])==num]
 
-    if save_figs:
-        fig, axes = plt.subplots(len(files), 3, figsize=(15,15))
-        fig.subplots_adjust(wspace=0.05, hspace=0.05)
+def _candy_files(num, indir, outdir, archive=None, stamp_index=None, 
+                 stamps=None, to_fits=True):
+    """
+    Bands and stamps of a candidate (see fit_candy). The stamps are
+    fits file names, or in-memory stamps (img, mask, var, headers) 
+    for stamps from an archive or from memory. If to_fits is True 
+    (for imfit), those are written to temporary fits files in outdir,
+    which are returned so they can be removed after the fit.
 
-    # fit all bands separately
-    r_e_err = []
-    fit_list = []
-    mask_files = [] 
-    for fn in files:
-        band = fn.split('-')[2]
-        fn = os.path.join(indir, fn)
-        prefix = os.path.join(outdir, 'candy-{}-{}'.format(num, band))
-        if use_psf:
-            psf_fn = 'psf-{}-{}-{}.fits'.format(band.upper(), tract, patch)
-            psf_fn = os.path.join(psf_dir, psf_fn)
-            if not os.path.isfile(psf_fn):
-                from astropy.io import fits
-                print('generating psf file for', tract, patch, band)
-                if butler is None:
-                    import lsst.daf.persistence
-                    hscdir = os.environ.get('HSC_DIR')
-                    butler = lsst.daf.persistence.Butler(hscdir)
-                data_id = {'tract': tract, 
-                           'patch': patch, 
-                           'filter': 'HSC-'+band.upper()}
-                exp = butler.get('deepCoadd_calexp', data_id, immediate=True)
-                psf = exp.getPsf().computeImage().getArray().copy()
-                fits.writeto(psf_fn, psf, clobber=True)
+    Returns
+    -------
+    bands : list of strings
+        The bands of the stamps.
+    files : list of strings or tuples
+        Full fits file names or in-memory stamps.
+    temp_files : list of strings
+        Temporary fits files.
+    """
+    if archive is not None:
+        if isinstance(archive, imtools.StampArchive):
+            stamp_archive = archive
+        else:
+            stamp_archive = imtools.StampArchive(archive)
+        bands = stamp_archive.bands(num)
+        if to_fits:
+            files = [stamp_archive.to_fits(num, band, os.path.join(
+                     outdir, 'candy-{}-{}-archive.fits'.format(num, band)))
+                     for band in bands]
         else:
-            psf_fn = None
-        sersic = sersic_fit(fn, 
-                            prefix=prefix,
-                            init_params=init_params,
-                            visualize=False, 
-                            clean='config', 
-                            mask_kwargs=mask_kwargs, 
-                            psf_fn=psf_fn)
-        r_e_err.append(sersic.r_e_err/sersic.r_e)
-        fit_list.append(sersic)
-        mask_files.append(prefix+'_photo_mask.fits')
-    r_e_err = np.array(r_e_err)
-    best_idx = r_e_err.argmin()
-    best_band = files[best_idx].split('-')[2]
+            files = [stamp_archive.stamp(num, band) for band in bands]
+        if stamp_archive is not archive:
+            stamp_archive.close()
+        return bands, files, files if to_fits else []
+    elif stamps is not None:
+        bands = list(stamps.keys())
+        files = list(stamps.values())
+        if to_fits:
+            for i, band in enumerate(bands):
+                img, mask, var, headers = files[i]
+                fn = 'candy-{}-{}-local.fits'.format(num, band)
+                files[i] = os.path.join(outdir, fn)
+                imtools.write_fits(files[i], [img, mask, var], headers)
+        return bands, files, files if to_fits else []
+    elif stamp_index is not None:
+        files = list(stamp_index[num]['files'].values())
+    else:
+        files = [f for f in os.listdir(indir) if 
+                 f.split('-')[-1]=='wide.fits' and int(f.split('-')[1])==num]
+    bands = [fn.split('-')[2] for fn in files]
+    return bands, [os.path.join(indir, fn) for fn in files], []
 
-    best = fit_list[best_idx]
 
-    # get wcs for best fit object
-    best_fn = os.path.join(indir, files[best_idx])
-    header = lsst.afw.image.readMetadata(best_fn)
-    wcs = lsst.afw.image.makeWcs(header)
-    X0_hsc, Y0_hsc = header.get('CRVAL1A'), header.get('CRVAL2A')
-    coord = wcs.pixelToSky(best.X0+X0_hsc, best.Y0+Y0_hsc)
-    ra, dec = coord.getPosition(lsst.afw.geom.degrees)
+def _image(img_fn):
+    """
+    Image of a stamp, for imfit.viz.img_mod_res.
+    """
+    return img_fn[0] if isinstance(img_fn, tuple) else img_fn
+
+
+def _psf_fn(band, tract, patch, butler=None):
+    """
+    PSF fits file of a patch, which is generated if needed.
+    """
+    psf_dir = os.path.join(os.environ.get('HUGS_PIPE_IO'), 'patch-psfs')
+    psf_fn = 'psf-{}-{}-{}.fits'.format(band.upper(), tract, patch)
+    psf_fn = os.path.join(psf_dir, psf_fn)
+    if not os.path.isfile(psf_fn):
+        from astropy.io import fits
+        print('generating psf file for', tract, patch, band)
+        if butler is None:
+            import lsst.daf.persistence
+            hscdir = os.environ.get('HSC_DIR')
+            butler = lsst.daf.persistence.Butler(hscdir)
+        data_id = {'tract': tract, 
+                   'patch': patch, 
+                   'filter': 'HSC-'+band.upper()}
+        exp = butler.get('deepCoadd_calexp', data_id, immediate=True)
+        psf = exp.getPsf().computeImage().getArray().copy()
+        fits.writeto(psf_fn, psf, clobber=True)
+    return psf_fn
+
+
+def _best_results(num, best_band, best, best_fn):
+    """
+    Output columns of the reference (best) band.
+    """
+    # the fit position is 1-indexed (imfit's convention)
+    if isinstance(best_fn, tuple):
+        # in-memory stamp: the image header has the stamp's own wcs
+        from astropy.wcs import WCS
+        ny, nx = best_fn[0].shape
+        ra, dec = WCS(best_fn[3][0]).all_pix2world(best.X0, best.Y0, 1)
+        ra, dec = float(ra), float(dec)
+    else:
+        import lsst.afw.image 
+        import lsst.afw.geom 
+
+        # get wcs for best fit object
+        header = lsst.afw.image.readMetadata(best_fn)
+        wcs = lsst.afw.image.makeWcs(header)
+        X0_hsc, Y0_hsc = header.get('CRVAL1A'), header.get('CRVAL2A')
+        coord = wcs.pixelToSky(best.X0-1+X0_hsc, best.Y0-1+Y0_hsc)
+        ra, dec = coord.getPosition(lsst.afw.geom.degrees)
+        nx, ny = header.get('NAXIS1'), header.get('NAXIS2')
 
     # generate ouput columns for best band
-    dX0 = best.X0 - header.get('NAXIS1')/2
-    dY0 = best.Y0 - header.get('NAXIS2')/2
+    dX0 = best.X0 - nx/2
+    dY0 = best.Y0 - ny/2
     data = [num, best_band, ra, dec, best.n, best.m_tot, best.mu_0, 
             best.ell, best.r_e*utils.pixscale, best.PA, dX0, dY0]
     names = ['candy_num', 
@@ -162,66 +524,207 @@ def fit_candy(num, indir, outdir, init_params={}, save_figs=True,
              'dX0', 
              'dY0']
     results = Table(rows=[data], names=names)
+    return results
+
+
+def _forced_params(best, sersic):
+    """
+    Forced-photometry parameters, with the shape of the best fit.
+    """
+    init_params = {
+        'X0': [best.X0, 'fixed'],
+        'Y0': [best.Y0, 'fixed'],
+        'n': [best.n, 'fixed'],
+        'PA': [best.PA, 'fixed'],
+        'ell': [best.ell, 'fixed'],
+        'r_e': best.r_e,
+        'I_e': sersic.I_e
+        }
+    return init_params
+
+
+def _linear_forced(img_fn, best, photo_mask, psf_fn, forced):
+    """
+    Forced photometry with the closed-form amplitude fit (see 
+    imfit.engine.fit_linear), which needs no mask or config files.
+    """
+    if isinstance(img_fn, tuple):
+        img, var = img_fn[0], img_fn[2]
+    else:
+        from astropy.io import fits
+        img, var = fits.getdata(img_fn, 1), fits.getdata(img_fn, 3)
+    results = imfit.engine.fit_linear(
+        img, best.params, photo_mask, var, psf_fn, 
+        fit_r_e=forced=='linear_r_e')
+    return imfit.Sersic(results)
+
+
+def _forced_results(band, sersic):
+    """
+    Output columns of a forced-photometry band.
+    """
+    data = [sersic.m_tot, sersic.mu_0, sersic.ell,
+            sersic.r_e*utils.pixscale, sersic.PA]
+    names = ['m_tot('+band+')', 'mu_0('+band+')', 'ell('+band+')',
+             'r_e('+band+')', 'PA('+band+')']
+    return Table(rows=[data], names=names)
+
+
+def fit_candy(num, indir, outdir, init_params={}, save_figs=True,
+              mask_kwargs={}, tract=None, patch=None, 
+              use_psf=True, butler=None, archive=None, stamp_index=None,
+              stamps=None, engine='imfit', forced='fit', joint=False,
+              band_r_e=False, coarse=None):
+    """
+    Fit single candidate.
+
+    Parameters
+    ----------
+    stamp_index : dict, optional
+        Stamp index of the run (see read_stamp_index), which gives 
+        the stamp files and tract/patch of the candidate without 
+        listing indir. 
+    archive : StampArchive or string, optional
+        Stamp archive (or its file name) to read the stamps from 
+        instead of the fits files in indir. The stamps are fit from 
+        memory, except with the imfit engine, for which each band is
+        written to a temporary fits file in outdir.
+    stamps : dict, optional
+        In-memory stamps of the candidate, stamps[band] = (img, mask,
+        var, headers), e.g. from iter_local_stamps. As for archive, 
+        they are only written to temporary fits files for imfit.
+    engine : string, optional
+        Fitting engine for sersic_fit ('imfit' or 'scipy').
+    forced : string, optional
+        Forced photometry mode: 'fit' runs sersic_fit with the shape
+        of the reference band held fixed, 'linear' also fixes r_e
+        and solves for I_e in closed form, and 'linear_r_e' refines
+        r_e as well (see imfit.engine.fit_linear). The linear modes
+        reuse the reference photometry mask and write no files.
+    joint : bool, optional
+        If True, fit all bands at once with a shared position, PA, 
+        ellipticity, and sersic index (see sersic_fit_joint), instead
+        of the separate and forced fits. 
+    band_r_e : bool, optional
+        If joint is True, fit r_e separately in each band.
+    coarse : int, optional
+        Block factor of the coarse-to-fine fits (see sersic_fit). 
+        Only for the 'scipy' engine.
+
+    Notes
+    -----
+    All bands are fit separately. Then, the band with the smallest
+    fractional error in r_eff is used as a reference for forced 
+    photometry on the other bands, where the position and sercic
+    index is held fixed. In the joint mode, the reference band is 
+    the band with the smallest fractional error in I_e, and each
+    band is shown with its own photometry mask.
+    """
+    assert forced in FORCED, 'forced must be one of '+str(FORCED)
+    tract, patch = _candy_patch(num, indir, tract, patch, stamp_index)
+    bands, files, temp_files = _candy_files(
+        num, indir, outdir, archive, stamp_index, stamps, 
+        to_fits=engine=='imfit' and not joint)
+
+    if save_figs:
+        fig, axes = plt.subplots(len(files), 3, figsize=(15,15),
+                                 squeeze=False)
+        fig.subplots_adjust(wspace=0.05, hspace=0.05)
+
+    # fit all bands separately (or jointly)
+    prefixes = [os.path.join(outdir, 'candy-{}-{}'.format(num, band)) 
+                for band in bands]
+    psf_fns = [_psf_fn(band, tract, patch, butler) if use_psf else None
+               for band in bands]
+    # only imfit reads the photometry masks from files
+    mask_files = [prefix+'_photo_mask.fits' for prefix in prefixes]
+    use_files = engine=='imfit' and not joint
+    if joint:
+        fit_list, photo_masks = sersic_fit_joint(
+            files, init_params, 
+            prefixes, clean='both', mask_kwargs=mask_kwargs, 
+            psf_fns=psf_fns, band_r_e=band_r_e, return_masks=True)
+        rel_err = np.array([s.I_e_err/s.I_e for s in fit_list])
+    else:
+        fit_list, photo_masks = [], []
+        for fn, prefix, psf_fn in zip(files, prefixes, psf_fns):
+            sersic, photo_mask = sersic_fit(
+                fn, 
+                prefix=prefix,
+                init_params=init_params,
+                visualize=False, 
+                clean='config' if use_files else 'both', 
+                mask_kwargs=mask_kwargs, 
+                psf_fn=psf_fn,
+                engine=engine,
+                coarse=coarse,
+                return_mask=True)
+            fit_list.append(sersic)
+            photo_masks.append(photo_mask)
+        rel_err = np.array([s.r_e_err/s.r_e for s in fit_list])
+    best_idx = rel_err.argmin()
+    best_band = bands[best_idx]
+
+    best = fit_list[best_idx]
+
+    results = _best_results(num, best_band, best, files[best_idx])
     
     if save_figs:
-        imfit.viz.img_mod_res(os.path.join(indir, files[best_idx]), 
+        imfit.viz.img_mod_res(_image(files[best_idx]), 
                               fit_list[best_idx].params, 
-                              mask_files[best_idx], 
+                              photo_masks[best_idx], 
                               band=best_band,
                               subplots=(fig, axes[0]),
-                              show=False)
+                              show=False, 
+                              psf_fn=psf_fns[best_idx])
     
     # perform forced photometry with "best" band as the reference
+    best_mask = photo_masks[best_idx]
     ax_count = 1
     for idx, fn in enumerate(files):
         if idx!=best_idx:
-            band = fn.split('-')[2]
-            fn = os.path.join(indir, fn)
-            init_params = {
-                'X0': [fit_list[best_idx].X0, 'fixed'],
-                'Y0': [fit_list[best_idx].Y0, 'fixed'],
-                'n': [fit_list[best_idx].n, 'fixed'],
-                'PA': [fit_list[best_idx].PA, 'fixed'],
-                'ell': [fit_list[best_idx].ell, 'fixed'],
-                'r_e': fit_list[best_idx].r_e,
-                'I_e': fit_list[idx].I_e
-                }
-            prefix = 'candy-{}-{}-forced-{}'.format(num, band, best_band)
-            prefix = os.path.join(outdir, prefix)
-            if use_psf:
-                psf_fn = 'psf-{}-{}-{}.fits'.format(band.upper(), tract, patch)
-                psf_fn = os.path.join(psf_dir, psf_fn)
+            band, psf_fn = bands[idx], psf_fns[idx]
+            photo_mask = photo_masks[idx if joint else best_idx]
+            if joint:
+                sersic = fit_list[idx]
+            elif forced!='fit':
+                sersic = _linear_forced(fn, best, best_mask, psf_fn, forced)
             else:
-                psf_fn = None
-            sersic = sersic_fit(fn, 
-                                prefix=prefix,
-                                init_params=init_params,
-                                visualize=False, 
-                                clean='config',
-                                photo_mask_fn=mask_files[best_idx], 
-                                psf_fn=psf_fn)
+                init_params = _forced_params(best, fit_list[idx])
+                prefix = 'candy-{}-{}-forced-{}'.format(num, band, best_band)
+                prefix = os.path.join(outdir, prefix)
+                sersic = sersic_fit(fn, 
+                                    prefix=prefix,
+                                    init_params=init_params,
+                                    visualize=False, 
+                                    clean='config',
+                                    photo_mask_fn=mask_files[best_idx] 
+                                    if use_files else best_mask, 
+                                    psf_fn=psf_fn,
+                                    engine=engine,
+                                    coarse=coarse)
 
             # generate output columns for other bands
-            data = [sersic.m_tot, sersic.mu_0, sersic.ell,
-                    sersic.r_e*utils.pixscale, sersic.PA]
-            names = ['m_tot('+band+')', 'mu_0('+band+')', 'ell('+band+')',
-                     'r_e('+band+')', 'PA('+band+')']
-            temp = Table(rows=[data], names=names)
-            results = hstack([results, temp])
+            results = hstack([results, _forced_results(band, sersic)])
 
             if save_figs:
-                imfit.viz.img_mod_res(fn, 
+                imfit.viz.img_mod_res(_image(fn), 
                                       sersic.params, 
-                                      mask_files[best_idx], 
+                                      photo_mask, 
                                       band=band,
                                       subplots=(fig, axes[ax_count]),
                                       show=False, 
-                                      titles=False)
+                                      titles=False, 
+                                      psf_fn=psf_fn)
                 axes[ax_count]
                 ax_count += 1
 
-    for mask_fn in mask_files:
-        os.remove(mask_fn)
+    if use_files:
+        for mask_fn in mask_files:
+            os.remove(mask_fn)
+
+    for fn in temp_files:
+        os.remove(fn)
 
     if save_figs:
         fig_fn = 'candy-{}-fit-results.png'.format(num)
@@ -232,7 +735,207 @@ def fit_candy(num, indir, outdir, init_params={}, save_figs=True,
     return results
 
 
-def run_batch_fit(rundir, bands='GRI', save_figs=True, use_psf=True):
+def fit_candy_block(nums, indir, outdir, init_params={}, save_figs=True, 
+                    mask_kwargs={}, tracts=None, patches=None, use_psf=True, 
+                    butler=None, archive=None, stamp_index=None, 
+                    stamps=None, forced='fit', **kwargs):
+    """
+    Fit a block of candidates as in fit_candy, but with the batched 
+    fitter (see sersic_fit_batch): the stamps of all the candidates 
+    and bands are fit in one call, and then the forced photometry of 
+    all the candidates in another. 
+
+    Parameters
+    ----------
+    nums : list of ints
+        The candidate numbers.
+    init_params : dict or list of dicts, optional
+        Initial imfit parameters for all candidates or for each.
+    tracts, patches : lists, optional
+        Tract and patch of each candidate.
+    archive : StampArchive or string, optional
+        Stamp archive (or its file name) to read the stamps from. 
+        They are fit from memory, without temporary fits files.
+    stamps : dict, optional
+        In-memory stamps, stamps[num][band] = (img, mask, var, headers),
+        e.g. from iter_local_stamps.
+    forced : string, optional
+        Forced photometry mode (see fit_candy). In the linear modes,
+        the forced bands are solved one by one in closed form.
+    kwargs : dict, optional
+        Keyword args for hugs.imfit.engine.fit_batch.
+
+    See fit_candy for the other parameters.
+
+    Returns
+    -------
+    results : astropy.table.Table
+        The results of the candidates, one row per candidate.
+    """
+    assert forced in FORCED, 'forced must be one of '+str(FORCED)
+    if isinstance(init_params, dict):
+        init_params = [init_params]*len(nums)
+    stamp_archive = archive
+    if archive is not None and not isinstance(archive, imtools.StampArchive):
+        stamp_archive = imtools.StampArchive(archive)
+
+    candidates = []
+    for i, num in enumerate(nums):
+        tract, patch = _candy_patch(
+            num, indir, tracts[i] if tracts is not None else None, 
+            patches[i] if patches is not None else None, stamp_index)
+        num_stamps = stamps.get(num) if stamps is not None else None
+        bands, files, _ = _candy_files(num, indir, outdir, stamp_archive, 
+                                       stamp_index, num_stamps, False)
+        psf_fns = [_psf_fn(band, tract, patch, butler) if use_psf else None 
+                   for band in bands]
+        candidates.append((num, files, bands, psf_fns))
+    if stamp_archive is not archive:
+        stamp_archive.close()
+
+    # fit all bands of all candidates separately
+    img_fns, img_bands, params, prefixes, psfs = [], [], [], [], []
+    for i, (num, files, bands, psf_fns) in enumerate(candidates):
+        img_fns.extend(files)
+        img_bands.extend(bands)
+        params.extend([init_params[i]]*len(files))
+        prefixes.extend([os.path.join(outdir, 'candy-{}-{}'.format(num, b))
+                         for b in bands])
+        psfs.extend(psf_fns)
+    fit_list, photo_masks = sersic_fit_batch(
+        img_fns, params, prefixes, clean='both', mask_kwargs=mask_kwargs, 
+        psf_fns=psfs, return_masks=True, **kwargs)
+
+    # forced photometry with the "best" band of each candidate
+    best, forced_list = [], []
+    lo = 0
+    for num, files, bands, psf_fns in candidates:
+        r_e_err = np.array([f.r_e_err/f.r_e for f in 
+                            fit_list[lo:lo + len(files)]])
+        best_idx = r_e_err.argmin()
+        best.append((lo + best_idx, bands[best_idx]))
+        for idx in range(len(files)):
+            if idx!=best_idx:
+                forced_list.append((len(best) - 1, lo + idx))
+        lo += len(files)
+    if forced=='fit':
+        forced_fits = sersic_fit_batch(
+            [img_fns[idx] for _, idx in forced_list], 
+            [_forced_params(fit_list[best[i][0]], fit_list[idx]) 
+             for i, idx in forced_list], clean='config', 
+            photo_mask_fns=[photo_masks[best[i][0]] for i, _ in forced_list],
+            psf_fns=[psfs[idx] for _, idx in forced_list], **kwargs)
+    else:
+        forced_fits = []
+        for i, idx in forced_list:
+            best_idx = best[i][0]
+            forced_fits.append(_linear_forced(
+                img_fns[idx], fit_list[best_idx], photo_masks[best_idx], 
+                psfs[idx], forced))
+
+    rows = []
+    for i, (num, files, bands, psf_fns) in enumerate(candidates):
+        best_idx, best_band = best[i]
+        results = _best_results(num, best_band, fit_list[best_idx], 
+                                img_fns[best_idx])
+        panels = [(best_idx, fit_list[best_idx], True)]
+        for (k, idx), sersic in zip(forced_list, forced_fits):
+            if k==i:
+                results = hstack(
+                    [results, _forced_results(img_bands[idx], sersic)])
+                panels.append((idx, sersic, False))
+        rows.append(results)
+
+        if save_figs:
+            fig, axes = plt.subplots(len(files), 3, figsize=(15,15),
+                                     squeeze=False)
+            fig.subplots_adjust(wspace=0.05, hspace=0.05)
+            for ax, (idx, sersic, titles) in zip(axes, panels):
+                imfit.viz.img_mod_res(_image(img_fns[idx]), 
+                                      sersic.params, 
+                                      photo_masks[best_idx], 
+                                      band=img_bands[idx],
+                                      subplots=(fig, ax),
+                                      show=False, 
+                                      titles=titles, 
+                                      psf_fn=psfs[idx])
+            fig_fn = 'candy-{}-fit-results.png'.format(num)
+            fig.savefig(os.path.join(outdir, fig_fn))
+            plt.close('all')
+
+    return vstack(rows) if rows else Table()
+
+
+def candy_init_params(cat, num):
+    """
+    Initial imfit parameters of a candidate from the hugs_pipe
+    catalog (candy.csv).
+    """
+    pa = cat['PA'][num] 
+    ell = cat['ell'][num]
+    n = cat['n'][num]
+    I_e = cat['I_e(i)'][num]
+    r_e = cat['r_e(i)'][num]*(1/0.168)
+    init_params = {'PA': [pa, 0, 180],
+                   'ell': [ell, 0, 0.999],
+                   'n': [n, 0.001, 5.0],
+                   'I_e': I_e,
+                   'r_e': r_e}
+    return init_params
+
+
+def _fit_block(args):
+    """
+    Fit a block of candidates (for a process pool). Blocks of local
+    stamps carry their patch group (see _patch_groups) and cut their
+    own stamps, so stamps are never sent to the workers.
+    """
+    nums, indir, outdir, kwargs = args
+    kwargs = dict(kwargs)
+    local = kwargs.pop('local', None)
+    if local is not None:
+        kwargs['stamps'] = _patch_stamps(_cut_patch(local))
+    return fit_candy_block(nums, indir, outdir, **kwargs)
+
+
+def _block_args(nums, rundir, imfitdir, cat, **kwargs):
+    """
+    Arguments of _fit_block for a block of candidates.
+    """
+    kwargs.update(init_params=[candy_init_params(cat, n) for n in nums], 
+                  tracts=list(cat['tract'][nums]), 
+                  patches=list(cat['patch'][nums]))
+    return nums, rundir, imfitdir, kwargs
+
+
+def _map_blocks(blocks, n_jobs):
+    """
+    Fit the blocks of candidates, n_jobs at a time.
+    """
+    if n_jobs==1:
+        return list(map(_fit_block, blocks))
+    from multiprocessing import Pool
+    pool = Pool(n_jobs)
+    results = pool.map(_fit_block, blocks)
+    pool.close()
+    pool.join()
+    return results
+
+
+def _fit_loop(nums, rundir, imfitdir, cat, stamps=None, **kwargs):
+    """
+    Fit candidates one by one with fit_candy.
+    """
+    return [fit_candy(num, rundir, imfitdir, candy_init_params(cat, num),
+                      tract=cat['tract'][num], patch=cat['patch'][num], 
+                      stamps=stamps[num] if stamps is not None else None,
+                      **kwargs) for num in nums]
+
+
+def run_batch_fit(rundir, bands='GRI', save_figs=True, use_psf=True,
+                  use_archive=False, use_local=False, n_jobs=1, 
+                  engine='imfit', block_size=None, forced='fit', 
+                  joint=False, band_r_e=False, coarse=None):
     """
     Fit Seric models to postage-stamp candidate images.
     
@@ -244,39 +947,84 @@ def run_batch_fit(rundir, bands='GRI', save_figs=True, use_psf=True):
         Photometric bands to be fit. 
     save_figs : bool
         If True, save a summary figure for each candidate.
-
+    use_archive : bool, optional
+        If True, read the stamps from the run's stamp archive
+        (see get_candy_stamps).
+    use_local : bool, optional
+        If True, cut the stamps from the local coadd patches and 
+        fit them from memory (see iter_local_stamps), patch by patch,
+        so only the stamps of a few patches are held at once. 
+    n_jobs : int, optional
+        Number of patches to cut in parallel if use_local is True,
+        and of blocks to fit in parallel if block_size is given.
+    engine : string, optional
+        Fitting engine ('imfit' or 'scipy', see sersic_fit).
+    block_size : int, optional
+        If not None, fit blocks of this many candidates at once with
+        the batched in-process fitter (see fit_candy_block), which 
+        needs engine='scipy' and no coarse fits. With use_local, 
+        blocks do not span patches.
+    forced : string, optional
+        Forced photometry mode ('fit', 'linear', or 'linear_r_e', 
+        see fit_candy).
+    joint : bool, optional
+        If True, fit all bands of each candidate at once with a 
+        shared shape (see fit_candy). Not available with block_size.
+    band_r_e : bool, optional
+        If joint is True, fit r_e separately in each band.
+    coarse : int, optional
+        Block factor of the coarse-to-fine fits with the 'scipy' 
+        engine (see sersic_fit). Not available with block_size.
     """
-    cat_fn = os.path.join(rundir, 'candy.csv')
-    cat = Table.read(cat_fn)
-
-    # get number of candidates
-    stamp_files = [f for f in os.listdir(rundir) if 
-                   f.split('-')[-1]=='wide.fits']
-    assert len(stamp_files)%len(bands)==0
-    num_candy = len(stamp_files)//len(bands)
+    assert not (joint and block_size), 'joint fits are not batched'
+    assert block_size is None or (engine=='scipy' and coarse is None),\
+        "block_size needs engine='scipy' and no coarse fits"
+    cat = Table.read(os.path.join(rundir, 'candy.csv'))
 
     # all imfit results will be saved in imfit directory
     imfitdir = os.path.join(rundir, 'imfit')
     utils.mkdir_if_needed(imfitdir)
 
-    # loop over candidates 
-    candy_params = Table()
-    for num in range(num_candy):	
-        # get initial guess parameters
-        pa = cat['PA'][num] 
-        ell = cat['ell'][num]
-        n = cat['n'][num]
-        I_e = cat['I_e(i)'][num]
-        r_e = cat['r_e(i)'][num]*(1/0.168)
-        init_params = {'PA': [pa, 0, 180],
-                       'ell': [ell, 0, 0.999],
-                       'n': [n, 0.001, 5.0],
-                       'I_e': I_e,
-                       'r_e': r_e}
-        results = fit_candy(
-            num, rundir, imfitdir, init_params, save_figs, cat=cat,
-            use_psf=use_psf)
-        candy_params = vstack([candy_params, results])
+    kwargs = dict(save_figs=save_figs, use_psf=use_psf, forced=forced)
+    if block_size is None:
+        kwargs.update(engine=engine, joint=joint, band_r_e=band_r_e, 
+                      coarse=coarse)
+
+    if use_local and block_size is None:
+        # cut and fit the candidates patch by patch
+        rows = []
+        for stamps in _iter_local_patches(cat, bands, n_jobs=n_jobs):
+            rows += _fit_loop(list(stamps.keys()), rundir, imfitdir, cat, 
+                              stamps, **kwargs)
+    elif use_local:
+        blocks = [_block_args(group[2], rundir, imfitdir, cat, local=group, 
+                              **kwargs) 
+                  for group in _patch_groups(cat, bands, 
+                                             block_size=block_size)]
+        rows = _map_blocks(blocks, n_jobs)
+    elif use_archive and block_size is None:
+        with imtools.StampArchive(os.path.join(rundir, ARCHIVE_FN)) as arch:
+            rows = _fit_loop(arch.candidates(), rundir, imfitdir, cat, 
+                             archive=arch, **kwargs)
+    else:
+        if use_archive:
+            kwargs['archive'] = os.path.join(rundir, ARCHIVE_FN)
+            with imtools.StampArchive(kwargs['archive']) as arch:
+                nums = arch.candidates()
+        else:
+            kwargs['stamp_index'] = read_stamp_index(rundir)
+            nums = sorted(kwargs['stamp_index'].keys())
+        if block_size is None:
+            rows = _fit_loop(nums, rundir, imfitdir, cat, **kwargs)
+        else:
+            blocks = [_block_args(nums[lo:lo + block_size], rundir, 
+                                  imfitdir, cat, **kwargs) 
+                      for lo in range(0, len(nums), block_size)]
+            rows = _map_blocks(blocks, n_jobs)
+
+    candy_params = vstack(rows) if rows else Table()
+    if len(candy_params) > 0:
+        candy_params.sort('candy_num')
 
     out_fn = os.path.join(imfitdir, 'candy-imfit-params.csv')
     candy_params.write(out_fn)
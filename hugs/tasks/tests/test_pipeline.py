@@ -0,0 +1,50 @@
+from __future__ import division, print_function
+
+import os
+import numpy as np
+from astropy.table import Table
+from .. import pipeline, stamps
+from ...datasets import das
+
+
+class _Unwritable(object):
+
+    def write(self, *args, **kwargs):
+        raise IOError('disk full')
+
+
+def _fake_fit_candy(num, rundir, imfitdir, init_params, stamp_index=None,
+                    **kwargs):
+    # candidate 1 fails inside fit_candy, candidate 2 when it is saved
+    if num==1:
+        raise ValueError('bad fit')
+    if num==2:
+        return _Unwritable()
+    files = stamp_index[num]['files']
+    assert sorted(files.keys())==['g', 'r']
+    return Table(rows=[[num, len(files)]], names=['candy_num', 'num_bands'])
+
+
+def test_pipeline(tmpdir, monkeypatch, das_server):
+    monkeypatch.setattr(stamps, 'fit_candy', _fake_fit_candy)
+    num = 5
+    cat = Table({'ra': np.arange(num, dtype=float), 'dec': np.zeros(num), 
+                 'tract': [9348]*num, 'patch': ['7,6']*num, 
+                 'PA': np.zeros(num), 'ell': np.zeros(num), 
+                 'n': np.ones(num), 'I_e(i)': np.ones(num), 
+                 'r_e(i)': np.ones(num)})
+    rundir = str(tmpdir.join('run'))
+    downloader = das.DASDownloader('user', url=das_server.url, chunk_size=3, 
+                                   n_jobs=2)
+
+    results = pipeline.run_pipeline(cat, rundir, downloader, bands='GR', 
+                                    n_fit=2, queue_size=1)
+
+    assert list(results['candy_num'])==[0, 3, 4]
+    assert (results['num_bands']==2).all()
+    with open(os.path.join(rundir, 'coordlist.txt')) as file:
+        lines = file.read().splitlines()[1:]
+    assert [line.split()[4] for line in lines]==['HSC-G', 'HSC-R']*num
+    stamp_index = stamps.read_stamp_index(rundir, build=False)
+    assert sorted(stamp_index.keys())==list(range(num))
+    assert stamp_index[3]['files']['r']=='candy-3-r-s16a-wide.fits'
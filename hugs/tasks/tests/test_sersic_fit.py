@@ -0,0 +1,55 @@
+from __future__ import division, print_function
+
+import os
+import numpy as np
+from ... import imfit, imtools
+from ...imfit.core import SERSIC_PARAMS
+from ...imfit.fisher import sersic_jacobian
+from ..sersic_fit import sersic_fit, sersic_fit_batch
+
+PARAMS = {'X0': 30.4, 'Y0': 28.7, 'PA': 35.0, 'ell': 0.3, 'n': 1.1,
+          'I_e': 0.5, 'r_e': 6.0}
+
+
+def _stamp():
+    np.random.seed(3)
+    y, x = np.mgrid[1:61, 1:59]
+    img = sersic_jacobian(x, y, *[PARAMS[p] for p in SERSIC_PARAMS])[0]
+    img += np.random.normal(0, 0.01, img.shape)
+    return img, np.zeros(img.shape, dtype='i4'), np.full(img.shape, 1e-4), \
+           [None]*3
+
+
+def _fake_make_mask(masked_image, out_fn=None, **kwargs):
+    mask = np.zeros(masked_image[0].shape, dtype=int)
+    mask[:5] = 1
+    if out_fn is not None:
+        imtools.write_fits(out_fn, mask.astype(np.uint8))
+    return mask
+
+
+def test_scipy_masks(tmpdir, monkeypatch):
+    monkeypatch.setattr(imfit, 'make_mask', _fake_make_mask)
+    prefix = str(tmpdir.join('fit'))
+    init = {'X0': [30.0, 25, 35], 'Y0': [29.0, 24, 34]}
+    stamp = _stamp()
+
+    # the scipy engine keeps the mask in memory
+    sersic, mask = sersic_fit(stamp, init, prefix, engine='scipy', 
+                              return_mask=True)
+    assert os.listdir(str(tmpdir))==[]
+    assert mask[:5].all() and not mask[5:].any()
+    assert np.isclose(sersic.r_e, PARAMS['r_e'], rtol=0.05)
+
+    forced = sersic_fit(stamp, init, prefix, clean='config', 
+                        photo_mask_fn=mask, engine='scipy')
+    sersics, masks = sersic_fit_batch([stamp], init, [prefix], 
+                                      photo_mask_fns=[mask], 
+                                      return_masks=True)
+    assert os.listdir(str(tmpdir))==[]
+    assert masks[0] is mask
+    assert np.isclose(forced.r_e, sersics[0].r_e, rtol=1e-3)
+
+    # masks that are not cleaned are still written
+    sersic_fit(stamp, init, prefix, clean='config', engine='scipy')
+    assert os.listdir(str(tmpdir))==['fit_photo_mask.fits']
@@ -0,0 +1,136 @@
+from __future__ import division, print_function
+
+import os
+import numpy as np
+from astropy.table import Table
+from .. import stamps
+
+
+def test_stamp_index(tmpdir):
+    rundir = str(tmpdir)
+    for num in [0, 1, 10]:
+        for band in 'GRI':
+            open(os.path.join(rundir, 'candy-{}-{}-rerun.fits'.format(
+                num, band)), 'w').close()
+    open(os.path.join(rundir, 'candy.csv.fits'), 'w').close()
+    cat = Table({'tract': [9348, 9348, 9615] + [0]*8, 
+                 'patch': ['7,6', '7,6', '1,2'] + ['0,0']*8})
+    cat.write(os.path.join(rundir, 'candy.csv'))
+
+    stamp_index = stamps.read_stamp_index(rundir)
+    assert os.listdir(rundir).count(stamps.INDEX_FN)==1
+    assert sorted(stamp_index.keys())==[0, 1, 10]
+    entry = stamp_index[10]
+    assert sorted(entry['files'].keys())==['G', 'I', 'R']
+    assert entry['files']['R']=='candy-10-R-rerun.fits'
+    assert (entry['tract'], entry['patch'])==(0, '0,0')
+    assert stamp_index[1]['patch']=='7,6'
+
+    # readers that do not build see the same index
+    assert stamps.read_stamp_index(rundir, build=False)==stamp_index
+
+
+def _write_patches(hscdir, tract, patches, bands='GR'):
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [150.0, 2.0]
+    wcs.wcs.crpix = [100.0, 100.0]
+    wcs.wcs.cdelt = [-0.168/3600, 0.168/3600]
+    header = wcs.to_header()
+    header['CRVAL1A'], header['CRVAL2A'] = 4000, 8000
+    images = {}
+    for i, patch in enumerate(patches):
+        for j, band in enumerate(bands):
+            np.random.seed(10*i + j)
+            img = np.random.normal(size=(300, 320)).astype('f4')
+            mask = np.random.randint(0, 64, img.shape).astype('i4')
+            var = np.full(img.shape, 0.5 + j, dtype='f4')
+            fn = stamps.coadd_fn(tract, patch, band, hscdir)
+            os.makedirs(os.path.dirname(fn))
+            hdus = [fits.PrimaryHDU()] + [fits.ImageHDU(d, header) 
+                                          for d in [img, mask, var]]
+            fits.HDUList(hdus).writeto(fn)
+            images[patch, band] = img, mask, var
+    return wcs, images
+
+
+def _local_catalog(wcs, tract, patches, xy):
+    ra, dec = wcs.all_pix2world(xy[:, 0], xy[:, 1], 0)
+    return Table({'ra': ra, 'dec': dec, 'tract': [tract]*len(xy),
+                  'patch': patches})
+
+
+def test_local_stamps(tmpdir):
+    from astropy.nddata import Cutout2D
+    from ...imtools import StampArchive
+    hscdir = str(tmpdir.join('hsc'))
+    patches = ['1,2', '3,4', '1,2', '1,2', '3,4']
+    xy = np.array([[100, 100], [160, 150], [60.4, 200.7], [250, 70], 
+                   [130, 220]])
+    wcs, images = _write_patches(hscdir, 9348, ['1,2', '3,4'])
+    cat = _local_catalog(wcs, 9348, patches, xy)
+
+    groups = stamps._patch_groups(cat, 'GR', hscdir=hscdir)
+    assert [g[2] for g in groups]==[[0, 2, 3], [1, 4]]
+    groups = stamps._patch_groups(cat, 'GR', hscdir=hscdir, block_size=2)
+    assert [g[2] for g in groups]==[[0, 2], [3], [1, 4]]
+
+    npix = 2*int(30/0.168) + 1
+    for n_jobs in [1, 2]:
+        local = list(stamps.iter_local_stamps(cat, 'GR', n_jobs=n_jobs, 
+                                              hscdir=hscdir))
+        # all the bands of a patch come together
+        assert [(num, band) for num, band, _ in local]==[
+            (0, 'g'), (0, 'r'), (2, 'g'), (2, 'r'), (3, 'g'), (3, 'r'),
+            (1, 'g'), (1, 'r'), (4, 'g'), (4, 'r')]
+        for num, band, (img, mask, var, headers) in local:
+            x0 = int(np.ceil(xy[num, 0] - npix/2))
+            y0 = int(np.ceil(xy[num, 1] - npix/2))
+            full = images[patches[num], band.upper()]
+            expected = Cutout2D(full[0], tuple(xy[num]), npix, 
+                                mode='partial', fill_value=np.nan).data
+            assert np.allclose(img, expected, equal_nan=True)
+            assert headers[0]['CRPIX1']==100 - x0
+            assert headers[0]['CRVAL2A']==8000 + y0
+
+    # archive round trip
+    archive_fn = str(tmpdir.join('stamps.h5'))
+    local = stamps.get_local_stamps(cat, 'GR', hscdir=hscdir, 
+                                    archive_fn=archive_fn)
+    with StampArchive(archive_fn) as archive:
+        assert archive.candidates()==[0, 1, 2, 3, 4]
+        for num in range(5):
+            assert archive.bands(num)==['g', 'r']
+            stamp = archive.stamp(num, 'r')
+            for a, b in zip(stamp[:3], local[num]['r'][:3]):
+                assert np.array_equal(a, b, equal_nan=True)
+            assert stamp[3][1]['CRPIX2']==local[num]['r'][3][1]['CRPIX2']
+
+
+def test_candy_files(tmpdir):
+    from ...imtools import StampArchive
+    outdir = str(tmpdir)
+    img = np.arange(12.0).reshape(3, 4)
+    stamp = (img, np.zeros((3, 4), dtype='i4'), np.ones((3, 4)), [None]*3)
+    num_stamps = {'g': stamp, 'r': stamp}
+
+    bands, files, temp = stamps._candy_files(
+        3, outdir, outdir, stamps=num_stamps, to_fits=False)
+    assert bands==['g', 'r'] and files[0] is stamp and temp==[]
+    assert os.listdir(outdir)==[]
+
+    bands, files, temp = stamps._candy_files(3, outdir, outdir, 
+                                             stamps=num_stamps)
+    assert temp==files==[os.path.join(outdir, 'candy-3-g-local.fits'),
+                         os.path.join(outdir, 'candy-3-r-local.fits')]
+    assert all(os.path.isfile(fn) for fn in temp)
+
+    archive_fn = str(tmpdir.join('stamps.h5'))
+    with StampArchive(archive_fn, 'w') as archive:
+        archive.write(3, 'i', *stamp[:3])
+    bands, files, temp = stamps._candy_files(3, outdir, outdir, archive_fn, 
+                                             to_fits=False)
+    assert bands==['i'] and temp==[]
+    assert np.array_equal(files[0][0], img)
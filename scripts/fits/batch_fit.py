@@ -29,9 +29,12 @@ def worker(source):
                    'n': [n, 0.001, 5.0],
                    'I_e': I_e,
                    'r_e': r_e}
+    archive = source['archive'] if source['archive'] else None
     results = hugs.tasks.fit_candy(
         num, rundir, imfitdir, init_params, save_figs, tract=source['tract'],
-        patch=source['patch'], use_psf=use_psf)
+        patch=source['patch'], use_psf=use_psf, archive=archive,
+        stamp_index=stamp_index, engine=source['engine'],
+        coarse=source['coarse'] if source['coarse'] else None)
     out_fn = os.path.join(imfitdir, 'candy-{}-imfit-params.csv'.format(num))
     results.write(out_fn)
 
@@ -48,6 +51,12 @@ if __name__=='__main__':
     parser.add_argument('--save_figs', action='store_false')
     parser.add_argument('--bands', type=str, default='GRI')
     parser.add_argument('--cat_fn', type=str, default='candy.csv')
+    parser.add_argument('--archive', action='store_true',
+                        help='read stamps from the run stamp archive')
+    parser.add_argument('--engine', type=str, default='imfit',
+                        help='fitting engine (imfit or scipy)')
+    parser.add_argument('--coarse', type=int, default=0,
+                        help='block factor of coarse-to-fine scipy fits')
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--ncores", dest="n_cores", default=1, type=int)
@@ -59,16 +68,30 @@ if __name__=='__main__':
     cat = Table.read(cat_fn)
 
     # get number of candidates
-    stamp_files = [f for f in os.listdir(args.path) if
-                   f.split('-')[-1]=='wide.fits']
-    assert len(stamp_files)%len(args.bands)==0
-    num_candy = len(stamp_files)//len(args.bands)
+    if args.archive:
+        archive_fn = os.path.join(args.path, hugs.tasks.stamps.ARCHIVE_FN)
+        with hugs.imtools.StampArchive(archive_fn) as archive:
+            num_candy = len(archive.candidates())
+        stamp_index = None
+    else:
+        archive_fn = ''
+        # build the index once, so ranks never read a half-written file
+        index_fn = os.path.join(args.path, hugs.tasks.stamps.INDEX_FN)
+        if rank==0 and not os.path.isfile(index_fn):
+            hugs.tasks.build_stamp_index(args.path)
+        if args.mpi:
+            MPI.COMM_WORLD.Barrier()
+        stamp_index = hugs.tasks.read_stamp_index(args.path, build=False)
+        num_candy = len(stamp_index)
     assert len(cat)==num_candy
 
     cat['num'] = np.arange(num_candy)
     cat['rundir'] = args.path
     cat['save_figs'] = args.save_figs
     cat['no_psf'] = args.no_psf
+    cat['archive'] = archive_fn
+    cat['engine'] = args.engine
+    cat['coarse'] = args.coarse
 
     # all imfit results will be saved in imfit directory
     if rank==0: